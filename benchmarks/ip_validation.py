@@ -0,0 +1,65 @@
+"""
+Compare the integer IP validation used by TraceParser with the
+regular expressions it used to run on every hop.
+
+Usage: python benchmarks/ip_validation.py [--count N]
+"""
+import re
+import random
+import timeit
+import argparse
+
+from inettopology_popmap.data.parsers import public_ipnum
+
+ipregex = re.compile("[1-9][0-9]{0,2}(\.[0-9]{1,3}){3}")
+privateipregex = re.compile("(^127\.0\.0\.1)|(^192\.168)|(^10\.)|(^172\.1[6-9])|(^172\.2[0-9])|(^172\.3[0-1])")
+
+
+def regex_is_valid(ip):
+  if privateipregex.match(ip) or not ipregex.match(ip):
+    return False
+  return True
+
+
+def sample_hops(count, seed=0):
+  """ A mix of hop fields like those found in traces: mostly
+  public addresses, with some private ones and timeouts.
+  """
+  rnd = random.Random(seed)
+  hops = []
+  for i in xrange(count):
+    roll = rnd.random()
+    if roll < 0.05:
+      hops.append('*')
+    elif roll < 0.15:
+      hops.append("10.{0}.{1}.{2}".format(rnd.randint(0, 255),
+                                          rnd.randint(0, 255),
+                                          rnd.randint(1, 254)))
+    else:
+      hops.append(".".join(str(rnd.randint(1, 223)) for octet in xrange(4)))
+  return hops
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--count", type=int, default=100000)
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  hops = sample_hops(args.count)
+
+  def run_regex():
+    for ip in hops:
+      regex_is_valid(ip)
+
+  def run_integer():
+    for ip in hops:
+      public_ipnum(ip)
+
+  for name, func in (('regex', run_regex), ('integer', run_integer)):
+    best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+    print "{0:>8}: {1:.3f}s for {2} hops [{3:.0f} ns/hop]".format(
+        name, best, args.count, best / args.count * 1e9)
+
+if __name__ == '__main__':
+  main()
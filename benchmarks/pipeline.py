@@ -0,0 +1,340 @@
+"""
+End to end benchmark of the PoP mapping pipeline.
+
+Generates a synthetic trace file (see tracegen.py), starts a
+throwaway redis-server, and runs each stage against it:
+
+  parse          process parse
+  assign_pops    process assign_pops
+  assign_failed  process assign_pops --process_failed (if needed)
+  process_joins  process process_joins
+
+For each stage it reports the wall time, the items it handled (links
+queued by parse, links assigned, or joins processed) and the rate,
+the Redis round trips made (counted in the stage's own process, so
+the round trips of separate parse workers aren't included), the
+commands the server executed, and the peak RSS of the stage. The
+parse rate is also given in traces/sec.
+
+With '--backend memory' the stages use the in-process store instead,
+handing the database from one stage to the next in a snapshot file.
+There's no server to count commands, and the time to load and save
+the snapshot is part of each stage. With '--shards N' the stages
+spread the database over N redis-servers, and the commands are
+counted across all of them.
+
+Usage: python benchmarks/pipeline.py [--traces N] [--workers N] [--shards N]
+                                    [--json FILE]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+
+import redis
+
+import tracegen
+import inettopology_popmap.memstore as memstore
+
+
+def _free_port():
+  sock = socket.socket()
+  sock.bind(('localhost', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+class ThrowawayRedis(object):
+  """ A redis-server running in a temporary directory, with
+  persistence turned off, for the lifetime of a with block.
+  """
+
+  def __init__(self, executable='redis-server'):
+    self.executable = executable
+    self.port = _free_port()
+
+  def __enter__(self):
+    self.dir = tempfile.mkdtemp(prefix='popmap-bench-')
+    self.process = subprocess.Popen(
+        [self.executable, '--port', str(self.port), '--dir', self.dir,
+         '--save', '', '--appendonly', 'no'],
+        stdout=open(os.path.join(self.dir, 'redis.log'), 'w'),
+        stderr=subprocess.STDOUT)
+
+    self.client = redis.StrictRedis(port=self.port)
+    deadline = time.time() + 10
+    while True:
+      try:
+        self.client.ping()
+        return self
+      except redis.ConnectionError:
+        if time.time() > deadline or self.process.poll() is not None:
+          self.__exit__(None, None, None)
+          raise RuntimeError("Couldn't start {0}".format(self.executable))
+        time.sleep(0.05)
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.process.terminate()
+    self.process.wait()
+    shutil.rmtree(self.dir, ignore_errors=True)
+
+  @property
+  def clients(self):
+    return [self.client]
+
+  def commands_processed(self):
+    return self.client.info('stats')['total_commands_processed']
+
+  def stage_args(self):
+    return ['--redis', 'localhost:{0}:0'.format(self.port)]
+
+
+class ThrowawayShards(object):
+  """ Several ThrowawayRedis servers, which the stages use as one
+  sharded database.
+  """
+
+  def __init__(self, count, executable='redis-server'):
+    self.servers = [ThrowawayRedis(executable) for i in xrange(count)]
+
+  def __enter__(self):
+    started = []
+    try:
+      for server in self.servers:
+        started.append(server.__enter__())
+    except Exception:
+      for server in started:
+        server.__exit__(None, None, None)
+      raise
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    for server in self.servers:
+      server.__exit__(exc_type, exc_value, tb)
+
+  @property
+  def clients(self):
+    return [server.client for server in self.servers]
+
+  def commands_processed(self):
+    return sum(server.commands_processed() for server in self.servers)
+
+  def stage_args(self):
+    args = self.servers[0].stage_args()
+    for server in self.servers[1:]:
+      args.extend(['--redis_shard', 'localhost:{0}:0'.format(server.port)])
+    return args
+
+
+class SnapshotStore(object):
+  """ Stands in for ThrowawayRedis when the stages use the memory
+  backend, passing the database between them in a snapshot file.
+  """
+
+  def __enter__(self):
+    self.dir = tempfile.mkdtemp(prefix='popmap-bench-')
+    self.snapshot = os.path.join(self.dir, 'popmap.snapshot')
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    shutil.rmtree(self.dir, ignore_errors=True)
+
+  @property
+  def clients(self):
+    return [memstore.MemoryRedis(self.snapshot)]
+
+  def commands_processed(self):
+    return None
+
+  def stage_args(self):
+    return ['--backend', 'memory', '--snapshot', self.snapshot]
+
+
+def _queue_length(server, name):
+  """ The total length of the list :name: and of its link
+  partitions, if it has any (see dbkeys), on every instance.
+  """
+  return sum(client.llen(key) for client in server.clients
+             for key in client.keys(name) + client.keys(name + ':{*'))
+
+
+def _count_traces(path):
+  with open(path) as fh:
+    return sum(1 for line in fh if line.startswith('traceroute'))
+
+
+def _run_stage(argv, conn):
+  """ Run the popmap command :argv: in this (child) process and
+  send back (round trips, peak RSS in KB, error or None).
+  """
+  from inettopology_popmap import cmdline
+
+  round_trips = [0]
+  send = redis.connection.Connection.send_packed_command
+
+  def counting_send(self, command):
+    round_trips[0] += 1
+    return send(self, command)
+  redis.connection.Connection.send_packed_command = counting_send
+
+  error = None
+  try:
+    parser = argparse.ArgumentParser()
+    cmdline.__argparse__(parser.add_subparsers(), [])
+    args = parser.parse_args(argv)
+    args.func(args)
+  except BaseException as e:
+    error = "{0}: {1}".format(type(e).__name__, e)
+
+  peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  conn.send((round_trips[0], peak, error))
+  conn.close()
+
+
+def run_stage(server, name, argv, count_items):
+  """ Run one stage in a fresh process so that its peak RSS is its
+  own. :count_items: is called before and after the stage to find
+  how many items it handled.
+
+  :returns: dict of measurements
+  """
+  before_items = count_items()
+  before_commands = server.commands_processed()
+  parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+  process = multiprocessing.Process(target=_run_stage,
+                                    args=(argv, child_conn))
+  started = time.time()
+  process.start()
+  round_trips, peak_kb, error = parent_conn.recv()
+  process.join()
+  elapsed = time.time() - started
+
+  items = abs(count_items() - before_items)
+  after_commands = server.commands_processed()
+  return {'stage': name,
+          'seconds': elapsed,
+          'items': items,
+          'items_per_sec': items / max(elapsed, 1e-6),
+          'round_trips': round_trips,
+          'redis_commands': (None if after_commands is None
+                             else after_commands - before_commands),
+          'peak_rss_mb': peak_kb / 1024.0,
+          'error': error}
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  tracegen.add_arguments(parser)
+  parser.add_argument("--workers", type=int, default=1,
+                      help="Parse workers (default: 1)")
+  parser.add_argument("--backend", choices=("redis", "memory"),
+                      default="redis",
+                      help="Storage backend for the stages (default: redis)")
+  parser.add_argument("--write_pipelines", type=int, default=1,
+                      help="Batches each parse worker keeps in flight "
+                           "(default: 1)")
+  parser.add_argument("--shards", type=int, default=1,
+                      help="redis-servers to spread the database over "
+                           "(default: 1)")
+  parser.add_argument("--redis_server", default="redis-server",
+                      help="redis-server executable (default: redis-server)")
+  parser.add_argument("--ip_layout", choices=("hash", "compact"),
+                      default="hash",
+                      help="IP record layout to parse into (default: hash)")
+  parser.add_argument("--trace_file",
+                      help="Use this trace file instead of generating one")
+  parser.add_argument("--json", metavar="FILE",
+                      help="Also write the results to FILE as JSON")
+  parser.add_argument("-v", "--verbose", action="store_true",
+                      help="Show the log output of each stage")
+  options = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO if options.verbose
+                      else logging.WARNING)
+
+  workdir = tempfile.mkdtemp(prefix='popmap-traces-')
+  try:
+    trace_file = options.trace_file
+    if trace_file is not None:
+      options.traces = _count_traces(trace_file)
+    else:
+      trace_file = os.path.join(workdir, 'traces.txt')
+      started = time.time()
+      with open(trace_file, 'w') as fh:
+        tracegen.TraceGenerator(options).write(fh)
+      sys.stderr.write("Generated {0} traces in {1:.1f}s\n"
+                       .format(options.traces, time.time() - started))
+
+    if options.backend == 'memory':
+      store = SnapshotStore()
+    elif options.shards > 1:
+      store = ThrowawayShards(options.shards, options.redis_server)
+    else:
+      store = ThrowawayRedis(options.redis_server)
+
+    with store as server:
+      redis_arg = server.stage_args()
+
+      def unassigned():
+        return _queue_length(server, 'delayed_job:unassigned_links')
+
+      def failed():
+        return _queue_length(server, 'delayed_job:unassigned_link_fails')
+
+      def joins():
+        return _queue_length(server, 'delayed_job:popjoins')
+
+      results = []
+      results.append(run_stage(
+          server, 'parse',
+          ['process', 'parse', trace_file, '--workers', str(options.workers),
+           '--write_pipelines', str(options.write_pipelines),
+           '--ip_layout', options.ip_layout] + redis_arg, unassigned))
+      results[-1]['traces'] = options.traces
+      results[-1]['traces_per_sec'] = (options.traces /
+                                       max(results[-1]['seconds'], 1e-6))
+
+      results.append(run_stage(server, 'assign_pops',
+                               ['process', 'assign_pops'] + redis_arg,
+                               unassigned))
+      if failed() > 0:
+        results.append(run_stage(
+            server, 'assign_failed',
+            ['process', 'assign_pops', '--process_failed'] + redis_arg,
+            failed))
+      results.append(run_stage(server, 'process_joins',
+                               ['process', 'process_joins'] + redis_arg,
+                               joins))
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  print "{0:<14} {1:>9} {2:>9} {3:>11} {4:>11} {5:>11} {6:>9}".format(
+      'stage', 'seconds', 'items', 'items/sec', 'round trips',
+      'commands', 'peak MB')
+  for result in results:
+    print ("{stage:<14} {seconds:>9.2f} {items:>9} {items_per_sec:>11.1f} "
+           "{round_trips:>11} {redis_commands!s:>11} {peak_rss_mb:>9.1f}"
+           .format(**result))
+    if result['error']:
+      print "  failed: {0}".format(result['error'])
+  print "parse: {0:.1f} traces/sec".format(results[0]['traces_per_sec'])
+
+  if options.json:
+    with open(options.json, 'w') as fh:
+      json.dump({'options': vars(options), 'results': results}, fh,
+                indent=2)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,161 @@
+"""
+Generate synthetic traceroutes in the format written by
+sc_warts2text. The output depends only on the options and the seed,
+so the same command always produces the same file.
+
+Router addresses are drawn from a fixed number of random public /16
+blocks. Each block maps (through the GeoIP database) to whichever AS
+owns it, so --prefixes sets the AS mix and --as_skew how unevenly
+traces are spread across it. Each trace crosses a few blocks, with
+small delays between routers in the same block and larger ones
+between blocks.
+
+Usage: python benchmarks/tracegen.py --traces N [options] > traces.txt
+"""
+import sys
+import random
+import argparse
+
+# Leading octets which don't hold public unicast addresses
+RESERVED_FIRST_OCTETS = frozenset([0, 10, 100, 127, 169, 172, 192])
+
+
+def add_arguments(parser):
+  """ Add the generator options to the argparse :parser: """
+  parser.add_argument("--traces", type=int, default=10000,
+                      help="Number of traces (default: 10000)")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed (default: 0)")
+  parser.add_argument("--monitors", type=int, default=20,
+                      help="Number of distinct trace sources (default: 20)")
+  parser.add_argument("--min_hops", type=int, default=6,
+                      help="Fewest hops in a trace (default: 6)")
+  parser.add_argument("--max_hops", type=int, default=20,
+                      help="Most hops in a trace (default: 20)")
+  parser.add_argument("--prefixes", type=int, default=200,
+                      help="Number of /16 blocks routers are drawn from "
+                           "(default: 200)")
+  parser.add_argument("--as_skew", type=float, default=1.0,
+                      help="Zipf exponent for how often each block is "
+                           "crossed. 0 is uniform (default: 1.0)")
+  parser.add_argument("--routers", type=int, default=50,
+                      help="Routers per block (default: 50)")
+  parser.add_argument("--ip_reuse", type=float, default=0.9,
+                      help="Chance that a hop is one of its block's "
+                           "routers rather than a fresh address "
+                           "(default: 0.9)")
+  parser.add_argument("--delay_noise", type=float, default=0.5,
+                      help="Standard deviation of the jitter added to "
+                           "each delay, in ms (default: 0.5)")
+  parser.add_argument("--loss", type=float, default=0.03,
+                      help="Chance that a hop doesn't reply (default: 0.03)")
+
+
+def _dotted(ipnum):
+  return "{0}.{1}.{2}.{3}".format(ipnum >> 24, (ipnum >> 16) & 0xff,
+                                  (ipnum >> 8) & 0xff, ipnum & 0xff)
+
+
+class TraceGenerator(object):
+  """ Builds a random topology from :options: (the values of
+  the arguments added by add_arguments) and walks traces across it.
+  """
+
+  def __init__(self, options):
+    self.options = options
+    self.rnd = random.Random(options.seed)
+
+    self.blocks = []
+    seen = set()
+    while len(self.blocks) < options.prefixes:
+      block = (self.rnd.randint(1, 223) << 8) | self.rnd.randint(0, 255)
+      if block >> 8 not in RESERVED_FIRST_OCTETS and block not in seen:
+        seen.add(block)
+        self.blocks.append(block)
+
+    self.routers = [[self._fresh_address(block)
+                     for i in xrange(options.routers)]
+                    for block in self.blocks]
+    self.monitors = [self._fresh_address(self.rnd.choice(self.blocks))
+                     for i in xrange(options.monitors)]
+
+    weights = [1.0 / (rank ** options.as_skew)
+               for rank in xrange(1, len(self.blocks) + 1)]
+    total = sum(weights)
+    self.cumulative = []
+    running = 0.0
+    for weight in weights:
+      running += weight / total
+      self.cumulative.append(running)
+
+  def _fresh_address(self, block):
+    return _dotted((block << 16) | self.rnd.randint(1, 0xfffe))
+
+  def _pick_block(self):
+    roll = self.rnd.random()
+    lo, hi = 0, len(self.cumulative) - 1
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.cumulative[mid] < roll:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _hop_address(self, block):
+    if self.rnd.random() < self.options.ip_reuse:
+      return self.rnd.choice(self.routers[block])
+    return self._fresh_address(self.blocks[block])
+
+  def trace(self):
+    """ Return the lines of one trace, header first. """
+    options = self.options
+    rnd = self.rnd
+    src = rnd.choice(self.monitors)
+    hops = rnd.randint(options.min_hops, options.max_hops)
+    dst_block = self._pick_block()
+    dst = self._fresh_address(self.blocks[dst_block])
+
+    lines = ["traceroute from {0} to {1}".format(src, dst)]
+    delay = 0.0
+    block = self._pick_block()
+    for ttl in xrange(1, hops + 1):
+      if ttl == hops:
+        block = dst_block
+      elif rnd.random() < 0.25:
+        block = self._pick_block()
+        delay += rnd.uniform(5.0, 40.0)
+      delay += rnd.uniform(0.1, 2.0)
+
+      if rnd.random() < options.loss:
+        lines.append("{0:2d}  *".format(ttl))
+        continue
+      noisy = max(0.001, delay + rnd.gauss(0.0, options.delay_noise))
+      lines.append("{0:2d}  {1}  {2:.3f} ms"
+                   .format(ttl, self._hop_address(block), noisy))
+    return lines
+
+  def write(self, fh):
+    for i in xrange(self.options.traces):
+      fh.write("\n".join(self.trace()))
+      fh.write("\n")
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  add_arguments(parser)
+  parser.add_argument("-o", "--output",
+                      help="Write to this file instead of stdout")
+  options = parser.parse_args()
+
+  generator = TraceGenerator(options)
+  if options.output:
+    with open(options.output, 'w') as fh:
+      generator.write(fh)
+  else:
+    generator.write(sys.stdout)
+
+if __name__ == '__main__':
+  main()
@@ -6,18 +6,29 @@ def lazy_load(package, function, check_args=None):
   """ A helper to lazy load functions that start
   actions to avoid circular references. If :check_args:
   is given, run that to allow checking arguments
-  specific to certain functions.
+  specific to certain functions. The storage backend
+  chosen with --backend is set up before the function runs,
+  as are the metrics asked for with --metrics_port and
+  --metrics_json.
   """
   def runner(args):
 
     if check_args is not None:
       check_args(args)
 
+    import inettopology_popmap.connection as connection
+    import inettopology_popmap.metrics as metrics
+    finish_metrics = metrics.start(args)
+    close_backend = connection.open_backend(args)
+
     module = importlib.import_module("{0}.{1}".format(
                                      __name__, package))
     try:
       module.__dict__[function](args)
     except KeyboardInterrupt:
       raise inettopology.SilentExit()
+    finally:
+      finish_metrics()
+      close_backend()
 
   return runner
@@ -23,6 +23,42 @@ def __argparse__(subparser, parents=[]):
                      default={'host': 'localhost', 'port': 6379, 'db': 0},
                      help="Redis connection info for router server "
                           "(default: 'localhost:6379:0')")
+  gen_p.add_argument("--redis_pool_size", type=int, default=50,
+                     metavar="N",
+                     help="Most connections to Redis open at once in "
+                          "each process (default: 50)")
+  gen_p.add_argument("--redis_timeout", type=float, metavar="SECONDS",
+                     help="Give up on Redis operations, and on waiting "
+                          "for a free connection, after SECONDS "
+                          "(default: wait forever)")
+  gen_p.add_argument("--redis_keepalive", type=int, default=60,
+                     metavar="SECONDS",
+                     help="Send TCP keepalives on connections idle for "
+                          "SECONDS, so a dead server is noticed. 0 turns "
+                          "them off (default: 60)")
+  gen_p.add_argument("--redis_shard", action="append", default=[],
+                     metavar="HOST:PORT:DB",
+                     help="Spread links over this Redis instance as well "
+                          "as the one given by --redis. Can be repeated; "
+                          "every command run on the database must be "
+                          "given the same ones")
+  gen_p.add_argument("--backend", choices=("redis", "memory"),
+                     default="redis",
+                     help="Where to keep the database. 'memory' keeps it "
+                          "inside this process instead of on a Redis "
+                          "server (default: redis)")
+  gen_p.add_argument("--snapshot", metavar="FILE",
+                     help="With '--backend memory', load the database "
+                          "from FILE if it exists and save it back there "
+                          "when the command finishes")
+  gen_p.add_argument("--metrics_port", type=int, metavar="PORT",
+                     help="Serve counts of the work done so far, in the "
+                          "Prometheus text format, at "
+                          "http://127.0.0.1:PORT/metrics while the "
+                          "command runs")
+  gen_p.add_argument("--metrics_json", metavar="FILE",
+                     help="Write the same counts to FILE as JSON when "
+                          "the command finishes")
 
   parents.append(gen_p)
 
@@ -1,6 +1,373 @@
+import os
+import bisect
+import socket
+import hashlib
+import itertools
+
 import redis
 
 import inettopology.util.decorators
+import inettopology.util.structures as structures
+import inettopology_popmap.memstore as memstore
+
+# Settings for the connection pools of new clients, set from the
+# command line by open_backend.
+pool_options = {'max_connections': 50,
+                'timeout': None,
+                'keepalive': 60}
+
+
+class ForkSafePool(redis.BlockingConnectionPool):
+  """ A connection pool which can be used on both sides of a fork.
+
+  redis-py notices when a pool is used in a child process, but
+  deals with it by disconnecting the inherited connections, which
+  shuts their sockets down for the parent as well. This pool just
+  drops them and opens new ones. Once :max_connections: are in use,
+  callers wait up to :timeout: seconds for one to be released.
+  """
+
+  def reset(self):
+    self._made = []
+    super(ForkSafePool, self).reset()
+
+  def make_connection(self):
+    connection = super(ForkSafePool, self).make_connection()
+    self._made.append(connection)
+    return connection
+
+  def _checkpid(self):
+    if self.pid != os.getpid():
+      for connection in self._made:
+        connection._sock = None  # Closed when collected, not shut down
+      self.reset()
+
+
+class PooledRedis(redis.StrictRedis):
+  """ A StrictRedis whose pipelines only wrap their commands in
+  MULTI/EXEC if asked to, with transaction=True or by calling
+  multi() after watch().
+  """
+
+  def pipeline(self, transaction=False, shard_hint=None):
+    return super(PooledRedis, self).pipeline(transaction, shard_hint)
+
+
+def pooled(client):
+  """ Return a PooledRedis for the same server as the StrictRedis
+  :client:, using a ForkSafePool set up from pool_options.
+  """
+  pool = client.connection_pool
+  kwargs = dict(pool.connection_kwargs)
+  if pool_options['timeout'] is not None:
+    kwargs['socket_timeout'] = pool_options['timeout']
+    kwargs['socket_connect_timeout'] = pool_options['timeout']
+  if pool_options['keepalive'] and pool.connection_class is redis.Connection:
+    kwargs['socket_keepalive'] = True
+    kwargs['socket_keepalive_options'] = _keepalive_options(
+        pool_options['keepalive'])
+
+  return PooledRedis(connection_pool=ForkSafePool(
+      connection_class=pool.connection_class,
+      max_connections=pool_options['max_connections'],
+      timeout=pool_options['timeout'],
+      **kwargs))
+
+
+def _keepalive_options(idle):
+  """ TCP keepalive settings which notice a dead server about
+  :idle: seconds after it was last heard from, where the platform
+  allows them to be set.
+  """
+  options = dict()
+  for name, value in (('TCP_KEEPIDLE', idle),
+                      ('TCP_KEEPINTVL', max(1, idle / 6)),
+                      ('TCP_KEEPCNT', 3)):
+    if hasattr(socket, name):
+      options[getattr(socket, name)] = value
+  return options
+
+
+def hash_tag(key):
+  """ Return the hash tag of :key:, the text inside the first
+  '{...}' as in Redis Cluster, or None if it hasn't got one.
+  """
+  start = key.find('{')
+  if start != -1:
+    end = key.find('}', start + 1)
+    if end > start + 1:
+      return key[start + 1:end]
+  return None
+
+
+def _ring_hash(name):
+  return int(hashlib.md5(name).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+  """ Consistent hashing of names onto the indexes of :nodes:,
+  each of which is placed at :replicas: points around the ring.
+  Adding a node only moves the names which land next to its points.
+  """
+
+  def __init__(self, nodes, replicas=160):
+    points = sorted((_ring_hash("%s-%d" % (node, i)), index)
+                    for index, node in enumerate(nodes)
+                    for i in xrange(replicas))
+    self._hashes = [point for point, index in points]
+    self._nodes = [index for point, index in points]
+
+  def lookup(self, name):
+    i = bisect.bisect(self._hashes, _ring_hash(name))
+    return self._nodes[i % len(self._nodes)]
+
+
+# Commands with more than one key, and how to find them in the
+# arguments. Everything else has its key first, or none at all.
+_KEYS_FIRST = {'rename': 2, 'renamenx': 2, 'rpoplpush': 2, 'smove': 2,
+               'brpoplpush': 2}
+_STORE_COMMANDS = ('sunionstore', 'sinterstore', 'sdiffstore',
+                   'zunionstore', 'zinterstore')
+
+
+def _command_keys(name, args):
+  if name in ('eval', 'evalsha'):
+    return args[2:2 + int(args[1])]
+  if name in _STORE_COMMANDS:
+    keys = args[1] if isinstance(args[1], (list, tuple)) else args[1:]
+    return [args[0]] + list(keys)
+  if name in ('delete', 'watch', 'mget', 'sunion', 'sinter', 'sdiff'):
+    if len(args) == 1 and isinstance(args[0], (list, tuple)):
+      return list(args[0])
+    return list(args)
+  return args[:_KEYS_FIRST.get(name, 1)]
+
+
+class ShardedRedis(object):
+  """ Spreads a database over several Redis instances, given as
+  the clients :shards: with matching :names: (host:port:db).
+
+  Keys with a hash tag (see hash_tag) live on the shard their tag
+  maps to on a HashRing; all other keys live on the first, home,
+  shard. Commands, pipelined transactions and scripts which touch
+  several keys need them all on one shard, and raise a ResponseError
+  otherwise, as Redis Cluster would. KEYS, SCAN and DELETE span
+  every shard.
+  """
+
+  def __init__(self, shards, names):
+    self.shards = shards
+    self.names = names
+    self.home = shards[0]
+    self._ring = HashRing(names)
+    self._tagged = dict()
+
+  def shard_index(self, key):
+    tag = hash_tag(key)
+    if tag is None:
+      return 0
+    try:
+      return self._tagged[tag]
+    except KeyError:
+      index = self._tagged[tag] = self._ring.lookup(tag)
+      return index
+
+  def route(self, keys):
+    """ Return the index of the shard holding all of :keys: """
+    indexes = set(self.shard_index(key) for key in keys)
+    if len(indexes) > 1:
+      raise redis.ResponseError(
+          "CROSSSLOT Keys in request don't hash to the same shard: "
+          "{0}".format(", ".join(keys)))
+    return indexes.pop() if indexes else 0
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+
+    def command(*args, **kwargs):
+      shard = self.shards[self.route(_command_keys(name, args))]
+      return getattr(shard, name)(*args, **kwargs)
+    command.__name__ = name
+    return command
+
+  def _by_shard(self, keys):
+    groups = dict()
+    for key in keys:
+      groups.setdefault(self.shard_index(key), []).append(key)
+    return groups
+
+  def delete(self, *names):
+    return sum(self.shards[index].delete(*keys) for index, keys
+               in self._by_shard(_command_keys('delete', names)).iteritems())
+
+  def keys(self, pattern='*'):
+    return list(itertools.chain.from_iterable(
+        shard.keys(pattern) for shard in self.shards))
+
+  def scan_iter(self, match=None, count=None):
+    return itertools.chain.from_iterable(
+        shard.scan_iter(match=match, count=count) for shard in self.shards)
+
+  def ping(self):
+    return all(shard.ping() for shard in self.shards)
+
+  def flushdb(self):
+    return all(shard.flushdb() for shard in self.shards)
+
+  def script_load(self, script):
+    return [shard.script_load(script) for shard in self.shards][0]
+
+  def register_script(self, script):
+    return ShardedScript(self, script)
+
+  def pipeline(self, transaction=False, shard_hint=None):
+    return ShardedPipeline(self, transaction)
+
+
+class ShardedScript(object):
+  """ A Lua script registered on every shard of :client:. Each
+  call runs on the shard holding its keys.
+  """
+
+  def __init__(self, client, script):
+    self.client = client
+    self.script = script
+    self._scripts = [shard.register_script(script)
+                     for shard in client.shards]
+
+  def __call__(self, keys=[], args=[], client=None):
+    index = self.client.route(keys)
+    if client is None:
+      return self._scripts[index](keys=keys, args=args)
+    return client.run_script(index, self._scripts[index], keys, args)
+
+
+class ShardedPipeline(object):
+  """ A pipeline for a ShardedRedis. Commands are queued on a
+  pipeline for their shard and their replies put back in order
+  by execute().
+
+  A transaction (a pipeline made with :transaction: True, or one
+  which has called watch()) is only atomic within one shard, so every
+  command in it must be for the same shard.
+  """
+
+  def __init__(self, client, transaction=False):
+    self.client = client
+    self._transaction = transaction
+    self.reset()
+
+  def reset(self):
+    for pipe in getattr(self, '_pipes', {}).itervalues():
+      pipe.reset()
+    self._pipes = dict()
+    self._order = []
+    self._pinned = None
+    self.transaction = self._transaction
+    self.watching = False
+    self.explicit_transaction = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.reset()
+
+  def __len__(self):
+    return len(self._order)
+
+  def _pipe(self, index):
+    if self.transaction or self.watching:
+      if self._pinned is not None and self._pinned != index:
+        raise redis.ResponseError(
+            "CROSSSLOT A transaction can only touch one shard")
+      self._pinned = index
+    try:
+      return self._pipes[index]
+    except KeyError:
+      pipe = self._pipes[index] = self.client.shards[index].pipeline(
+          transaction=self.transaction)
+      return pipe
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+
+    def command(*args, **kwargs):
+      index = self.client.route(_command_keys(name, args))
+      result = getattr(self._pipe(index), name)(*args, **kwargs)
+      if self.watching and not self.explicit_transaction:
+        return result
+      self._order.append(index)
+      return self
+    command.__name__ = name
+    return command
+
+  def watch(self, *names):
+    self.watching = True
+    index = self.client.route(_command_keys('watch', names))
+    return self._pipe(index).watch(*names)
+
+  def unwatch(self):
+    for pipe in self._pipes.itervalues():
+      pipe.unwatch()
+    self.watching = False
+
+  def multi(self):
+    self.explicit_transaction = True
+    self.transaction = True
+    if self._pinned is not None:
+      self._pipes[self._pinned].multi()
+
+  def run_script(self, index, script, keys, args):
+    result = script(keys=keys, args=args, client=self._pipe(index))
+    if self.watching and not self.explicit_transaction:
+      return result
+    self._order.append(index)
+    return self
+
+  def execute(self, raise_on_error=True):
+    order = self._order
+    try:
+      replies = dict((index, iter(pipe.execute(raise_on_error=False)))
+                     for index, pipe in self._pipes.iteritems())
+    finally:
+      self.reset()
+
+    response = [next(replies[index]) for index in order]
+    if raise_on_error:
+      for reply in response:
+        if isinstance(reply, redis.ResponseError):
+          raise reply
+    return response
+
+
+class ShardedInfo(object):
+  """ Stands in for a ConnectionInfo, connecting to the Redis
+  instance :home: ({'host':, 'port':, 'db':}) and the extra
+  :shards: given as 'host:port:db' strings.
+  """
+
+  def __init__(self, home, shards):
+    self.home = home
+    self.shards = shards
+
+  def instantiate(self):
+    infos = [self.home]
+    for shard in self.shards:
+      host, port, db = shard.split(':')
+      infos.append({'host': host, 'port': int(port), 'db': int(db)})
+    return ShardedRedis(
+        [pooled(redis.StrictRedis(**info)) for info in infos],
+        ["{host}:{port}:{db}".format(**info) for info in infos])
+
+
+def sharded(r):
+  """ Return True if :r: spreads the database over several
+  Redis instances.
+  """
+  return isinstance(r, ShardedRedis)
 
 
 @inettopology.util.decorators.singleton
@@ -9,12 +376,61 @@ class Redis:
 
   def __init__(self, *redisinfo, **conninfo):
     try:
-      self._instance = redisinfo[0].instantiate()
+      client = redisinfo[0].instantiate()
     except (AttributeError, IndexError):
-      self._instance = redis.StrictRedis(**conninfo)
+      client = redis.StrictRedis(**conninfo)
+    if isinstance(client, redis.StrictRedis):
+      client = pooled(client)
+    self._instance = client
 
   def __call__(self, **kwargs):
     try:
       return self._instance
     except AttributeError:
       return Redis(**kwargs)
+
+
+class MemoryInfo(object):
+  """ Stands in for a ConnectionInfo, creating an in-process
+  store (see memstore) loaded from :snapshot: instead of a
+  connection to a Redis server.
+  """
+
+  def __init__(self, snapshot=None):
+    self.snapshot = snapshot
+
+  def instantiate(self):
+    return memstore.MemoryRedis(self.snapshot)
+
+
+def open_backend(args):
+  """ Set up the storage backend chosen by :args:, so that it's
+  the connection every command gets from Redis(). With the memory
+  backend that's so whatever Redis server a command asks for.
+
+  :returns: a function to call once the command is done, which
+  saves the memory store to its snapshot
+  """
+  if getattr(args, 'backend', 'redis') != 'memory':
+    for option, name in (('max_connections', 'redis_pool_size'),
+                         ('timeout', 'redis_timeout'),
+                         ('keepalive', 'redis_keepalive')):
+      if getattr(args, name, None) is not None:
+        pool_options[option] = getattr(args, name)
+    if getattr(args, 'redis_shard', None):
+      Redis(ShardedInfo(args.redis, args.redis_shard))
+    elif getattr(args, 'redis', None) is not None:
+      Redis(structures.ConnectionInfo(**args.redis))
+    return lambda: None
+
+  store = Redis(MemoryInfo(args.snapshot))
+  if args.snapshot is None:
+    return lambda: None
+  return store.save
+
+
+def in_process(r):
+  """ Return True if :r: is an in-process store, which forked
+  processes can't share.
+  """
+  return isinstance(r, memstore.MemoryRedis)
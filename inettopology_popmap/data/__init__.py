@@ -12,24 +12,46 @@ internet topology.
 *** obviously an issue.
 
 Note: The trace route files are expected in the form output by the
-sc_warts2text command contained in the scamper package (not included).
+sc_warts2text command contained in the scamper package (not included),
+or, with '--format warts', as the binary warts files scamper writes.
+They may be gzip, bzip2 or xz compressed, and a trace file of '-'
+reads from stdin, so sc_warts2text output can be piped straight in.
 
 Order of Commands
 -----------------
-1. parse         -  This can be parallelized (i.e. you
-                    can many of these processes at once).
+1. parse         -  This can be parallelized, either by
+                    using the '--workers' flag (which will
+                    split large files into shards), or by
+                    running many of these processes at once.
+
+                    With '--offline DIR', links are written
+                    to a link store in DIR instead of Redis,
+                    so parsing can run on machines without
+                    Redis access. Load the stores with
+                    'bulkload' before running assign_pops.
 
 2. assign_pops   -  This can also be parallelized, with
-                    one caveat. If several are run
-                    simultaneously, this command must be
-                    run again (only one instance), with
-                    the '--process_failed' flag.
+                    the '--workers' flag or by running
+                    several at once. Links which fail to
+                    be assigned because of Redis errors are
+                    retried once the rest are done, and in
+                    the end by the process itself, which
+                    exits with an error if any are left.
+                    Those, and any left by older versions,
+                    are assigned by running it again (only
+                    one instance) with '--process_failed'.
 
                     If for any reason you need to reprocess
                     all of the pop assignments, use the
                     '--reset' flag.
 
 3. process_joins  - (no extra notes)
+
+Instead of 2 and 3, 'cluster' reads every link
+into memory and assigns them all to their final PoPs
+in one pass, leaving no joins to process. It needs
+enough memory to hold the links and IPs, and a
+database without PoPs.
 """
 import argparse
 
@@ -50,25 +72,177 @@ def __argparse__(subparser, parents):
                                 parents=parents)
   subparsers = parser.add_subparsers()
 
+  # Options for the commands which read traces
+  trace_p = argparse.ArgumentParser(add_help=False)
+  trace_p.add_argument("trace",
+                       nargs="+",
+                       help="CAIDA trace files. Globs are expanded, "
+                            "and '-' reads from stdin.",
+                       metavar="<trace file>")
+
+  trace_p.add_argument("--format",
+                       choices=("text", "warts"), default="text",
+                       help="Trace file format: sc_warts2text output, "
+                            "or binary scamper warts files. Warts "
+                            "files aren't sharded. (default: text)")
+
+  trace_p.add_argument("--workers",
+                       type=int, default=1,
+                       help="Number of parse processes to run "
+                            "(default: 1)")
+
+  trace_p.add_argument("--shard_size",
+                       type=int, default=256, metavar="MB",
+                       help="Split trace files into shards of about "
+                            "this many megabytes so they can be parsed "
+                            "in parallel (default: 256)")
+
+  trace_p.add_argument("--geoip_cache_mb",
+                       type=int, default=16, metavar="MB",
+                       help="Size of the GeoIP lookup cache shared by "
+                            "all workers (default: 16)")
+
+  trace_p.add_argument("--geoip_cache",
+                       metavar="FILE",
+                       help="Keep the GeoIP lookup cache in FILE, so "
+                            "separately started parse processes "
+                            "share it and it persists across runs")
+
   # {parse} command
   parser_parse = subparsers.add_parser("parse",
                                        help="Parse Trace Routes. "
                                             "Perform ASN lookups for "
                                             "IPs as we go.",
-                                       parents=parents)
+                                       parents=parents + [trace_p])
 
   #parser_parse.add_argument("--geoipdb",
                             #help='MaxMind GeoIP Database to use'
                                  #'for ASN lookups.',
                             #required=True)
 
-  parser_parse.add_argument("trace",
-                            help="CAIDA trace file",
-                            metavar="<trace file>")
+  parser_parse.add_argument("--batch_size",
+                            type=int, default=1000, metavar="LINKS",
+                            help="Write links to Redis in batches of this "
+                                 "many links (default: 1000)")
+
+  parser_parse.add_argument("--batch_timeout",
+                            type=float, default=1.0, metavar="SECONDS",
+                            help="Write a partial batch once it is this "
+                                 "old (default: 1.0)")
+
+  parser_parse.add_argument("--write_pipelines",
+                            type=int, default=1, metavar="N",
+                            help="Batches each worker may have on their "
+                                 "way to Redis at once. Raising this hides "
+                                 "the round trip to a distant server "
+                                 "(default: 1)")
+
+  parser_parse.add_argument("--seen_ip_mb",
+                            type=int, default=64, metavar="MB",
+                            help="Memory each worker may use to remember "
+                                 "IPs whose ASN has already been written, "
+                                 "so it isn't written again. 0 disables. "
+                                 "(default: 64)")
+
+  parser_parse.add_argument("--offline",
+                            metavar="DIR",
+                            help="Write parsed links to a link store in DIR "
+                                 "instead of to Redis. Load it later with "
+                                 "'process bulkload'")
+
+  parser_parse.add_argument("--resume",
+                            action="store_true",
+                            help="Continue each trace file from the last "
+                                 "checkpoint saved by an earlier run, "
+                                 "skipping files that were finished. With "
+                                 "--offline, skips files which already "
+                                 "have a segment")
+
+  parser_parse.add_argument("--force",
+                            action="store_true",
+                            help="Parse files again from the start even "
+                                 "if they were parsed into the database "
+                                 "before, counting their link delays a "
+                                 "second time")
+
+  parser_parse.add_argument("--checkpoint_interval",
+                            type=float, default=30.0, metavar="SECONDS",
+                            help="Save parse progress to Redis at most "
+                                 "this often (default: 30)")
+
+  parser_parse.add_argument("--ip_layout",
+                            choices=("hash", "compact"),
+                            help="How to store per-IP records in a new "
+                                 "database. 'compact' groups them into "
+                                 "small hashes, using much less memory "
+                                 "(default: hash)")
   parser_parse.set_defaults(
       func=lazy_load('data.process', 'parse'),
       dump=False)
 
+  parser_dump_ips = subparsers.add_parser(
+      "dump_ips",
+      help="Write the sorted list of unique IPs seen in traces",
+      parents=parents + [trace_p])
+
+  parser_dump_ips.add_argument("-o", "--output",
+                               default="-", metavar="FILE",
+                               help="Write the IPs to FILE (default: stdout)")
+
+  parser_dump_ips.add_argument("--resolved",
+                               metavar="FILE",
+                               help="Also write each IP with its ASN and "
+                                    "country to FILE, tab separated")
+
+  parser_dump_ips.add_argument("--run_size",
+                               type=int, default=1000000, metavar="IPS",
+                               help="IPs each worker collects in memory "
+                                    "before sorting them out to a file on "
+                                    "disk (default: 1000000)")
+
+  parser_dump_ips.add_argument("--merge_width",
+                               type=int, default=64, metavar="FILES",
+                               help="Most sorted files to merge at once "
+                                    "(default: 64)")
+
+  parser_dump_ips.add_argument("--tmpdir",
+                               metavar="DIR",
+                               help="Directory for the sorted files "
+                                    "(default: the system temp directory)")
+  parser_dump_ips.set_defaults(
+      func=lazy_load('data.process', 'parse'),
+      dump=True, offline=None, resume=False)
+
+  parser_bulkload = subparsers.add_parser(
+      "bulkload",
+      help="Load link stores written by 'parse --offline'",
+      parents=parents)
+
+  parser_bulkload.add_argument("store",
+                               nargs="+",
+                               help="Link store directories or segment files",
+                               metavar="<link store>")
+
+  parser_bulkload.add_argument("--window",
+                               type=int, default=16, metavar="BATCHES",
+                               help="Number of batches to send to Redis "
+                                    "before waiting for replies (default: 16)")
+
+  parser_bulkload.add_argument("--ip_layout",
+                               choices=("hash", "compact"),
+                               help="How to store per-IP records in a new "
+                                    "database (default: hash)")
+  parser_bulkload.set_defaults(
+      func=lazy_load('data.process', 'bulkload'))
+
+  parser_convert_delays = subparsers.add_parser(
+      "convert_delays",
+      help="Convert link delays stored as sets by older versions "
+           "into histograms",
+      parents=parents)
+  parser_convert_delays.set_defaults(
+      func=lazy_load('data.process', 'convert_delays'))
+
   parser_process_joins = subparsers.add_parser("process_joins",
                                                help="Process queued PoP joins",
                                                parents=parents)
@@ -89,9 +263,32 @@ def __argparse__(subparser, parents):
       action="store_true",
       help="Process any links that were skipped in the initial run.")
 
+  parser_assign_pops.add_argument(
+      "--batch_size", type=int, default=500, metavar="N",
+      help="Claim N links from the queue at a time and assign them "
+           "together (default: 500)")
+
+  parser_assign_pops.add_argument(
+      "--workers", type=int, default=1,
+      help="Number of assigning processes to run (default: 1)")
+
+  parser_assign_pops.add_argument(
+      "--asn_cache_mb", type=int, default=64, metavar="MB",
+      help="Memory each process may use to remember the ASNs of IPs "
+           "it has seen, so they're read from Redis only once. "
+           "0 disables. (default: 64)")
+
   parser_assign_pops.set_defaults(
       func=lazy_load('data.process', 'assign_pops'))
 
+  parser_cluster = subparsers.add_parser(
+      "cluster",
+      help="Assign pops to the loaded links in one pass, "
+           "without joins",
+      parents=parents)
+  parser_cluster.set_defaults(
+      func=lazy_load('data.process', 'cluster_pops'))
+
   parser_cleanup = subparsers.add_parser(
       "cleanup",
       help="Remove all PoP related info from "
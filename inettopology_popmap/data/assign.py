@@ -0,0 +1,473 @@
+"""
+Assigning PoPs to links a batch at a time, for 'process assign_pops'.
+
+A BatchAssigner claims links from the front of a queue BATCH_LINKS at
+a time with one script call, and reads the delays of all of them in
+one pipeline. It then assigns them GROUP_LINKS at a time with one
+call of ASSIGN_LINKS_LUA, which makes every decision for the group
+inside Redis: reading the ASN and PoP of each IP, numbering new PoPs,
+recording their members and storing the links between and within
+them, and queueing PoPs to be joined. A script runs atomically, so
+any number of assigners can work through the queues at once without
+ever having to put a link aside because of another.
+
+Assigners look the ASNs of IPs up in Redis only the first time they
+come across them, keeping them in a bounded cache (an ASN never
+changes once a link has been parsed). The ASNs of IPs in a batch
+which aren't cached are read in the pipeline which reads its delays.
+Links whose IPs don't both have an ASN are skipped there and then,
+and the script is handed the ASNs rather than reading them again.
+PoPs aren't cached: they change as links are assigned, so only the
+script, which reads them at the moment it uses them, can know them.
+
+An assigner given a queue of failed links moves the links of any
+group it couldn't assign because of a Redis error there, and backs
+off for a while before carrying on, so that they can be retried
+once the whole queue has been worked through.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import redis
+
+from inettopology.util.general import Color
+import inettopology_popmap.memstore as memstore
+import inettopology_popmap.metrics as metrics
+import inettopology_popmap.data.dbkeys as dbkeys
+import inettopology_popmap.data.delays as delays
+import inettopology_popmap.data.preprocess as preprocess
+from inettopology_popmap.data.parsers import different_24
+
+BATCH_LINKS = 500
+GROUP_LINKS = 100
+
+# Links with a median delay above this (in ms) join different PoPs
+MAX_SAME_POP_DELAY = 2.5
+# Medians read back from a histogram stand for their whole bucket, so
+# those from the bucket holding MAX_SAME_POP_DELAY count as within it
+_SAME_POP_LIMIT = delays.bucket_top(MAX_SAME_POP_DELAY)
+
+# Errors after which a group of links is put aside to be retried
+RETRY_ERRORS = (redis.ConnectionError,
+                redis.InvalidResponse,
+                redis.ResponseError)
+# Seconds to wait after the first failure in a row, doubling with
+# each one after it up to MAX_BACKOFF. Once more than MAX_FAILURES
+# groups in a row have failed, the error is raised.
+BACKOFF = 0.5
+MAX_BACKOFF = 10.0
+MAX_FAILURES = 6
+
+# A rough estimate of what an IP costs in an ASN cache, counting its
+# address and the dict slot; the ASNs themselves are shared
+ASN_ENTRY_BYTES = 120
+
+LINKS_ASSIGNED = dict(
+    (result, metrics.Counter('popmap_links_assigned_total',
+                             'Links taken off the unassigned queues',
+                             labels={'result': result}))
+    for result in ('assigned', 'no_asn', 'failed'))
+GROUP_ASSIGN_SECONDS = metrics.Histogram(
+    'popmap_group_assign_seconds',
+    'Time taken to assign PoPs to a group of links')
+ASN_CACHE_LOOKUPS = dict(
+    (result, metrics.Counter('popmap_asn_cache_lookups_total',
+                             'IP ASNs looked up in assigners\' caches',
+                             labels={'result': result}))
+    for result in ('hit', 'miss'))
+UNASSIGNED_LINKS = metrics.Gauge(
+    'popmap_unassigned_links', 'Links left on the queue being assigned')
+
+# Move up to ARGV[1] links from the end of the queue KEYS[1] to the
+# front of KEYS[2], as RPOPLPUSH would, or just pop them if there's
+# no KEYS[2]. Returns the links moved.
+CLAIM_LINKS_LUA = """
+  local links = {}
+  for i = 1, tonumber(ARGV[1]) do
+    local link
+    if #KEYS > 1 then
+      link = redis.call("RPOPLPUSH", KEYS[1], KEYS[2])
+    else
+      link = redis.call("RPOP", KEYS[1])
+    end
+    if not link then
+      break
+    end
+    links[i] = link
+  end
+  return links
+"""
+
+
+@memstore.native_script(CLAIM_LINKS_LUA)
+def _claim_links_native(r, keys, args):
+  links = []
+  for i in xrange(int(args[0])):
+    if len(keys) > 1:
+      link = r.rpoplpush(keys[0], keys[1])
+    else:
+      link = r.rpop(keys[0])
+    if link is None:
+      break
+    links.append(link)
+  return links
+
+
+# Assign PoPs to a group of links, in order.
+#
+# KEYS are the ASSIGN_KEYS, which the script may write for any link:
+# the PoP counter and list, the list of interlink keys, and the queue
+# and set of PoP joins. The records (see dbkeys.ip_key) of the two IPs
+# of each link follow in turn. ARGV[1] is the number of links,
+# followed by ASSIGN_ARGS arguments for each: its two IPs, the ASN of
+# each, the 'pop' field of each IP's record (see dbkeys.ip_field), the
+# country code of each IP, and "1" if the link joins different PoPs
+# or "0". Links whose IPs don't both have an ASN mustn't be passed.
+#
+# The keys of each PoP, ASN and link the script writes (see
+# dbkeys.POP, ASN and Link, whose names it repeats) can't be in KEYS,
+# as they're named after PoPs the script reads from the records or
+# numbers itself. Like every key in KEYS they have no hash tag, so
+# they live on the first instance of a sharded database, which is
+# where the script runs.
+#
+# Returns the number of links assigned.
+ASSIGN_KEYS = (dbkeys.POP.counter(), dbkeys.POP.list(),
+               dbkeys.Link.interlink_keys(), 'delayed_job:popjoins',
+               'delayed_job:popjoins:known')
+ASSIGN_ARGS = 9
+ASSIGN_LINKS_LUA = """
+  local popincr, poplist, interlink_keys, popjoins, known_joins =
+      unpack(KEYS, 1, %(keys)d)
+
+  local function pair(a, b)
+    return "('" .. a .. "', '" .. b .. "')"
+  end
+
+  local function new_pop(key, field, ip, asn, cc)
+    local pop = tostring(redis.call("INCR", popincr))
+    redis.call("SADD", poplist, pop)
+    redis.call("SADD", "pop:" .. pop .. ":members", ip)
+    redis.call("HSET", key, field, pop)
+    redis.call("SADD", "pop:" .. pop .. ":cc", cc)
+    redis.call("SET", "pop:" .. pop .. ":asn", asn)
+    redis.call("SADD", "asn:" .. asn .. ":pops", pop)
+    return pop
+  end
+
+  local function join_pop(key, field, ip, pop)
+    redis.call("HSET", key, field, pop)
+    redis.call("SADD", "pop:" .. pop .. ":members", ip)
+  end
+
+  local function store_link(ip1, ip2, pop1, pop2)
+    if pop2 and pop1 ~= pop2 then
+      local interlink = "links:inter:" .. pop2 .. ":" .. pop1
+      if tonumber(pop1) < tonumber(pop2) then
+        interlink = "links:inter:" .. pop1 .. ":" .. pop2
+      end
+      redis.call("SADD", "pop:" .. pop1 .. ":connected", pop2)
+      redis.call("SADD", "pop:" .. pop2 .. ":connected", pop1)
+      local known = redis.call("EXISTS", interlink)
+      redis.call("SADD", interlink, pair(ip1, ip2))
+      if known == 0 then
+        redis.call("LPUSH", interlink_keys, interlink)
+      end
+    else
+      redis.call("SADD", "links:intra:" .. pop1, pair(ip1, ip2))
+    end
+  end
+
+  local n = tonumber(ARGV[1])
+  for i = 0, n - 1 do
+    local key1 = KEYS[%(keys)d + 2 * i + 1]
+    local key2 = KEYS[%(keys)d + 2 * i + 2]
+    local first = %(args)d * i + 2
+    local ip1, ip2, asn1, asn2, pop_field1, pop_field2,
+          cc1, cc2, far = unpack(ARGV, first, first + %(args)d - 1)
+    local pop1 = redis.call("HGET", key1, pop_field1)
+    local pop2 = redis.call("HGET", key2, pop_field2)
+
+    if far == "1" then
+      if not pop1 then
+        pop1 = new_pop(key1, pop_field1, ip1, asn1, cc1)
+      end
+      if not pop2 then
+        pop2 = new_pop(key2, pop_field2, ip2, asn2, cc2)
+      end
+      store_link(ip1, ip2, pop1, pop2)
+    elseif not pop1 and not pop2 then
+      pop1 = new_pop(key1, pop_field1, ip1, asn1, cc1)
+      join_pop(key2, pop_field2, ip2, pop1)
+      store_link(ip1, ip2, pop1, false)
+    elseif pop1 and pop2 then
+      local join = pair(pop1, pop2)
+      if redis.call("SADD", known_joins, join) == 1 then
+        redis.call("LPUSH", popjoins, join)
+      end
+    elseif pop1 then
+      join_pop(key2, pop_field2, ip2, pop1)
+      store_link(ip1, ip2, pop1, false)
+    else
+      join_pop(key1, pop_field1, ip1, pop2)
+      store_link(ip1, ip2, pop2, false)
+    end
+  end
+  return n
+""" % {'keys': len(ASSIGN_KEYS), 'args': ASSIGN_ARGS}
+
+
+@memstore.native_script(ASSIGN_LINKS_LUA)
+def _assign_links_native(r, keys, args):
+  fixed, records = keys[:len(ASSIGN_KEYS)], keys[len(ASSIGN_KEYS):]
+  popincr, poplist, interlink_keys, popjoins, known_joins = fixed
+
+  def new_pop(key, field, ip, asn, cc):
+    pop = str(r.incr(popincr))
+    r.sadd(poplist, pop)
+    r.sadd(dbkeys.POP.members(pop), ip)
+    r.hset(key, field, pop)
+    r.sadd(dbkeys.POP.countries(pop), cc)
+    r.set(dbkeys.POP.asn(pop), asn)
+    r.sadd(dbkeys.ASN.pops(asn), pop)
+    return pop
+
+  def join_pop(key, field, ip, pop):
+    r.hset(key, field, pop)
+    r.sadd(dbkeys.POP.members(pop), ip)
+
+  def store_link(ip1, ip2, pop1, pop2):
+    if pop2 is not None and pop1 != pop2:
+      interlink = dbkeys.Link.interlink(pop1, pop2)
+      r.sadd(dbkeys.POP.neighbors(pop1), pop2)
+      r.sadd(dbkeys.POP.neighbors(pop2), pop1)
+      known = r.exists(interlink)
+      r.sadd(interlink, (ip1, ip2))
+      if not known:
+        r.lpush(interlink_keys, interlink)
+    else:
+      r.sadd(dbkeys.Link.intralink(pop1), (ip1, ip2))
+
+  n = int(args[0])
+  for i in xrange(n):
+    key1, key2 = records[2 * i:2 * i + 2]
+    (ip1, ip2, asn1, asn2, pop_field1, pop_field2,
+     cc1, cc2, far) = args[ASSIGN_ARGS * i + 1:ASSIGN_ARGS * (i + 1) + 1]
+    pop1 = r.hget(key1, pop_field1)
+    pop2 = r.hget(key2, pop_field2)
+
+    if str(far) == "1":
+      if pop1 is None:
+        pop1 = new_pop(key1, pop_field1, ip1, asn1, cc1)
+      if pop2 is None:
+        pop2 = new_pop(key2, pop_field2, ip2, asn2, cc2)
+      store_link(ip1, ip2, pop1, pop2)
+    elif pop1 is None and pop2 is None:
+      pop1 = new_pop(key1, pop_field1, ip1, asn1, cc1)
+      join_pop(key2, pop_field2, ip2, pop1)
+      store_link(ip1, ip2, pop1, None)
+    elif pop1 is not None and pop2 is not None:
+      join = (pop1, pop2)
+      if r.sadd(known_joins, join):
+        r.lpush(popjoins, join)
+    elif pop1 is not None:
+      join_pop(key2, pop_field2, ip2, pop1)
+      store_link(ip1, ip2, pop1, None)
+    else:
+      join_pop(key1, pop_field1, ip1, pop2)
+      store_link(ip1, ip2, pop2, None)
+  return n
+
+
+def far_link(delay, ip1, ip2):
+  """ Return True if the link between :ip1: and :ip2:, with a median
+  delay of :delay: (read back from its histogram), joins two
+  different PoPs whatever their ASNs.
+  """
+  return delay > _SAME_POP_LIMIT or different_24(ip1, ip2)
+
+
+def assign_links_call(links, medians, asns, aslookup):
+  """ Return the (keys, args) for the ASSIGN_LINKS_LUA call which
+  assigns PoPs to :links:, whose median delays are :medians: and
+  whose IPs have the ASNs :asns: (a dict), looking up country codes
+  in :aslookup:.
+  """
+  ips = [ip for link in links for ip in dbkeys.link_ips(link)]
+  ccs = aslookup.lookup_country_codes(ips)
+  args = [len(links)]
+  for i, delay in enumerate(medians):
+    ip1, ip2 = ips[2 * i:2 * i + 2]
+    asn1, asn2 = asns[ip1], asns[ip2]
+    far = asn1 != asn2 or far_link(delay, ip1, ip2)
+    args.extend([ip1, ip2, asn1, asn2,
+                 dbkeys.ip_field(ip1, 'pop'), dbkeys.ip_field(ip2, 'pop'),
+                 ccs[2 * i], ccs[2 * i + 1],
+                 1 if far else 0])
+  return list(ASSIGN_KEYS) + map(dbkeys.ip_key, ips), args
+
+
+class BatchAssigner(object):
+  """ Assigns PoPs to the links on the queue :unassigned:, claiming
+  :batch_size: at a time. Claimed links are moved to :processed:,
+  or dropped from the queue if that's None. Links which fail to be
+  assigned are moved to the queue :failed:; without one, the error
+  is raised.
+
+  :asn_cache: is a cache.BoundedCache of the ASNs of IPs, which may
+  be shared with other assigners. Without one, the ASN of every IP
+  is read for each batch it's in.
+  """
+
+  def __init__(self, r, unassigned, processed=None, batch_size=BATCH_LINKS,
+               failed=None, asn_cache=None):
+    self.r = r
+    self.unassigned = unassigned
+    self.processed = processed
+    self.failed = failed
+    self.batch_size = batch_size
+    self.asn_cache = asn_cache
+    self.aslookup = preprocess.MaxMindGeoIPReader.Instance()
+    self._claim = r.register_script(CLAIM_LINKS_LUA)
+    self._assign = r.register_script(ASSIGN_LINKS_LUA)
+
+    self.assigned = 0
+    self.no_asn = 0
+    self.failures = 0
+    self._failures_in_row = 0
+    self.asn_hits = 0
+    self.asn_misses = 0
+
+  def run(self):
+    """ Assign links until the queue is empty
+
+    :returns: dict of statistics
+    """
+    while True:
+      links = self.claim()
+      if len(links) == 0:
+        return self.stats()
+      self.assign(links)
+
+      p = self.r.pipeline(transaction=False)
+      p.llen(self.unassigned)
+      p.llen('delayed_job:popjoins')
+      remaining, joins = p.execute()
+      UNASSIGNED_LINKS.set(remaining)
+      log.info("Assigning PoPs. Remaining: [{0}]. "
+               "Deferred for join: [{1}]".format(
+                   Color.wrap(remaining, Color.OKBLUE),
+                   Color.wrap(joins, Color.HEADER)))
+
+  def claim(self):
+    """ Take the next batch of links off the queue """
+    keys = [self.unassigned]
+    if self.processed is not None:
+      keys.append(self.processed)
+    return self._claim(keys=keys, args=[self.batch_size])
+
+  def assign(self, links):
+    """ Assign PoPs to the claimed :links: """
+    try:
+      medians, asns = self.read(links)
+    except RETRY_ERRORS as e:
+      self.fail(links, e)
+      return
+
+    usable = []
+    usable_medians = []
+    for link, delay in zip(links, medians):
+      ip1, ip2 = dbkeys.link_ips(link)
+      if asns[ip1] and asns[ip2]:
+        usable.append(link)
+        usable_medians.append(delay)
+    no_asn = len(links) - len(usable)
+    LINKS_ASSIGNED['no_asn'].inc(no_asn)
+    self.no_asn += no_asn
+
+    links = usable
+    for start in xrange(0, len(links), GROUP_LINKS):
+      group = links[start:start + GROUP_LINKS]
+      keys, args = assign_links_call(group,
+                                     usable_medians[start:start + GROUP_LINKS],
+                                     asns, self.aslookup)
+      try:
+        with GROUP_ASSIGN_SECONDS.time():
+          assigned = self._assign(keys=keys, args=args)
+      except RETRY_ERRORS as e:
+        if self._failures_in_row >= MAX_FAILURES:
+          # Giving up, so put aside the rest of the batch too
+          group = links[start:]
+        self.fail(group, e)
+        continue
+      self._failures_in_row = 0
+      LINKS_ASSIGNED['assigned'].inc(assigned)
+      self.assigned += assigned
+
+  def read(self, links):
+    """ Read the delays of :links:, and the ASNs of their IPs
+    which aren't cached, in one pipeline.
+
+    :returns: (the median delay of each link,
+               dict of the ASN of each IP, or None if it has none)
+    """
+    asns = dict()
+    missing = []
+    for link in links:
+      for ip in dbkeys.link_ips(link):
+        if ip in asns:
+          continue
+        asn = None
+        if self.asn_cache is not None:
+          asn = self.asn_cache.get(ip)
+        if asn is None:
+          missing.append(ip)
+        asns[ip] = asn or None
+    self.asn_hits += len(asns) - len(missing)
+    self.asn_misses += len(missing)
+    ASN_CACHE_LOOKUPS['hit'].inc(len(asns) - len(missing))
+    ASN_CACHE_LOOKUPS['miss'].inc(len(missing))
+
+    p = self.r.pipeline(transaction=False)
+    delays.queue_reads(p, links)
+    for ip in missing:
+      dbkeys.get_asn(ip, pipe=p)
+    replies = p.execute(raise_on_error=False)
+
+    for ip, asn in zip(missing, replies[len(links):]):
+      if isinstance(asn, Exception):
+        raise asn
+      # Cache IPs without an ASN too, as ''
+      asn = intern(asn) if asn else ''
+      if self.asn_cache is not None:
+        self.asn_cache.put(ip, asn)
+      asns[ip] = asn or None
+
+    histograms = delays.parse_reads(self.r, links, replies[:len(links)])
+    return map(delays.median, histograms), asns
+
+  def fail(self, links, error):
+    """ Put :links:, which couldn't be assigned because of
+    :error:, on the failed queue and back off.
+    """
+    if self.failed is None:
+      raise error
+    self.r.lpush(self.failed, *links)
+    LINKS_ASSIGNED['failed'].inc(len(links))
+    self.failures += len(links)
+    if self._failures_in_row >= MAX_FAILURES:
+      raise error
+
+    delay = min(MAX_BACKOFF, BACKOFF * 2 ** self._failures_in_row)
+    self._failures_in_row += 1
+    log.warn("Couldn't assign {0} links ({1}). Retrying them later, "
+             "and waiting {2:.1f} seconds".format(len(links), error, delay))
+    time.sleep(delay)
+
+  def stats(self):
+    return {'assigned': self.assigned,
+            'no_asn': self.no_asn,
+            'failed': self.failures,
+            'asn_cache_hits': self.asn_hits,
+            'asn_cache_misses': self.asn_misses}
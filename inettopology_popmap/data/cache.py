@@ -0,0 +1,179 @@
+"""
+Bounded caches, both in-process and shared between processes.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import mmap
+import struct
+
+# A rough estimate of what a single cached IP costs in a CPython dict,
+# counting the integer key and the dict slot.
+IP_ENTRY_BYTES = 80
+
+
+class BoundedCache(object):
+  """ A mapping which holds at most :max_entries: items.
+
+  Entries are kept in two generations of half the size each. New
+  entries go into the current generation; once it fills up it
+  becomes the old generation and the previous old generation is
+  dropped. Entries found in the old generation are promoted, so
+  frequently used keys survive, much like an LRU but at the cost of
+  a couple of dict lookups.
+  """
+
+  def __init__(self, max_entries):
+    self.max_entries = max(2, int(max_entries))
+    self._generation_size = self.max_entries / 2
+    self._current = dict()
+    self._old = dict()
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @classmethod
+  def from_budget(cls, megabytes, entry_bytes=IP_ENTRY_BYTES):
+    """ Size a cache to use about :megabytes: of memory. """
+    return cls(megabytes * 1024 * 1024 / entry_bytes)
+
+  def __len__(self):
+    return len(self._current) + len(self._old)
+
+  def __contains__(self, key):
+    return key in self._current or key in self._old
+
+  def get(self, key, default=None):
+    try:
+      value = self._current[key]
+    except KeyError:
+      try:
+        value = self._old.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._store(key, value)
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    if key in self._current:
+      self._current[key] = value
+    else:
+      self._old.pop(key, None)
+      self._store(key, value)
+
+  def discard(self, key):
+    self._current.pop(key, None)
+    self._old.pop(key, None)
+
+  def clear(self):
+    self._current = dict()
+    self._old = dict()
+
+  def hit_rate(self):
+    lookups = self.hits + self.misses
+    return float(self.hits) / lookups if lookups > 0 else 0.0
+
+  def stats(self):
+    return {'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate()}
+
+  def _store(self, key, value):
+    if len(self._current) >= self._generation_size:
+      self.evictions += len(self._old)
+      self._old = self._current
+      self._current = dict()
+    self._current[key] = value
+
+
+class SharedLookupCache(object):
+  """ A fixed size cache from 32-bit integer keys to pairs of
+  32-bit integer values, held in a memory map so that it can be
+  shared between processes.
+
+  Without a :path: the map is anonymous, and is shared with any
+  processes forked after it is created. With a :path: it's backed
+  by that file, so independently started processes share it and it
+  persists across runs. :fingerprint: identifies what the values
+  mean; a file written with a different fingerprint is cleared.
+
+  Each key maps to exactly one slot, and a new key simply replaces
+  whatever was in its slot. Slots carry a checksum, so a slot that
+  is half written by another process reads as a miss. The key 0 is
+  used to mark empty slots and can't be cached.
+  """
+  MAGIC = 'popmapLC'
+  VERSION = 1
+  HEADER = struct.Struct('<8sIII')
+  SLOT = struct.Struct('<IIII')
+  CHECK = 0x5bd1e995
+
+  def __init__(self, megabytes, path=None, fingerprint=0):
+    self.nslots = max(1, megabytes * 1024 * 1024 / self.SLOT.size)
+    self.path = path
+    self.fingerprint = fingerprint & 0xffffffff
+    size = self.HEADER.size + self.nslots * self.SLOT.size
+    header = self.HEADER.pack(self.MAGIC, self.VERSION,
+                              self.nslots, self.fingerprint)
+
+    if path is None:
+      self._map = mmap.mmap(-1, size)
+      self._map[:len(header)] = header
+    else:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+      try:
+        if os.fstat(fd).st_size != size:
+          os.ftruncate(fd, 0)
+          os.ftruncate(fd, size)
+        self._map = mmap.mmap(fd, size)
+      finally:
+        os.close(fd)
+
+      if self._map[:len(header)] != header:
+        log.info("Initializing GeoIP cache in {0}".format(path))
+        self._map[:] = '\x00' * size
+        self._map[:len(header)] = header
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _offset(self, key):
+    # Fibonacci hash the key, then scale it into the slot range using
+    # its high bits, since the low bits of nearby IPs barely differ.
+    slot = ((key * 2654435761) & 0xffffffff) * self.nslots >> 32
+    return self.HEADER.size + slot * self.SLOT.size
+
+  def get(self, key):
+    """ Return the pair of values cached for :key:, or None """
+    stored, a, b, check = self.SLOT.unpack_from(self._map, self._offset(key))
+    if stored == key and check == stored ^ a ^ b ^ self.CHECK:
+      self.hits += 1
+      return (a, b)
+    self.misses += 1
+    return None
+
+  def put(self, key, a, b):
+    offset = self._offset(key)
+    stored = self.SLOT.unpack_from(self._map, offset)[0]
+    if stored != 0 and stored != key:
+      self.evictions += 1
+    self.SLOT.pack_into(self._map, offset, key, a, b,
+                        key ^ a ^ b ^ self.CHECK)
+
+  def hit_rate(self):
+    lookups = self.hits + self.misses
+    return float(self.hits) / lookups if lookups > 0 else 0.0
+
+  def stats(self):
+    return {'slots': self.nslots,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate()}
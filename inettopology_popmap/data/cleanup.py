@@ -3,6 +3,7 @@ log = logging.getLogger(__name__)
 
 import inettopology_popmap.connection as connection
 from inettopology_popmap.data import dbkeys
+from inettopology_popmap.data import delays
 import inettopology.util.structures as structures
 from inettopology.util.general import Color
 
@@ -32,10 +33,10 @@ def cleanup(args):
   r = connection.Redis(structures.ConnectionInfo(**args.redis))
 
   log.info("Removing IP pop data (may take a while)... ")
-  ips = r.smembers('iplist')
+  ips = list(dbkeys.iter_ips(r))
   p = r.pipeline()
   for ip in ips:
-    p.hdel(dbkeys.ip_key(ip), 'pop')
+    dbkeys.del_pop(ip, pipe=p)
   result = p.execute()
   del ips
   log.info(Color.wrapformat("[{0} removed]",
@@ -72,14 +73,15 @@ def cleanup(args):
   if args.ip_links:
     log.info("Removing ip links... ")
     p = r.pipeline()
-    p.delete(dbkeys.Link.unassigned())
-    p.delete(dbkeys.Link.unassigned_fails())
-    p.delete("delayed_job:processed_links")
+    for queue in dbkeys.Link.queues():
+      p.delete(queue)
     iplinkkeys = r.keys("ip:links:*")
     for key in iplinkkeys:
       p.delete(key)
     result = p.execute()
     write_failed(result)
+    r.delete(delays.STORE_KEY)
+    r.delete(dbkeys.LINK_PARTITIONS_KEY)
 
   pipelined_delete(r,
                    'poplist',
@@ -0,0 +1,263 @@
+"""
+Computing every PoP in one pass, for 'process cluster'.
+
+Two IPs belong to the same PoP if a link with a median delay within
+assign.MAX_SAME_POP_DELAY (see assign.far_link) joins them and they
+share an ASN and a /24, and PoPs are the groups of IPs that chains of
+such links connect. assign_pops finds those groups a link at a time,
+queueing a join whenever a link turns out to connect two PoPs already
+made, and process_joins merges them afterwards. Clustering instead reads
+every link and IP record once into compact arrays, finds the groups
+with a union-find, and writes the finished PoPs, their links and
+their ASNs back in bulk, with no joins left to process.
+
+The links are read from the queues which hold them (see
+dbkeys.Link.queues), and left on the processed queues afterwards, as
+assign_pops would.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import array
+import collections
+
+import inettopology_popmap.data.dbkeys as dbkeys
+import inettopology_popmap.data.delays as delays
+import inettopology_popmap.data.assign as assign
+import inettopology_popmap.data.preprocess as preprocess
+from inettopology_popmap.data import DataError
+
+READ_LINKS = 5000
+WRITE_COMMANDS = 10000
+MOVE_LINKS = 10000
+
+
+def _chunks(values, size=READ_LINKS):
+  for start in xrange(0, len(values), size):
+    yield values[start:start + size]
+
+
+class _Writer(object):
+  """ Queues commands on a pipeline of :r:, sending them every
+  WRITE_COMMANDS commands.
+  """
+
+  def __init__(self, r):
+    self.pipe = r.pipeline(transaction=False)
+    self.queued = 0
+
+  def __getattr__(self, command):
+    method = getattr(self.pipe, command)
+
+    def queue(*args):
+      method(*args)
+      self.queued += 1
+      if self.queued >= WRITE_COMMANDS:
+        self.flush()
+    return queue
+
+  def flush(self):
+    if self.queued:
+      self.pipe.execute()
+      self.queued = 0
+
+
+class Clusterer(object):
+  """ Finds the PoPs of the links in the database at :r: """
+
+  def __init__(self, r):
+    self.r = r
+    self.aslookup = preprocess.MaxMindGeoIPReader.Instance()
+
+    self.ips = []
+    self.index = {}
+    self.asns = []
+    # The IPs at each end of every link, and whether it joins
+    # different PoPs whatever their ASNs
+    self.ends1 = array.array('i')
+    self.ends2 = array.array('i')
+    self.far = bytearray()
+
+    self.parent = array.array('i')
+    self.size = array.array('i')
+
+  def run(self):
+    """ Cluster the links into PoPs and write them to the database
+
+    :returns: dict of statistics
+    """
+    if self.r.exists(dbkeys.POP.list()):
+      raise DataError("This database already has PoPs. Remove them "
+                      "with 'process cleanup' before clustering")
+
+    started = time.time()
+    for queue in dbkeys.Link.queues():
+      self.read_links(queue)
+    self.read_asns()
+    log.info("Read {0} links between {1} IPs in {2:.1f} seconds"
+             .format(len(self.ends1), len(self.ips), time.time() - started))
+
+    started = time.time()
+    members = self.cluster()
+    log.info("Found {0} PoPs in {1:.1f} seconds"
+             .format(len(members), time.time() - started))
+
+    started = time.time()
+    pops = self.write_pops(members)
+    stats = self.write_links(pops)
+    self.finish_queues()
+    log.info("Wrote PoPs in {0:.1f} seconds".format(time.time() - started))
+
+    stats['pops'] = len(members)
+    return stats
+
+  def _ip(self, ip):
+    try:
+      return self.index[ip]
+    except KeyError:
+      i = self.index[ip] = len(self.ips)
+      self.ips.append(ip)
+      return i
+
+  def read_links(self, queue):
+    """ Read the links on :queue:, and their delays """
+    start = 0
+    while True:
+      links = self.r.lrange(queue, start, start + READ_LINKS - 1)
+      if len(links) == 0:
+        return
+      start += len(links)
+
+      for link, histogram in zip(links, delays.read_each(self.r, links)):
+        ip1, ip2 = dbkeys.link_ips(link)
+        self.ends1.append(self._ip(ip1))
+        self.ends2.append(self._ip(ip2))
+        self.far.append(assign.far_link(delays.median(histogram), ip1, ip2))
+
+  def read_asns(self):
+    """ Read the ASN of every IP seen on a link """
+    for start in xrange(0, len(self.ips), READ_LINKS):
+      p = self.r.pipeline(transaction=False)
+      for ip in self.ips[start:start + READ_LINKS]:
+        dbkeys.get_asn(ip, pipe=p)
+      self.asns.extend(asn or None for asn in p.execute())
+
+  def _find(self, i):
+    parent = self.parent
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  def _union(self, i, j):
+    i = self._find(i)
+    j = self._find(j)
+    if i == j:
+      return
+    if self.size[i] < self.size[j]:
+      i, j = j, i
+    self.parent[j] = i
+    self.size[i] += self.size[j]
+
+  def cluster(self):
+    """ Join the ends of every link within a PoP.
+
+    :returns: the IPs of each PoP, as lists of indexes, in the order
+    their first IP was seen. IPs which aren't on any link with an
+    ASN at both ends aren't in one, as assign_pops would skip them.
+    """
+    self.parent = array.array('i', xrange(len(self.ips)))
+    self.size = array.array('i', [1]) * len(self.ips)
+    placed = bytearray(len(self.ips))
+
+    asns = self.asns
+    for i1, i2, far in zip(self.ends1, self.ends2, self.far):
+      if asns[i1] is None or asns[i2] is None:
+        continue
+      placed[i1] = placed[i2] = 1
+      if not far and asns[i1] == asns[i2]:
+        self._union(i1, i2)
+
+    members = collections.OrderedDict()
+    for i in xrange(len(self.ips)):
+      if placed[i]:
+        members.setdefault(self._find(i), []).append(i)
+    return members.values()
+
+  def write_pops(self, members):
+    """ Number and store the PoPs with :members:
+
+    :returns: the PoP number of each IP, or None for those
+    without one
+    """
+    first = self.r.incrby(dbkeys.POP.counter(), len(members)) - len(members)
+    pops = [None] * len(self.ips)
+    asn_pops = collections.defaultdict(list)
+
+    w = _Writer(self.r)
+    for n, indexes in enumerate(members):
+      pop = str(first + n + 1)
+      ips = [self.ips[i] for i in indexes]
+      asn = self.asns[indexes[0]]
+      asn_pops[asn].append(pop)
+
+      w.sadd(dbkeys.POP.members(pop), *ips)
+      w.sadd(dbkeys.POP.countries(pop),
+             *set(self.aslookup.lookup_country_codes(ips)))
+      w.set(dbkeys.POP.asn(pop), asn)
+      for i, ip in zip(indexes, ips):
+        pops[i] = pop
+        dbkeys.set_pop(ip, pop, pipe=w)
+
+    for asn, numbers in asn_pops.iteritems():
+      for chunk in _chunks(numbers):
+        w.sadd(dbkeys.ASN.pops(asn), *chunk)
+    for chunk in _chunks([str(first + n + 1) for n in xrange(len(members))]):
+      w.sadd(dbkeys.POP.list(), *chunk)
+    w.flush()
+    return pops
+
+  def write_links(self, pops):
+    """ Store each link within or between the PoPs :pops: """
+    intra = collections.defaultdict(list)
+    inter = collections.defaultdict(list)
+    no_asn = 0
+    for i1, i2 in zip(self.ends1, self.ends2):
+      pop1 = pops[i1]
+      pop2 = pops[i2]
+      if self.asns[i1] is None or self.asns[i2] is None:
+        no_asn += 1
+      elif pop1 == pop2:
+        intra[pop1].append(str((self.ips[i1], self.ips[i2])))
+      else:
+        inter[dbkeys.Link.interlink(pop1, pop2)].append(
+            str((self.ips[i1], self.ips[i2])))
+
+    w = _Writer(self.r)
+    for pop, links in intra.iteritems():
+      w.sadd(dbkeys.Link.intralink(pop), *links)
+
+    neighbors = collections.defaultdict(list)
+    for key, links in inter.iteritems():
+      pop1, pop2 = key.split(':')[2:]
+      neighbors[pop1].append(pop2)
+      neighbors[pop2].append(pop1)
+      w.sadd(key, *links)
+    for pop, connected in neighbors.iteritems():
+      w.sadd(dbkeys.POP.neighbors(pop), *connected)
+    for chunk in _chunks(inter.keys()):
+      w.lpush(dbkeys.Link.interlink_keys(), *chunk)
+    w.flush()
+
+    return {'assigned': len(self.ends1) - no_asn, 'no_asn': no_asn}
+
+  def finish_queues(self):
+    """ Move every link onto the processed queues """
+    claim = self.r.register_script(assign.CLAIM_LINKS_LUA)
+    for partition in dbkeys.partitions():
+      processed = dbkeys.Link.processed(partition)
+      for queue in (dbkeys.Link.unassigned(partition),
+                    dbkeys.Link.unassigned_fails(partition)):
+        while claim(keys=[queue, processed], args=[MOVE_LINKS]):
+          pass
@@ -1,12 +1,50 @@
-__all__ = ('delay_key', 'ASN', 'POP', 'Link', 'AS')
+__all__ = ('delay_key', 'ASN', 'POP', 'Link', 'Checkpoint', 'AS')
 
 import logging
 log = logging.getLogger(__name__)
+import zlib
 import inettopology.util.decorators
 import inettopology.util.structures as structures
 import inettopology_popmap.connection as connection
+import inettopology_popmap.data.delays as delays
+from inettopology_popmap.data.geoip import ip2long
 from inettopology_popmap.data import DataError
 
+# Per-IP records ('asn' and 'pop') are stored in one of two layouts,
+# recorded in IP_LAYOUT_KEY:
+#
+#  hash     - one 'ip:<ip>' hash per IP, and every IP in 'iplist'
+#  compact  - IPs are grouped into 'ipb:<n>' hashes, where n is the
+#             address as an integer shifted right by IP_BUCKET_BITS.
+#             Fields are '<low bits>:asn' and '<low bits>:pop'. Small
+#             hashes get Redis' compact encoding, and there's no
+#             'iplist'.
+#
+# Everything else should use ip_key, ip_field and the get/set
+# functions below rather than depend on either layout.
+IP_LAYOUT_KEY = 'meta:ip_layout'
+HASH_LAYOUT = 'hash'
+COMPACT_LAYOUT = 'compact'
+IP_LAYOUTS = (HASH_LAYOUT, COMPACT_LAYOUT)
+IP_BUCKET_BITS = 6
+IP_BUCKET_MASK = (1 << IP_BUCKET_BITS) - 1
+
+_ip_layout = {}
+
+# Links, and the queues that hold them, can be split into partitions
+# so that they spread across the instances of a sharded deployment
+# (see connection.ShardedRedis). The number of partitions is fixed
+# when a database is created and recorded in LINK_PARTITIONS_KEY. With
+# more than one, each link key and queue carries a '{p<n>}' hash tag
+# naming its partition, which decides the shard it lives on. A link's
+# partition is a hash of its two IPs, so the link key and the queues
+# it passes through always share a shard. Everything else is untagged
+# and lives on the first instance.
+LINK_PARTITIONS_KEY = 'meta:link_partitions'
+SHARDED_LINK_PARTITIONS = 256
+
+_link_partitions = {}
+
 
 @inettopology.util.decorators.factory
 def mutex_popnum():
@@ -22,21 +60,178 @@ def delay_key(ip1, ip2):
     """
     Return a delay key, with the 'lower' ip always first
     """
-    return "ip:links:%s:%s" % ((ip1, ip2) if ip1 < ip2 else (ip2, ip1))
+    if ip1 > ip2:
+      ip1, ip2 = ip2, ip1
+    partition = link_partition(ip1, ip2)
+    if partition is None:
+      return "ip:links:%s:%s" % (ip1, ip2)
+    return "ip:links:{p%d}:%s:%s" % (partition, ip1, ip2)
+
+
+def link_ips(link):
+  """ Return the two IPs of the delay key :link: """
+  return link.split(':')[-2:]
+
+
+def configure_link_partitions(r, sharded=False):
+  """ Settle how many partitions the database at :r: splits its
+  links into. A new database gets SHARDED_LINK_PARTITIONS if it's
+  :sharded: and one otherwise; one that already holds links keeps
+  what it has.
+  """
+  stored = r.get(LINK_PARTITIONS_KEY)
+  if stored is None:
+    _link_partitions['count'] = 1
+    if any(r.exists(key) for key in Link.queues()):
+      stored = 1  # Built before partitions were recorded
+    else:
+      r.setnx(LINK_PARTITIONS_KEY,
+              SHARDED_LINK_PARTITIONS if sharded else 1)
+      stored = r.get(LINK_PARTITIONS_KEY)
+
+  count = int(stored)
+  if sharded and count == 1:
+    log.warn("This database's links aren't partitioned, so they "
+             "will all be kept on the first Redis instance")
+  _link_partitions['count'] = count
+  return count
+
+
+def link_partitions():
+  """ Return the number of partitions links are split into """
+  try:
+    return _link_partitions['count']
+  except KeyError:
+    count = int(connection.Redis().get(LINK_PARTITIONS_KEY) or 1)
+    _link_partitions['count'] = count
+    return count
+
+
+def partitions():
+  """ Return the link partitions to pass to the Link queue
+  functions; just None if links aren't partitioned.
+  """
+  count = link_partitions()
+  return [None] if count == 1 else range(count)
+
+
+def link_partition(ip1, ip2):
+  """ Return the partition of the link between :ip1: and :ip2:
+  (given lower first), or None if links aren't partitioned.
+  """
+  count = link_partitions()
+  if count == 1:
+    return None
+  return (zlib.crc32("%s:%s" % (ip1, ip2)) & 0xffffffff) % count
+
+
+def _partitioned(key, partition):
+  return key if partition is None else "%s:{p%d}" % (key, partition)
+
+
+def configure_ip_layout(r, requested=None):
+  """ Settle which layout the database at :r: uses for IP
+  records. A new database gets the :requested: one (or the hash
+  layout if that's None); otherwise it must match what's there.
+
+  :raises: DataError if :requested: differs from the database's
+  """
+  stored = r.get(IP_LAYOUT_KEY)
+  if stored is None:
+    if r.exists('iplist') or any(r.exists(key) for key in Link.queues()):
+      stored = HASH_LAYOUT  # Built before layouts were recorded
+    else:
+      r.setnx(IP_LAYOUT_KEY, requested or HASH_LAYOUT)
+      stored = r.get(IP_LAYOUT_KEY)
+
+  if requested is not None and requested != stored:
+    raise DataError("This database stores IPs in the '{0}' layout, "
+                    "not '{1}'".format(stored, requested))
+  _ip_layout['layout'] = stored
+  return stored
+
+
+def ip_layout():
+  """ Return the IP record layout of the connected database """
+  try:
+    return _ip_layout['layout']
+  except KeyError:
+    layout = connection.Redis().get(IP_LAYOUT_KEY) or HASH_LAYOUT
+    _ip_layout['layout'] = layout
+    return layout
 
 
 def ip_key(ip):
+  """ Return the key of the hash holding the record of :ip: """
+  if ip_layout() == COMPACT_LAYOUT:
+    return "ipb:%d" % (ip2long(ip) >> IP_BUCKET_BITS)
   return "ip:%s" % ip
 
 
+def ip_field(ip, field):
+  """ Return the name of :field: of the record of :ip:
+  within the hash named by ip_key.
+  """
+  if ip_layout() == COMPACT_LAYOUT:
+    return "%d:%s" % (ip2long(ip) & IP_BUCKET_MASK, field)
+  return field
+
+
+def iplist_member(ip):
+  """ Return what to add to 'iplist' for :ip:, or None
+  if the layout doesn't keep one.
+  """
+  return None if ip_layout() == COMPACT_LAYOUT else ip
+
+
 def get_pop(ip, pipe=None):
-  p = pipe if pipe else connection.Redis()
-  return p.hget(ip_key(ip), 'pop')
+  p = pipe if pipe is not None else connection.Redis()
+  return p.hget(ip_key(ip), ip_field(ip, 'pop'))
+
+
+def get_asn(ip, pipe=None):
+  p = pipe if pipe is not None else connection.Redis()
+  return p.hget(ip_key(ip), ip_field(ip, 'asn'))
+
+
+def set_pop(ip, pop, pipe=None):
+  p = pipe if pipe is not None else connection.Redis()
+  return p.hset(ip_key(ip), ip_field(ip, 'pop'), pop)
+
+
+def del_pop(ip, pipe=None):
+  p = pipe if pipe is not None else connection.Redis()
+  return p.hdel(ip_key(ip), ip_field(ip, 'pop'))
+
+
+def set_ip_fields(ip, values, pipe=None):
+  """ Store the dict :values: in the record of :ip: """
+  p = pipe if pipe is not None else connection.Redis()
+  p.hmset(ip_key(ip), dict((ip_field(ip, field), value)
+                           for field, value in values.iteritems()))
+  if iplist_member(ip) is not None:
+    p.sadd('iplist', ip)
+
+
+def iter_ips(r):
+  """ Yield every IP which has a record """
+  if ip_layout() != COMPACT_LAYOUT:
+    for ip in r.sscan_iter('iplist'):
+      yield ip
+    return
+
+  for key in r.scan_iter(match='ipb:*', count=1000):
+    base = int(key.split(':')[1]) << IP_BUCKET_BITS
+    lows = set(int(field.split(':')[0]) for field in r.hkeys(key))
+    for low in sorted(lows):
+      ipnum = base | low
+      yield "%d.%d.%d.%d" % (ipnum >> 24, (ipnum >> 16) & 0xff,
+                             (ipnum >> 8) & 0xff, ipnum & 0xff)
 
 
 def get_delay(link):
-  delays = list(connection.Redis().smembers(link))
-  return float(sorted(delays)[len(delays) / 2])
+  """ Return the median delay seen on :link: """
+  return delays.median(delays.read(connection.Redis(), [link]))
 
 
 def setpopnumber(mutex, key, pipe=None):
@@ -46,14 +241,15 @@ def setpopnumber(mutex, key, pipe=None):
   """
   r = connection.Redis()
 
-  p = mutex.backend().pipeline() if not pipe else pipe
+  # An empty pipeline is falsy, so test for None
+  p = mutex.backend().pipeline(transaction=True) if pipe is None else pipe
   pop = r.incr(POP.counter())
 
   p.sadd(POP.list(), pop)
   p.sadd(POP.members(pop), key)
-  p.hset(ip_key(key), 'pop', pop)
+  set_pop(key, pop, pipe=p)
 
-  asn = r.hget(ip_key(key), 'asn')
+  asn = get_asn(key)
   if not asn:
     raise DataError("IP '%s' is missing an ASN" % key)
 
@@ -69,7 +265,7 @@ def setpopnumber(mutex, key, pipe=None):
   p.set(POP.asn(pop), asn)
   p.sadd(ASN.pops(asn), pop)
 
-  if not pipe:
+  if pipe is None:
       p.execute()
   return pop
 
@@ -128,16 +324,30 @@ class Link:
     return "meta:interlink_keys"
 
   @staticmethod
-  def unassigned():
-    return "delayed_job:unassigned_links"
+  def unassigned(partition=None):
+    return _partitioned("delayed_job:unassigned_links", partition)
 
   @staticmethod
-  def unassigned_fails():
-    return "delayed_job:unassigned_link_fails"
+  def unassigned_fails(partition=None):
+    return _partitioned("delayed_job:unassigned_link_fails", partition)
 
   @staticmethod
-  def processed():
-    return "delayed_job:unassigned_links"
+  def retry_fails(partition=None):
+    """ Links which fail again while the failed links are being
+    retried, until they're moved back onto unassigned_fails """
+    return _partitioned("delayed_job:unassigned_link_fails2", partition)
+
+  @staticmethod
+  def processed(partition=None):
+    return _partitioned("delayed_job:processed_links", partition)
+
+  @staticmethod
+  def queues():
+    """ The lists which between them hold every link """
+    return [queue for partition in partitions()
+            for queue in (Link.unassigned(partition),
+                          Link.unassigned_fails(partition),
+                          Link.processed(partition))]
 
   @staticmethod
   def ensure_dbsafe(link):
@@ -146,6 +356,22 @@ class Link:
       return link
 
 
+class Checkpoint:
+
+  @staticmethod
+  def parse(content_id, start):
+    return "meta:parse_checkpoint:%s:%s" % (content_id, start)
+
+  @staticmethod
+  def shards(content_id):
+    return "meta:parse_shards:%s" % content_id
+
+  @staticmethod
+  def written(content_id, start, partition=None):
+    return _partitioned("meta:parse_written:%s:%s" % (content_id, start),
+                        partition)
+
+
 class AS:
   metakeys = {'peering_data': 'peering_data_loaded'}
 
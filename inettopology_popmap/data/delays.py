@@ -0,0 +1,190 @@
+"""
+Fixed size summaries of the delays observed on each link.
+
+Each link key (see dbkeys.delay_key) is a Redis hash mapping a
+histogram bucket to the number of delays seen in it. Buckets are
+spaced logarithmically, each GROWTH times wider than the last, so any
+delay is known to within about 1% and a link can never use more than
+a few hundred buckets however many traces cross it. In practice
+links fill a handful.
+
+Databases built before this stored every distinct delay in a set
+under the same key. Those can still be read, but have to be
+converted with 'process convert_delays' before more links are added.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import math
+
+import redis
+
+from inettopology_popmap.data import DataError
+
+STORE_KEY = 'meta:delay_store'
+STORE_FORMAT = 'histogram'
+
+MIN_DELAY = 0.001
+MAX_DELAY = 100000.0
+GROWTH = 1.02
+_LOG_GROWTH = math.log(GROWTH)
+MAX_BUCKET = int(math.log(MAX_DELAY / MIN_DELAY) / _LOG_GROWTH)
+
+
+def bucket(delay):
+  """ Return the histogram bucket for :delay: (in ms). Delays
+  outside [MIN_DELAY, MAX_DELAY] go in the first or last bucket.
+  """
+  if delay <= MIN_DELAY:
+    return 0
+  return min(MAX_BUCKET, int(math.log(delay / MIN_DELAY) / _LOG_GROWTH))
+
+
+def bucket_delay(b):
+  """ Return the delay that stands for bucket :b:, the
+  geometric middle of the range it covers.
+  """
+  return round(MIN_DELAY * GROWTH ** (b + 0.5), 3)
+
+
+def bucket_top(delay):
+  """ Return the upper bound of the bucket :delay: falls in. A
+  delay read back from a histogram is only above this if every
+  delay in its bucket was above :delay:.
+  """
+  return MIN_DELAY * GROWTH ** (bucket(delay) + 1)
+
+
+def quantiles(histogram, fractions):
+  """ Return the delay at each of :fractions: of the way
+  through :histogram: (a dict of bucket -> count), choosing the
+  same elements decile_transform would from a sorted list.
+  """
+  total = sum(histogram.itervalues())
+  if total == 0:
+    raise ValueError("Empty histogram")
+
+  ranks = [min(total - 1, int(fraction * total)) for fraction in fractions]
+  order = sorted(range(len(ranks)), key=ranks.__getitem__)
+  result = [None] * len(ranks)
+
+  seen = 0
+  i = 0
+  for b in sorted(histogram):
+    seen += histogram[b]
+    while i < len(order) and ranks[order[i]] < seen:
+      result[order[i]] = bucket_delay(b)
+      i += 1
+  return result
+
+
+def median(histogram):
+  return quantiles(histogram, (0.5,))[0]
+
+
+def deciles(histogram):
+  return quantiles(histogram, [d / 10.0 for d in xrange(10)])
+
+
+def _parse_hash(data):
+  return dict((int(b), int(count)) for b, count in data.iteritems())
+
+
+def _parse_set(members):
+  histogram = dict()
+  for delay in members:
+    b = bucket(float(delay))
+    histogram[b] = histogram.get(b, 0) + 1
+  return histogram
+
+
+def read_each(r, keys):
+  """ Return the histogram of the delays seen on each of
+  the links :keys:, reading them all in one pipeline.
+  """
+  p = r.pipeline(transaction=False)
+  queue_reads(p, keys)
+  return parse_reads(r, keys, p.execute(raise_on_error=False))
+
+
+def queue_reads(p, keys):
+  """ Queue reads of the delays of the links :keys: on the
+  pipeline :p:, so that other commands can share its round trip.
+  Pass the replies, executed with raise_on_error=False, to
+  parse_reads.
+  """
+  for key in keys:
+    p.hgetall(key)
+
+
+def parse_reads(r, keys, replies):
+  """ Return the histograms of the links :keys: from the
+  :replies: to the reads queued by queue_reads.
+  """
+  histograms = []
+  for key, reply in zip(keys, replies):
+    if isinstance(reply, redis.ResponseError):
+      # A link stored as a set by an older version
+      histograms.append(_parse_set(r.smembers(key)))
+    else:
+      histograms.append(_parse_hash(reply))
+  return histograms
+
+
+def read(r, keys):
+  """ Return the histogram of all delays seen on the
+  links :keys:, merged together.
+  """
+  merged = dict()
+  for histogram in read_each(r, keys):
+    for b, count in histogram.iteritems():
+      merged[b] = merged.get(b, 0) + count
+  return merged
+
+
+def ensure_histogram_store(r, link_lists):
+  """ Make sure the database at :r: stores delays as histograms,
+  marking it as doing so if it's empty. :link_lists: are the lists
+  which hold every link key in the database.
+
+  :raises: DataError if the database holds links stored as sets.
+  """
+  store = r.get(STORE_KEY)
+  if store == STORE_FORMAT:
+    return
+  if store is None and not any(r.exists(key) for key in link_lists):
+    r.setnx(STORE_KEY, STORE_FORMAT)
+    return
+  raise DataError("This database stores link delays as sets. "
+                  "Run 'process convert_delays' before adding links.")
+
+
+def convert_set_store(r, link_lists, batch_size=1000):
+  """ Convert every link in :link_lists: which is stored as
+  a set of delays into a histogram.
+
+  :returns: the number of links converted
+  """
+  converted = 0
+  for listkey in link_lists:
+    for start in xrange(0, r.llen(listkey), batch_size):
+      links = r.lrange(listkey, start, start + batch_size - 1)
+      p = r.pipeline(transaction=False)
+      for link in links:
+        p.type(link)
+      sets = [link for link, kind in zip(links, p.execute()) if kind == 'set']
+
+      p = r.pipeline(transaction=False)
+      for link in sets:
+        p.smembers(link)
+      histograms = [_parse_set(members) for members in p.execute()]
+
+      p = r.pipeline(transaction=True)
+      for link, histogram in zip(sets, histograms):
+        p.delete(link)
+        p.hmset(link, histogram)
+      p.execute()
+      converted += len(sets)
+
+  r.set(STORE_KEY, STORE_FORMAT)
+  return converted
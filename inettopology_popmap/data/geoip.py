@@ -0,0 +1,252 @@
+"""
+Compiled lookup tables for the MaxMind GeoIP databases.
+
+A legacy GeoIP .dat file is a binary trie keyed on the bits of an
+IPv4 address. Walking it once produces a sorted list of address
+ranges, so a lookup becomes a binary search over an integer array
+instead of a 32 step walk through the trie for every IP.
+
+Compiled tables are cached on disk next to the .dat file they came
+from (or in ~/.cache/inettopology_popmap if that isn't writable), so
+only the first run has to walk the trie.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import array
+import bisect
+import marshal
+import socket
+import struct
+import zlib
+
+COUNTRY_EDITION = 1
+ASNUM_EDITION = 9
+COUNTRY_BEGIN = 16776960
+STANDARD_RECORD_LENGTH = 3
+SEGMENT_RECORD_LENGTH = 3
+STRUCTURE_INFO_MAX_SIZE = 20
+MAX_ORG_RECORD_LENGTH = 300
+ORG_ENCODING = 'iso-8859-1'
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.ranges'
+USER_CACHE_DIR = os.path.join('~', '.cache', 'inettopology_popmap')
+
+
+def _uint32_typecode():
+  for code in ('I', 'L'):
+    if array.array(code).itemsize == 4:
+      return code
+  raise TypeError("No 32-bit array type available")
+
+UINT32 = _uint32_typecode()
+
+
+def ip2long(ip):
+  """ Convert a dotted quad into a 32-bit integer """
+  return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+class RangeTable(object):
+  """ A sorted set of IP address ranges, each mapped to a label.
+
+  Range i covers the addresses from starts[i] up to (but not
+  including) starts[i + 1], and has the label labels[index[i]].
+  """
+
+  def __init__(self, starts, index, labels):
+    self.starts = starts
+    self.index = index
+    self.labels = labels
+
+  def __len__(self):
+    return len(self.starts)
+
+  def lookup(self, ipnum):
+    """ Return the label for the integer address :ipnum: """
+    i = bisect.bisect_right(self.starts, ipnum) - 1
+    return self.labels[self.index[i]]
+
+  def lookup_many(self, ipnums):
+    """ Return the labels for each of the integer addresses
+    in :ipnums:.
+    """
+    starts = self.starts
+    index = self.index
+    labels = self.labels
+    search = bisect.bisect_right
+    return [labels[index[search(starts, ipnum) - 1]] for ipnum in ipnums]
+
+  def label_id(self, ipnum):
+    """ Return the position of the label for :ipnum: in
+    :labels:, which is a compact stand-in for the label itself.
+    """
+    return self.index[bisect.bisect_right(self.starts, ipnum) - 1]
+
+  def fingerprint(self):
+    """ A checksum which changes whenever the labels do. """
+    return zlib.crc32(self.index.tostring(),
+                      zlib.crc32(repr(self.labels))) & 0xffffffff
+
+  def dump(self, fh, fingerprint):
+    marshal.dump((CACHE_VERSION, fingerprint,
+                  self.starts.tostring(), self.index.tostring(),
+                  self.labels), fh)
+
+  @classmethod
+  def load(cls, fh, fingerprint):
+    """ Load a table written by :dump:. Return None if it was
+    written by a different version or for a different .dat file.
+    """
+    try:
+      version, stored, starts, index, labels = marshal.load(fh)
+    except (EOFError, ValueError, TypeError):
+      return None
+    if version != CACHE_VERSION or stored != fingerprint:
+      return None
+
+    starts_arr = array.array(UINT32)
+    starts_arr.fromstring(starts)
+    index_arr = array.array(UINT32)
+    index_arr.fromstring(index)
+    return cls(starts_arr, index_arr, labels)
+
+
+def _structure_info(data):
+  """ Return the (edition, segments, record length) of the
+  database contained in :data:.
+  """
+  pos = len(data) - 3
+  for i in xrange(STRUCTURE_INFO_MAX_SIZE):
+    if data[pos:pos + 3] == '\xff\xff\xff':
+      edition = ord(data[pos + 3])
+      if edition >= 106:
+        edition -= 105
+      if edition == ASNUM_EDITION:
+        segments = 0
+        for j in xrange(SEGMENT_RECORD_LENGTH):
+          segments += ord(data[pos + 4 + j]) << (j * 8)
+        return (edition, segments, STANDARD_RECORD_LENGTH)
+      return (edition, COUNTRY_BEGIN, STANDARD_RECORD_LENGTH)
+    pos -= 1
+  return (COUNTRY_EDITION, COUNTRY_BEGIN, STANDARD_RECORD_LENGTH)
+
+
+def _walk_trie(data, segments, record_length):
+  """ Walk the trie in :data: in address order, returning a
+  list of range starts and the list of leaf values for each range.
+  Adjacent ranges with the same value are merged.
+  """
+  starts = array.array(UINT32)
+  values = []
+  node_size = 2 * record_length
+
+  def record(node, side):
+    offset = node * node_size + side * record_length
+    value = 0
+    for j in xrange(record_length):
+      value += ord(data[offset + j]) << (j * 8)
+    return value
+
+  def visit(node, depth, prefix):
+    for side in (0, 1):
+      start = prefix | (side << depth)
+      value = record(node, side)
+      if value >= segments:
+        if len(values) == 0 or values[-1] != value:
+          starts.append(start)
+          values.append(value)
+      elif depth == 0:
+        raise ValueError("GeoIP trie is deeper than 32 bits")
+      else:
+        visit(value, depth - 1, start)
+
+  visit(0, 31, 0)
+  return starts, values
+
+
+def compile_dat(path):
+  """ Compile the GeoIP country or ASN database at :path:
+  into a RangeTable.
+  """
+  with open(path, 'rb') as fh:
+    data = fh.read()
+
+  edition, segments, record_length = _structure_info(data)
+  starts, values = _walk_trie(data, segments, record_length)
+
+  if edition == ASNUM_EDITION:
+    org_base = (2 * record_length - 1) * segments
+
+    def label(value):
+      if value == segments:
+        return None
+      ptr = value + org_base
+      record = data[ptr:ptr + MAX_ORG_RECORD_LENGTH].split('\x00', 1)[0]
+      return record.decode(ORG_ENCODING)
+
+  elif edition == COUNTRY_EDITION:
+    import pygeoip.const
+
+    def label(value):
+      return pygeoip.const.COUNTRY_CODES[value - COUNTRY_BEGIN]
+
+  else:
+    raise ValueError("Unsupported GeoIP database edition {0} in {1}"
+                     .format(edition, path))
+
+  labels = []
+  label_ids = dict()
+  index = array.array(UINT32)
+  for value in values:
+    try:
+      index.append(label_ids[value])
+    except KeyError:
+      label_ids[value] = len(labels)
+      index.append(len(labels))
+      labels.append(label(value))
+
+  return RangeTable(starts, index, labels)
+
+
+def _cache_paths(path):
+  yield path + CACHE_SUFFIX
+  yield os.path.join(os.path.expanduser(USER_CACHE_DIR),
+                     os.path.basename(path) + CACHE_SUFFIX)
+
+
+def load_table(path):
+  """ Return the RangeTable for the GeoIP database at :path:,
+  using a cached compiled copy if there's a current one.
+  """
+  stat = os.stat(path)
+  fingerprint = (stat.st_size, int(stat.st_mtime))
+
+  for cache_path in _cache_paths(path):
+    try:
+      with open(cache_path, 'rb') as fh:
+        table = RangeTable.load(fh, fingerprint)
+      if table is not None:
+        return table
+    except IOError:
+      pass
+
+  log.info("Compiling GeoIP lookup table for {0}".format(path))
+  table = compile_dat(path)
+
+  for cache_path in _cache_paths(path):
+    try:
+      if not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+      tmp_path = "{0}.{1}".format(cache_path, os.getpid())
+      with open(tmp_path, 'wb') as fh:
+        table.dump(fh, fingerprint)
+      os.rename(tmp_path, cache_path)
+      break
+    except (IOError, OSError) as e:
+      log.debug("Couldn't cache GeoIP table at {0}: {1}"
+                .format(cache_path, e))
+
+  return table
@@ -0,0 +1,513 @@
+"""
+Batched writing of parsed trace links into Redis, either as they
+are parsed or in bulk from an offline link store, and tracking of
+how far through its input a parse has got.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import sys
+import time
+import Queue
+import threading
+
+import inettopology_popmap.memstore as memstore
+import inettopology_popmap.metrics as metrics
+import inettopology_popmap.data.dbkeys as dbkeys
+import inettopology_popmap.data.delays as delays
+import inettopology_popmap.data.tracefile as tracefile
+
+LINKS_WRITTEN = dict(
+    (kind, metrics.Counter('popmap_links_written_total',
+                           'Links written to the database',
+                           labels={'kind': kind}))
+    for kind in ('new', 'existing'))
+LINK_WRITE_SECONDS = metrics.Histogram(
+    'popmap_link_write_seconds',
+    'Time taken to write a batch of links to the database')
+WRITES_IN_FLIGHT = metrics.Gauge(
+    'popmap_writes_in_flight',
+    'Batches of links being written or queued to be written')
+
+
+def _count_written(links, new_links):
+  LINKS_WRITTEN['new'].inc(new_links)
+  LINKS_WRITTEN['existing'].inc(links - new_links)
+
+
+# Store a batch of links in one call.
+#
+# KEYS[1] is the unassigned link queue, followed by ARGV[1] link delay
+# keys; if there are no links the queue is left out too. If ARGV[2] is
+# "1", the next key is the hash of the traces a parse has written (see
+# ParseCheckpoint.written_key). Any further keys are the set of known
+# IPs, and then the key of the record (see dbkeys.ip_key) of each IP
+# that needs its ASN recorded.
+#
+# ARGV[3 .. ARGV[1] + 2] are the delay histogram buckets for each
+# link (see data.delays). If ARGV[2] is "1", they're followed by the
+# offsets of the first and last traces the links came from. Then
+# there's an (iplist member, field, asn) triple for each of the
+# record keys, where the member is empty if the IP layout has no
+# iplist.
+#
+# Returns the number of links which hadn't been seen before.
+PUSH_LINKS_LUA = """
+  local n = tonumber(ARGV[1])
+  local new = 0
+  for i = 1, n do
+    local key = KEYS[i + 1]
+    if redis.call("EXISTS", key) == 0 then
+      redis.call("LPUSH", KEYS[1], key)
+      new = new + 1
+    end
+    redis.call("HINCRBY", key, ARGV[i + 2], 1)
+  end
+  local iplist = n > 0 and n + 2 or 1
+  local arg = n + 3
+  if ARGV[2] == "1" then
+    local last = redis.call("HGET", KEYS[iplist], ARGV[arg])
+    if not last or tonumber(last) < tonumber(ARGV[arg + 1]) then
+      redis.call("HSET", KEYS[iplist], ARGV[arg], ARGV[arg + 1])
+    end
+    iplist = iplist + 1
+    arg = arg + 2
+  end
+  for i = iplist + 1, #KEYS do
+    if ARGV[arg] ~= "" then
+      redis.call("SADD", KEYS[iplist], ARGV[arg])
+    end
+    redis.call("HSET", KEYS[i], ARGV[arg + 1], ARGV[arg + 2])
+    arg = arg + 3
+  end
+  return new
+"""
+
+
+@memstore.native_script(PUSH_LINKS_LUA)
+def _push_links_native(r, keys, args):
+  n = int(args[0])
+  new = 0
+  for i in xrange(n):
+    key = keys[i + 1]
+    if not r.exists(key):
+      r.lpush(keys[0], key)
+      new += 1
+    r.hincrby(key, args[i + 2], 1)
+  iplist = n + 1 if n > 0 else 0
+  arg = n + 2
+  if str(args[1]) == '1':
+    last = r.hget(keys[iplist], args[arg])
+    if last is None or int(last) < int(args[arg + 1]):
+      r.hset(keys[iplist], args[arg], args[arg + 1])
+    iplist += 1
+    arg += 2
+  for key in keys[iplist + 1:]:
+    if args[arg] != '':
+      r.sadd(keys[iplist], args[arg])
+    r.hset(key, args[arg + 1], args[arg + 2])
+    arg += 3
+  return new
+
+
+def push_links_calls(links, ip_asns, checkpoint=None, traces=None):
+  """ Return a list of the (keys, args) for the PUSH_LINKS_LUA calls
+  which store :links: (tuples starting (ip1, ip2, delay)) and record
+  the ASN of each IP in :ip_asns: (a list of (ip, asn) pairs). If a
+  ParseCheckpoint :checkpoint: is given, each call also records that
+  the links of the traces ending at the offsets :traces: (first,
+  last) are written to its partition.
+
+  That's a single call unless links are partitioned (see dbkeys),
+  when each call only touches keys on one shard: one per partition
+  with links in the batch, and one for the IP records.
+  """
+  batches = dict()
+  for link in links:
+    ip1, ip2 = sorted(link[:2])
+    batches.setdefault(dbkeys.link_partition(ip1, ip2), []).append(link)
+
+  calls = []
+  for partition, batch in sorted(batches.iteritems()):
+    keys = [dbkeys.Link.unassigned(partition)]
+    keys.extend(dbkeys.delay_key(link[0], link[1]) for link in batch)
+    args = [len(batch), 0 if checkpoint is None else 1]
+    args.extend(delays.bucket(link[2]) for link in batch)
+    if checkpoint is not None:
+      keys.append(checkpoint.written_key(partition))
+      args.extend(traces)
+    calls.append((keys, args))
+
+  if len(ip_asns) > 0:
+    if batches.keys() == [None]:
+      keys, args = calls[0]
+    else:
+      keys, args = [], [0, 0]
+      calls.append((keys, args))
+    keys.append('iplist')
+    keys.extend(dbkeys.ip_key(ip) for ip, asn in ip_asns)
+    for ip, asn in ip_asns:
+      args.extend((dbkeys.iplist_member(ip) or '',
+                   dbkeys.ip_field(ip, 'asn'), asn))
+  return calls
+
+
+class WriteQueue(object):
+  """ Runs writes (functions taking no arguments) on :threads:
+  background threads, so that up to that many can be waiting on
+  Redis at once while the caller gets on with parsing.
+
+  At most :threads: more writes can be queued behind those. After
+  that submit() blocks until one finishes, so when Redis slows down
+  the parse slows with it rather than piling batches up in memory.
+  An error raised by a write is raised again by the next call to
+  submit(), wait() or close().
+  """
+
+  def __init__(self, threads):
+    self._queue = Queue.Queue(maxsize=threads)
+    self._error = None
+    self._threads = [threading.Thread(target=self._run)
+                     for i in xrange(threads)]
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def _run(self):
+    while True:
+      write = self._queue.get()
+      try:
+        if write is None:
+          return
+        if self._error is None:
+          write()
+      except Exception:
+        self._error = sys.exc_info()
+      finally:
+        self._queue.task_done()
+
+  def _raise_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error[0], error[1], error[2]
+
+  def submit(self, write):
+    self._raise_error()
+    self._queue.put(write)
+
+  def wait(self):
+    """ Wait until every write submitted so far has finished """
+    self._queue.join()
+    self._raise_error()
+
+  def close(self):
+    self.wait()
+    for thread in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+
+
+class LinkWriter(object):
+  """ Gathers the links from many traces and writes them to
+  Redis with a single script call (one per partition when links
+  are partitioned) once :batch_size: links have been collected, or
+  :max_delay: seconds have passed since the first link in the batch
+  was added.
+
+  If :seen_ips: (a cache.BoundedCache keyed by integer address) is
+  given, the ASN of an IP is only written the first time the IP is
+  seen while it remains in the cache.
+
+  With :pipelines: above one, batches are written by a WriteQueue
+  with that many threads, so that many can be in flight at once.
+  Call wait() before relying on everything flushed being in Redis.
+
+  If a ParseCheckpoint :checkpoint: is given, each batch records
+  which traces it holds the links of in the same call as it writes
+  them, and links from the traces in :written: (as returned by
+  ParseCheckpoint.load_written) are dropped, since an earlier run
+  wrote them after its last checkpoint. Delays are counted once per
+  observation, so writing them again would count them twice.
+  """
+
+  def __init__(self, r, geoipdb, batch_size=1000, max_delay=1.0,
+               seen_ips=None, pipelines=1, checkpoint=None, written=None):
+    self.r = r
+    self.geoipdb = geoipdb
+    self.batch_size = batch_size
+    self.max_delay = max_delay
+    self.seen_ips = seen_ips
+    self.checkpoint = checkpoint
+    self.written = written or None
+    self._push_links = r.register_script(PUSH_LINKS_LUA)
+    self._writes = WriteQueue(pipelines) if pipelines > 1 else None
+    self._lock = threading.Lock()
+
+    self._links = []
+    self._ips = dict()
+    self._batch_started = None
+    self._traces = None
+
+    self.links_written = 0
+    self.links_rewrites_avoided = 0
+    self.new_links = 0
+    self.flushes = 0
+    self.ip_writes = 0
+    self.ip_writes_avoided = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if exc_type is None:
+      self.close()
+
+  def add(self, links, offset=None):
+    """ Queue :links: (a list of (ip1, ip2, delay, ipnum1, ipnum2)
+    tuples, as returned by TraceParser.parse) for writing. :offset:
+    is where the trace they came from ends, which a checkpointed
+    writer needs.
+    """
+    if self._batch_started is None:
+      self._batch_started = time.time()
+
+    if self.checkpoint is not None:
+      first = offset if self._traces is None else self._traces[0]
+      self._traces = (first, offset)
+      if self.written is not None:
+        links = self._unwritten(links, offset)
+
+    for link in links:
+      if link[0] == link[1]:
+        raise Exception("Should not happen")
+      self._links.append(link)
+      self._ips[link[0]] = link[3]
+      self._ips[link[1]] = link[4]
+
+    if (len(self._links) >= self.batch_size
+            or time.time() - self._batch_started >= self.max_delay):
+      self.flush()
+
+  def _unwritten(self, links, offset):
+    """ Return those of :links:, from the trace ending at :offset:,
+    which an earlier run didn't write.
+    """
+    if offset > max(last for ranges in self.written.itervalues()
+                    for first, last in ranges):
+      # Past everything written before
+      self.written = None
+      return links
+
+    unwritten = []
+    for link in links:
+      ranges = self.written.get(dbkeys.link_partition(*sorted(link[:2])), ())
+      if any(first <= offset <= last for first, last in ranges):
+        self.links_rewrites_avoided += 1
+      else:
+        unwritten.append(link)
+    return unwritten
+
+  def flush(self):
+    if len(self._links) == 0:
+      return
+
+    if dbkeys.mutex_popjoin().is_locked():
+      log.debug("Waiting for popjoin lock")
+      dbkeys.mutex_popjoin().wait()
+
+    if self.seen_ips is None:
+      ips = self._ips.items()
+    else:
+      ips = [(ip, ipnum) for ip, ipnum in self._ips.iteritems()
+             if self.seen_ips.get(ipnum) is None]
+      self.ip_writes_avoided += len(self._ips) - len(ips)
+    asns = self.geoipdb.lookup_ipnums([ipnum for ip, ipnum in ips])
+    calls = push_links_calls(self._links,
+                             [(ip, asn) for (ip, ipnum), asn
+                              in zip(ips, asns)],
+                             checkpoint=self.checkpoint,
+                             traces=self._traces)
+
+    links = len(self._links)
+    if self._writes is None:
+      self._write(calls, links)
+    else:
+      WRITES_IN_FLIGHT.inc()
+      self._writes.submit(lambda: self._write(calls, links))
+    self.links_written += len(self._links)
+    self.ip_writes += len(ips)
+    self.flushes += 1
+
+    if self.seen_ips is not None:
+      for ip, ipnum in ips:
+        self.seen_ips.put(ipnum, True)
+
+    self._links = []
+    self._ips = dict()
+    self._batch_started = None
+    self._traces = None
+
+  def _write(self, calls, links):
+    try:
+      with LINK_WRITE_SECONDS.time():
+        if len(calls) == 1:
+          keys, args = calls[0]
+          new_links = self._push_links(keys=keys, args=args)
+        else:
+          pipe = self.r.pipeline(transaction=False)
+          for keys, args in calls:
+            self._push_links(keys=keys, args=args, client=pipe)
+          new_links = sum(pipe.execute())
+    finally:
+      if self._writes is not None:
+        WRITES_IN_FLIGHT.dec()
+    _count_written(links, new_links)
+    with self._lock:
+      self.new_links += new_links
+
+  def wait(self):
+    """ Wait for the batches already flushed to be written """
+    if self._writes is not None:
+      self._writes.wait()
+
+  def close(self):
+    self.flush()
+    if self._writes is not None:
+      self._writes.close()
+
+  def stats(self):
+    return {'links_written': self.links_written,
+            'links_rewrites_avoided': self.links_rewrites_avoided,
+            'new_links': self.new_links,
+            'flushes': self.flushes,
+            'ip_writes': self.ip_writes,
+            'ip_writes_avoided': self.ip_writes_avoided}
+
+
+class BulkLoader(object):
+  """ Loads batches of links which were parsed offline (see
+  data.linkstore) into Redis.
+
+  Each batch becomes one PUSH_LINKS_LUA call, or one per partition
+  when links are partitioned. Calls are queued on a non-transactional
+  pipeline and sent :window: batches at a time, so the load streams
+  without waiting on a reply for every batch.
+  """
+
+  def __init__(self, r, window=16):
+    self.r = r
+    self.window = window
+    self._push_links = r.register_script(PUSH_LINKS_LUA)
+    self._pipe = r.pipeline(transaction=False)
+    self._queued = 0
+    self._queued_links = 0
+
+    self.links_written = 0
+    self.new_links = 0
+    self.ip_writes = 0
+
+  def add(self, links, ip_asns):
+    for keys, args in push_links_calls(links, ip_asns):
+      self._push_links(keys=keys, args=args, client=self._pipe)
+    self._queued += 1
+    self._queued_links += len(links)
+    self.links_written += len(links)
+    self.ip_writes += len(ip_asns)
+    if self._queued >= self.window:
+      self.flush()
+
+  def flush(self):
+    if self._queued == 0:
+      return
+    if dbkeys.mutex_popjoin().is_locked():
+      log.debug("Waiting for popjoin lock")
+      dbkeys.mutex_popjoin().wait()
+    with LINK_WRITE_SECONDS.time():
+      new_links = sum(self._pipe.execute())
+    _count_written(self._queued_links, new_links)
+    self.new_links += new_links
+    self._queued = 0
+    self._queued_links = 0
+
+
+class ParseCheckpoint(object):
+  """ Records how far the parse of the shard of :path: starting at
+  :start: has got, so that an interrupted parse can pick up where it
+  left off. Checkpoints are keyed on the content of the file as well
+  as the shard, so a file which has changed is parsed from scratch.
+
+  A checkpoint should only be saved once everything before its
+  offset has been written. Save only when due(), at most once every
+  :interval: seconds, except for the final save.
+
+  Between checkpoints, a LinkWriter records which traces it has
+  written the links of, for each partition, in the same calls as it
+  writes them (see written_key). A resumed parse reads those back
+  with load_written, so that it doesn't count the delays of the
+  traces since the checkpoint twice.
+  """
+
+  def __init__(self, r, path, start, interval=30.0):
+    self.r = r
+    self.path = path
+    self.start = start
+    self.interval = interval
+    self.content_id = tracefile.content_id(path)
+    self.key = dbkeys.Checkpoint.parse(self.content_id, start)
+    self._last_saved = time.time()
+
+  def written_key(self, partition=None):
+    """ The hash mapping the offset of the first trace in each batch
+    written to :partition: to the offset of its last.
+    """
+    return dbkeys.Checkpoint.written(self.content_id, self.start, partition)
+
+  def load_written(self):
+    """ Return a dict mapping each partition to the (first, last)
+    offsets of the batches of traces written to it since the last
+    checkpoint, leaving out partitions with none.
+    """
+    partitions = dbkeys.partitions()
+    p = self.r.pipeline(transaction=False)
+    for partition in partitions:
+      p.hgetall(self.written_key(partition))
+    written = dict()
+    for partition, ranges in zip(partitions, p.execute()):
+      if ranges:
+        written[partition] = [(int(first), int(last))
+                              for first, last in ranges.iteritems()]
+    return written
+
+  def clear(self):
+    """ Forget about any earlier parse of this shard """
+    self.r.delete(self.key, *map(self.written_key, dbkeys.partitions()))
+
+  def load(self):
+    """ Return (offset, traces parsed, finished) for the
+    last saved checkpoint, or None if there isn't one.
+    """
+    saved = self.r.hgetall(self.key)
+    if not saved:
+      return None
+    return (int(saved['offset']), int(saved['traces']),
+            saved.get('done') == '1')
+
+  def save(self, offset, traces, done=False):
+    self.r.hmset(self.key, {'path': self.path,
+                            'offset': offset,
+                            'traces': traces,
+                            'done': 1 if done else 0,
+                            'updated': int(time.time())})
+    self._last_saved = time.time()
+
+    # Batches before the checkpoint won't be parsed again. Those of
+    # an earlier run which got further still might be.
+    for partition, ranges in self.load_written().iteritems():
+      finished = [first for first, last in ranges if last <= offset]
+      if finished:
+        self.r.hdel(self.written_key(partition), *finished)
+
+  def due(self):
+    """ Return True unless a checkpoint was saved recently. """
+    return time.time() - self._last_saved >= self.interval
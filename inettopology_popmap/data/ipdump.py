@@ -0,0 +1,172 @@
+"""
+Building the list of unique IPs seen in a set of traces without
+holding them all in memory, for 'process dump_ips'.
+
+Each parse worker gathers the addresses it sees into a set of at most
+a run's worth of entries. When the set fills up it's sorted and
+written to disk as a run: a file of packed 32-bit addresses. Once
+every trace has been parsed the runs are merged (several passes of
+at most MERGE_WIDTH runs at a time, if there are many) into one
+sorted list with the duplicates removed.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import glob
+import heapq
+import array
+import socket
+import struct
+import tempfile
+
+from inettopology_popmap.data.geoip import UINT32
+
+RUN_SUFFIX = '.run'
+MERGE_WIDTH = 64
+READ_ENTRIES = 65536
+RESOLVE_BATCH = 10000
+
+_pack_ip = struct.Struct('!I').pack
+
+
+def _dotted(ipnum):
+  return socket.inet_ntoa(_pack_ip(ipnum))
+
+
+def write_run(directory, ipnums):
+  """ Write the sorted run of the integer addresses :ipnums: to a
+  new file in :directory:.
+
+  :returns: the path of the run
+  """
+  fd, path = tempfile.mkstemp(suffix=RUN_SUFFIX, dir=directory)
+  with os.fdopen(fd, 'wb') as fh:
+    array.array(UINT32, sorted(ipnums)).tofile(fh)
+  return path
+
+
+def read_run(path):
+  """ Yield the addresses in the run at :path:, in order """
+  with open(path, 'rb') as fh:
+    while True:
+      chunk = array.array(UINT32)
+      try:
+        chunk.fromfile(fh, READ_ENTRIES)
+      except EOFError:
+        pass  # The rest of the file is in chunk
+      if len(chunk) == 0:
+        return
+      for ipnum in chunk:
+        yield ipnum
+
+
+def unique(ipnums):
+  """ Drop repeated values from the sorted iterable :ipnums: """
+  last = None
+  for ipnum in ipnums:
+    if ipnum != last:
+      yield ipnum
+      last = ipnum
+
+
+def merge_runs(runs, directory, width=MERGE_WIDTH):
+  """ Yield the unique addresses in all of :runs:, in order.
+  While there are more than :width: runs, groups of them are merged
+  into new runs in :directory: first, so no more than :width: files
+  are ever open at once.
+  """
+  runs = list(runs)
+  while len(runs) > width:
+    merged = []
+    for i in xrange(0, len(runs), width):
+      group = runs[i:i + width]
+      fd, path = tempfile.mkstemp(suffix=RUN_SUFFIX, dir=directory)
+      with os.fdopen(fd, 'wb') as fh:
+        out = array.array(UINT32)
+        for ipnum in unique(heapq.merge(*map(read_run, group))):
+          out.append(ipnum)
+          if len(out) >= READ_ENTRIES:
+            out.tofile(fh)
+            out = array.array(UINT32)
+        out.tofile(fh)
+      for run in group:
+        os.remove(run)
+      merged.append(path)
+    log.info("Merged {0} runs into {1}".format(len(runs), len(merged)))
+    runs = merged
+
+  return unique(heapq.merge(*map(read_run, runs)))
+
+
+def find_runs(directory):
+  return sorted(glob.glob(os.path.join(directory, '*' + RUN_SUFFIX)))
+
+
+def write_ips(ipnums, output, resolved=None, geoipdb=None):
+  """ Write each of the addresses :ipnums: to the file object
+  :output:, one dotted quad per line. If :resolved: is given, also
+  write a tab separated line with each address, its ASN and its
+  country (looked up in :geoipdb:) to it.
+
+  :returns: the number of addresses written
+  """
+  count = 0
+  batch = []
+  for ipnum in ipnums:
+    batch.append(ipnum)
+    if len(batch) >= RESOLVE_BATCH:
+      count += _write_batch(batch, output, resolved, geoipdb)
+      batch = []
+  count += _write_batch(batch, output, resolved, geoipdb)
+  return count
+
+
+def _write_batch(ipnums, output, resolved, geoipdb):
+  ips = map(_dotted, ipnums)
+  output.writelines(ip + "\n" for ip in ips)
+  if resolved is not None:
+    asns = geoipdb.lookup_ipnums(ipnums)
+    ccs = geoipdb.lookup_country_ipnums(ipnums)
+    for ip, asn, cc in zip(ips, asns, ccs):
+      resolved.write(u"{0}\t{1}\t{2}\n".format(ip, asn, cc).encode('utf-8'))
+  return len(ipnums)
+
+
+class RunWriter(object):
+  """ A stand-in for ingest.LinkWriter which collects the addresses
+  at either end of each link, writing them to a new run in
+  :directory: whenever :run_size: distinct ones have been collected.
+  """
+
+  def __init__(self, directory, run_size=1000000):
+    self.directory = directory
+    self.run_size = run_size
+    self._ipnums = set()
+
+    self.runs = []
+    self.ips_written = 0
+    self.flushes = 0
+
+  def add(self, links, offset=None):
+    for link in links:
+      self._ipnums.add(link[3])
+      self._ipnums.add(link[4])
+
+    if len(self._ipnums) >= self.run_size:
+      self.flush()
+
+  def flush(self):
+    if len(self._ipnums) == 0:
+      return
+    self.runs.append(write_run(self.directory, self._ipnums))
+    self.ips_written += len(self._ipnums)
+    self.flushes += 1
+    self._ipnums = set()
+
+  def close(self):
+    self.flush()
+
+  def stats(self):
+    return {'ips_written': self.ips_written,
+            'runs': self.flushes}
@@ -0,0 +1,203 @@
+"""
+A compact on-disk store for parsed links, so that traces can be
+parsed on machines without access to Redis and loaded later with
+'process bulkload'.
+
+A store is a directory of segment files, one per parsed shard. Each
+segment is an append-only sequence of marshalled chunks. A chunk
+holds a batch of links as parallel arrays (two 32-bit address arrays
+and an array of delays) plus the ASN of every address in the batch
+that hadn't been seen before. Segments are written under a temporary
+name and renamed once complete, so a store only ever contains whole
+segments.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import glob
+import array
+import hashlib
+import marshal
+import socket
+import struct
+
+from inettopology_popmap.data.geoip import UINT32
+from inettopology_popmap.data.tracefile import STDIN
+
+MAGIC = 'popmap-links'
+VERSION = 1
+SUFFIX = '.seg'
+
+_pack_ip = struct.Struct('!I').pack
+
+
+def _dotted(ipnum):
+  return socket.inet_ntoa(_pack_ip(ipnum))
+
+
+def segment_name(path, start):
+  """ The name of the segment holding the shard of :path: which
+  begins at :start:. Files with the same name in different
+  directories are told apart by a hash of their full path.
+  """
+  if path == STDIN:
+    name = "stdin-{0}-{1}".format(socket.gethostname(), os.getpid())
+  else:
+    path_hash = hashlib.sha1(os.path.abspath(path)).hexdigest()[:8]
+    name = "{0}-{1}".format(os.path.basename(path), path_hash)
+  return "{0}-{1}{2}".format(name, start, SUFFIX)
+
+
+def find_segments(paths):
+  """ Expand :paths: (segment files or store directories) into a
+  sorted list of segment files.
+  """
+  segments = []
+  for path in paths:
+    if os.path.isdir(path):
+      segments.extend(sorted(glob.glob(os.path.join(path, '*' + SUFFIX))))
+    else:
+      segments.append(path)
+  return segments
+
+
+class SegmentWriter(object):
+  """ Appends chunks of links to a new segment at :path:. """
+
+  def __init__(self, path):
+    self.path = path
+    self._tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    self._fh = open(self._tmp_path, 'wb')
+    marshal.dump((MAGIC, VERSION), self._fh)
+
+  def write(self, links, ip_asns):
+    """ Append a chunk.
+
+    :links: list of (ip1, ip2, delay, ipnum1, ipnum2) tuples
+    :ip_asns: list of (ipnum, asn) pairs
+    """
+    ipnums1 = array.array(UINT32, [link[3] for link in links])
+    ipnums2 = array.array(UINT32, [link[4] for link in links])
+    delays = array.array('d', [link[2] for link in links])
+
+    labels = []
+    label_ids = dict()
+    index = array.array(UINT32)
+    for ipnum, asn in ip_asns:
+      if asn not in label_ids:
+        label_ids[asn] = len(labels)
+        labels.append(asn)
+      index.append(label_ids[asn])
+    ipnums = array.array(UINT32, [ipnum for ipnum, asn in ip_asns])
+
+    marshal.dump((ipnums1.tostring(), ipnums2.tostring(), delays.tostring(),
+                  ipnums.tostring(), index.tostring(), labels), self._fh)
+
+  def close(self):
+    self._fh.close()
+    os.rename(self._tmp_path, self.path)
+
+
+def read_segment(path):
+  """ Yield each chunk of the segment at :path: as a tuple
+  (links, ip_asns), where :links: is a list of (ip1, ip2, delay)
+  and :ip_asns: a list of (ip, asn).
+  """
+  with open(path, 'rb') as fh:
+    try:
+      header = marshal.load(fh)
+    except (EOFError, ValueError, TypeError):
+      header = None
+    if header != (MAGIC, VERSION):
+      raise IOError("{0} is not a version {1} link segment"
+                    .format(path, VERSION))
+
+    while True:
+      try:
+        chunk = marshal.load(fh)
+      except EOFError:
+        return
+      ipnums1, ipnums2, delays, ipnums, index, labels = chunk
+
+      arrays = []
+      for typecode, data in ((UINT32, ipnums1), (UINT32, ipnums2),
+                             ('d', delays), (UINT32, ipnums),
+                             (UINT32, index)):
+        arr = array.array(typecode)
+        arr.fromstring(data)
+        arrays.append(arr)
+      ipnums1, ipnums2, delays, ipnums, index = arrays
+
+      links = [(_dotted(a), _dotted(b), delay)
+               for a, b, delay in zip(ipnums1, ipnums2, delays)]
+      ip_asns = [(_dotted(ipnum), labels[i])
+                 for ipnum, i in zip(ipnums, index)]
+      yield links, ip_asns
+
+
+class OfflineLinkWriter(object):
+  """ A stand-in for ingest.LinkWriter which writes batches of links
+  to a segment at :path: instead of to Redis.
+
+  Like LinkWriter, if :seen_ips: is given the ASN of an IP is only
+  stored the first time it's seen while it remains in the cache. A
+  worker shares the cache between the segments it writes, so a
+  segment can leave out ASNs which an earlier one holds.
+  """
+
+  def __init__(self, path, geoipdb, batch_size=1000, seen_ips=None):
+    self.segment = SegmentWriter(path)
+    self.geoipdb = geoipdb
+    self.batch_size = batch_size
+    self.seen_ips = seen_ips
+
+    self._links = []
+    self._ips = dict()
+
+    self.links_written = 0
+    self.flushes = 0
+    self.ip_writes = 0
+    self.ip_writes_avoided = 0
+
+  def add(self, links, offset=None):
+    for link in links:
+      self._links.append(link)
+      self._ips[link[0]] = link[3]
+      self._ips[link[1]] = link[4]
+
+    if len(self._links) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    if len(self._links) == 0:
+      return
+
+    if self.seen_ips is None:
+      ipnums = self._ips.values()
+    else:
+      ipnums = [ipnum for ipnum in self._ips.itervalues()
+                if self.seen_ips.get(ipnum) is None]
+      self.ip_writes_avoided += len(self._ips) - len(ipnums)
+      for ipnum in ipnums:
+        self.seen_ips.put(ipnum, True)
+
+    asns = self.geoipdb.lookup_ipnums(ipnums)
+    self.segment.write(self._links, zip(ipnums, asns))
+    self.links_written += len(self._links)
+    self.ip_writes += len(ipnums)
+    self.flushes += 1
+
+    self._links = []
+    self._ips = dict()
+
+  def close(self):
+    self.flush()
+    self.segment.close()
+
+  def stats(self):
+    return {'links_written': self.links_written,
+            'new_links': 0,
+            'flushes': self.flushes,
+            'ip_writes': self.ip_writes,
+            'ip_writes_avoided': self.ip_writes_avoided}
@@ -3,8 +3,103 @@ Author: Chris Wacek
 Email: cwacek@cs.georgetown.edu
 Date: 02/22/202
 """
-import re
+import bisect
+import socket
+import struct
 import inettopology.util as util
+import inettopology_popmap.data.dbkeys as dbkeys
+
+# Address ranges (first, last) that can't be a router on a public
+# path: 'this' network, private, shared (carrier-grade NAT), loopback,
+# link-local, and multicast plus the reserved space above it.
+RESERVED_RANGES = (
+    (0x00000000, 0x00FFFFFF),  # 0.0.0.0/8
+    (0x0A000000, 0x0AFFFFFF),  # 10.0.0.0/8
+    (0x64400000, 0x647FFFFF),  # 100.64.0.0/10
+    (0x7F000000, 0x7FFFFFFF),  # 127.0.0.0/8
+    (0xA9FE0000, 0xA9FEFFFF),  # 169.254.0.0/16
+    (0xAC100000, 0xAC1FFFFF),  # 172.16.0.0/12
+    (0xC0A80000, 0xC0A8FFFF),  # 192.168.0.0/16
+    (0xE0000000, 0xFFFFFFFF),  # 224.0.0.0/3
+)
+_reserved_starts = [first for first, last in RESERVED_RANGES]
+_unpack_ip = struct.Struct('!I').unpack
+_inet_aton = socket.inet_aton
+
+_PUBLIC, _RESERVED, _PARTIAL = range(3)
+
+# A last hop slower than this (in ms) is dropped from a trace
+MAX_LAST_DELAY = 800
+
+
+def _classify_first_octets():
+  """ Return a tuple saying, for each possible first octet, whether
+  none, all or only some of the addresses starting with it fall in
+  the RESERVED_RANGES.
+  """
+  table = []
+  for octet in xrange(256):
+    first, last = octet << 24, (octet << 24) | 0xFFFFFF
+    overlaps = [(max(lo, first), min(hi, last))
+                for lo, hi in RESERVED_RANGES
+                if lo <= last and hi >= first]
+    if len(overlaps) == 0:
+      table.append(_PUBLIC)
+    elif (first, last) in overlaps:
+      table.append(_RESERVED)
+    else:
+      table.append(_PARTIAL)
+  return tuple(table)
+
+_first_octet = _classify_first_octets()
+
+
+def ip_to_int(ip):
+  """ Return the dotted quad :ip: as a 32-bit integer, or
+  None if it isn't a dotted quad.
+  """
+  if ip.count('.') != 3:
+    return None
+  try:
+    return _unpack_ip(_inet_aton(ip))[0]
+  except socket.error:
+    return None
+
+
+def is_reserved(ipnum):
+  """ Return True if the integer address :ipnum: lies in one
+  of the RESERVED_RANGES.
+  """
+  i = bisect.bisect_right(_reserved_starts, ipnum) - 1
+  return i >= 0 and ipnum <= RESERVED_RANGES[i][1]
+
+
+def is_public(ipnum):
+  """ Return True unless the integer address :ipnum: is reserved. """
+  kind = _first_octet[ipnum >> 24]
+  return kind == _PUBLIC or (kind == _PARTIAL and not is_reserved(ipnum))
+
+
+def public_ipnum(ip):
+  """ Return the dotted quad :ip: as a 32-bit integer if it's a
+  public address, or None if it's reserved or not an address.
+
+  This runs for every hop of every trace, so most addresses are
+  settled by a single table lookup on their first octet.
+  """
+  if ip.count('.') != 3:
+    return None
+  try:
+    ipnum = _unpack_ip(_inet_aton(ip))[0]
+  except socket.error:
+    return None
+
+  kind = _first_octet[ipnum >> 24]
+  if kind == _PUBLIC:
+    return ipnum
+  if kind == _RESERVED or is_reserved(ipnum):
+    return None
+  return ipnum
 
 
 class ParseError(Exception):
@@ -17,24 +112,51 @@ class EmptyTraceError(ParseError):
 
 class TraceParser(object):
 
-  ipregex = re.compile("[1-9][0-9]{0,2}(\.[0-9]{1,3}){3}")
-  privateipregex = re.compile("(^127\.0\.0\.1)|(^192\.168)|(^10\.)|(^172\.1[6-9])|(^172\.2[0-9])|(^172\.3[0-1])")
+  @classmethod
+  def parse(cls, tracefields):
+    """ Parse a trace given as a list of tokenized lines
+    (like the traces yielded by tracefile.read_traces).
+    """
+    return cls.parsepairs(cls.hops_from_fields(tracefields))
+
+  @classmethod
+  def parse_hops(cls, hops):
+    """ Parse a trace given as a list of [ip, delay, ipnum] hops,
+    the first of which is the source (like the traces yielded by
+    warts.read_traces).
+    """
+    return cls.parsepairs(cls.public_hops(hops))
 
   @classmethod
-  def parse(cls, tracelines):
-    if len(tracelines) == 0:
+  def hops_from_fields(cls, tracefields):
+    """ Return the hops of a trace given as a list of tokenized
+    lines, ready for parsepairs (or a tracebatch.TraceBatch).
+    """
+    if len(tracefields) == 0:
       raise EmptyTraceError("No lines to trace")
-    raw = cls.transform_raw_data(tracelines)
-    return cls.parsepairs(raw)
+    return cls.transform_raw_data(tracefields)
+
+  @classmethod
+  def public_hops(cls, hops):
+    """ Return the hops with public addresses out of a list of
+    [ip, delay, ipnum] hops, ready for parsepairs (or a
+    tracebatch.TraceBatch).
+    """
+    if len(hops) == 0:
+      raise EmptyTraceError("No hops in trace")
+    if not is_public(hops[0][2]):
+      raise ParseError("Invalid source IP for trace: {0}"
+                       .format(hops[0][0]))
+    return [hop for hop in hops if is_public(hop[2])]
 
   @classmethod
   def ip_is_valid(cls, ip):
-    if cls.privateipregex.match(ip) or not cls.ipregex.match(ip):
-      return False
-    return True
+    return cls.ipnum(ip) is not None
+
+  ipnum = staticmethod(public_ipnum)
 
   @classmethod
-  def transform_raw_data(cls, tracelines):
+  def transform_raw_data(cls, tracefields):
     """
     Transform a raw trace of the form:
 
@@ -44,29 +166,29 @@ class TraceParser(object):
     # 3  192.245.179.52  0.290 ms
     # 4  192.245.179.166  0.318 ms
 
-    into a list of tuples of the form (ip, total_delay).
+    which has already been split into a list of fields per line,
+    into a list of the form [ip, total_delay, ip as an integer].
     """
     transformed = []
-    for i, line in enumerate(tracelines):
-      fields = line.split()
+    ipnum_of = public_ipnum
+    for i, fields in enumerate(tracefields):
       if i == 0:
-        try:
-          if not cls.ip_is_valid(fields[2]):
-            raise ParseError("Invalid IP in first line of trace: [{0}]"
-                             .format(line))
-          transformed.append([fields[2], 0.0])
-        except IndexError:
-          if cls.privateipregex.match(fields[2]):
-            continue
-          raise ParseError("No IP found on first line of trace: [%s]"
-                           .format(line))
+        if len(fields) < 3:
+          raise ParseError("No IP found on first line of trace: [{0}]"
+                           .format(" ".join(fields)))
+        ipnum = ipnum_of(fields[2])
+        if ipnum is None:
+          raise ParseError("Invalid IP in first line of trace: [{0}]"
+                           .format(" ".join(fields)))
+        transformed.append([fields[2], 0.0, ipnum])
 
       else:
         try:
-          if not cls.ip_is_valid(fields[1]):
+          ipnum = ipnum_of(fields[1])
+          if ipnum is None:
             raise ParseError()
-          transformed.append([fields[1], float(fields[2])])
-        except (IndexError, ParseError):
+          transformed.append([fields[1], float(fields[2]), ipnum])
+        except (IndexError, ValueError, ParseError):
           """ If we encounter errors here, it's probably because there are *
           fields.  Our response to those will simply be to skip them - if we
           know the absolute distance, then the link 'exists'. """
@@ -80,9 +202,11 @@ class TraceParser(object):
     Parse the raw data belonging to this instance and turn
     them into pairs of IP addresses with a corresponding delay.
 
+    Each pair is a tuple of (ip1, ip2, delay, ip1 as an integer,
+    ip2 as an integer).
     """
     removed = None
-    if rawdata[-1][1] > 800:
+    if rawdata[-1][1] > MAX_LAST_DELAY:
       removed = rawdata[-1]
       rawdata = rawdata[:-1]
 
@@ -90,12 +214,13 @@ class TraceParser(object):
 
     pairs = []
 
-    for latest, previous in util.pairwise(reversed(rawdata)):
+    for previous, latest in util.pairwise(rawdata):
       dist = round(latest[1] - previous[1], 3)
-			if dist == 0.0:
-				dist = 1.0 
-      if previous[0] != latest[0]:
-        pairs.insert(0, (previous[0], latest[0], dist))
+      if dist == 0.0:
+        dist = 1.0
+      if previous[2] != latest[2]:
+        pairs.append((previous[0], latest[0], dist,
+                      previous[2], latest[2]))
 
     return (pairs, removed)
 
@@ -119,7 +244,7 @@ class TraceParser(object):
 
 def different_as(r, ip1, ip2, ignore=False):
     """
-    Return True if r().hget(ip1,'asn') != r().hget(ip2,'asn').
+    Return True if the ASNs recorded for ip1 and ip2 differ.
     Else False
     Return None if either side of the link has "N/A" for it's
     ASN
@@ -127,8 +252,8 @@ def different_as(r, ip1, ip2, ignore=False):
     if ignore:
         return False
 
-    ip1_asn = r.hget(ip1, 'asn')
-    ip2_asn = r.hget(ip2, 'asn')
+    ip1_asn = dbkeys.get_asn(ip1, pipe=r)
+    ip2_asn = dbkeys.get_asn(ip2, pipe=r)
 
     if not ip1_asn or not ip2_asn:
       return None
@@ -143,6 +268,4 @@ def different_24(ip1, ip2, ignore=False):
     """
     if ignore:
         return False
-    ip1_24 = ip1.split('.')[3]
-    ip2_24 = ip2.split('.')[3]
-    return True if ip1_24 != ip2_24 else False
+    return ip1.rsplit('.', 1)[0] != ip2.rsplit('.', 1)[0]
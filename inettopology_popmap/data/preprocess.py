@@ -6,24 +6,52 @@ log = logging.getLogger(__name__)
 from inettopology import SilentExit
 import inettopology_popmap.connection as connection
 import inettopology_popmap.data.dbkeys as dbkeys
+import inettopology_popmap.data.geoip as geoip
+import inettopology_popmap.data.cache as cache
 import inettopology.util.decorators
 
 
+_lookup_cache_config = {'megabytes': 16, 'path': None}
+
+
+def configure_lookup_cache(megabytes=16, path=None):
+  """ Configure the result cache used by the MaxMindGeoIPReader.
+  Must be called before the reader is first used.
+
+  :megabytes: The size of the cache
+  :path: A file to hold the cache, so that it's shared with other
+         processes using the same file and persists across runs. If
+         None, the cache is anonymous shared memory, which is shared
+         only with processes forked after it is created.
+  """
+  _lookup_cache_config.update(megabytes=megabytes, path=path)
+
+
 @inettopology.util.decorators.singleton
 class MaxMindGeoIPReader(object):
+  """ Looks up the ASN and country code of IP addresses using
+  the bundled MaxMind GeoIP databases, compiled into range tables
+  (see data.geoip).
+
+  Results are kept in a bounded cache shared between processes,
+  which is consulted first (see configure_lookup_cache).
+  """
 
   def __init__(self):
     try:
-      import pygeoip
       fname = pkg_resources.resource_filename('inettopology_popmap.resources',
                                               'GeoIPASNum.dat')
-      self.asn_db = pygeoip.GeoIP(fname, pygeoip.MEMORY_CACHE)
+      self.asn_db = geoip.load_table(fname)
 
       fname = pkg_resources.resource_filename('inettopology_popmap.resources',
                                               'GeoIP.dat')
-      self.cc_db = pygeoip.GeoIP(fname, pygeoip.MEMORY_CACHE)
+      self.cc_db = geoip.load_table(fname)
 
-      self._cache = dict()
+      self._cache = cache.SharedLookupCache(
+          _lookup_cache_config['megabytes'],
+          path=_lookup_cache_config['path'],
+          fingerprint=(self.asn_db.fingerprint() ^
+                       self.cc_db.fingerprint()))
 
     except IOError, e:
       raise Exception("Failed to open GeoIP database [{0}]".format(e))
@@ -31,20 +59,33 @@ class MaxMindGeoIPReader(object):
       raise Exception("IP Translation requires the pygeoip library: "
                       "'pip install pygeoip'")
 
-  def lookup_ips(self, ips):
-    result = list()
-    for ip in ips:
-      if ip not in self._cache:
-        self._cache[ip] = self.asn_db.org_by_addr(ip)
-      result.append(self._cache[ip])
+  def _label_ids(self, ipnum):
+    ids = self._cache.get(ipnum)
+    if ids is None:
+      ids = (self.asn_db.label_id(ipnum), self.cc_db.label_id(ipnum))
+      self._cache.put(ipnum, *ids)
+    return ids
 
-    return result
+  def lookup_ips(self, ips):
+    return self.lookup_ipnums(map(geoip.ip2long, ips))
 
   def lookup_country_codes(self, ips):
     if isinstance(ips, basestring):
-      return map(self.cc_db.country_code_by_addr, (ips,))
-    else:
-      return map(self.cc_db.country_code_by_addr, ips)
+      ips = (ips,)
+    return self.lookup_country_ipnums(map(geoip.ip2long, ips))
+
+  def lookup_ipnums(self, ipnums):
+    """ Return the ASNs for a batch of integer addresses """
+    labels = self.asn_db.labels
+    return [labels[self._label_ids(ipnum)[0]] for ipnum in ipnums]
+
+  def lookup_country_ipnums(self, ipnums):
+    """ Return the country codes for a batch of integer addresses """
+    labels = self.cc_db.labels
+    return [labels[self._label_ids(ipnum)[1]] for ipnum in ipnums]
+
+  def cache_stats(self):
+    return self._cache.stats()
 
 
 def load_attr_data(args):
@@ -70,8 +111,7 @@ def load_attr_data(args):
           if 'pop' in vals:
             del vals['pop']
 
-        r.hmset(dbkeys.ip_key(ip), vals)
-        r.sadd('iplist', ip)
+        dbkeys.set_ip_fields(ip, vals, pipe=r)
         if i % 10000 == 0:
           log.info("Set values for %d" % i)
 
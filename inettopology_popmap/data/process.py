@@ -1,120 +1,436 @@
 import logging
 log = logging.getLogger(__name__)
 
+import os
 import sys
+import time
+import shutil
+import signal
+import tempfile
 import itertools
+import collections
+import multiprocessing
 import redis
 redis_errors = (redis.ConnectionError,
                 redis.InvalidResponse,
                 redis.ResponseError)
 
 from inettopology import SilentExit
-from inettopology.util.decorators import timeit
 from inettopology.util.general import ProgressTimer, Color
 import inettopology.util.structures as structures
 import inettopology_popmap.data.dbkeys as dbkeys
-from inettopology_popmap.data.parsers import TraceParser, EmptyTraceError
-from inettopology_popmap.data.parsers import different_24, different_as
+import inettopology_popmap.data.tracefile as tracefile
+import inettopology_popmap.data.warts as warts
+import inettopology_popmap.data.linkstore as linkstore
+import inettopology_popmap.data.ipdump as ipdump
+import inettopology_popmap.data.delays as delays
+import inettopology_popmap.data.assign as assign
+import inettopology_popmap.data.cluster as cluster
+from inettopology_popmap.data.ingest import LinkWriter, ParseCheckpoint
+from inettopology_popmap.data.ingest import BulkLoader
+from inettopology_popmap.data.cache import BoundedCache
+from inettopology_popmap.data.parsers import TraceParser, ParseError
+from inettopology_popmap.data.parsers import EmptyTraceError
+from inettopology_popmap.data.tracebatch import TraceBatch, BATCH_TRACES
 import inettopology_popmap.data.preprocess as preprocess
 import inettopology_popmap.connection as connection
+import inettopology_popmap.metrics as metrics
 from inettopology_popmap.data import DataError
 
+TRACES_PARSED = metrics.Counter(
+    'popmap_traces_parsed_total', 'Traces read from trace files')
+TRACES_SKIPPED = metrics.Counter(
+    'popmap_traces_skipped_total', 'Traces skipped as empty or unparseable')
+JOINS_APPLIED = metrics.Counter(
+    'popmap_joins_applied_total', 'PoP joins processed')
+JOIN_ERRORS = metrics.Counter(
+    'popmap_join_errors_total', 'PoP joins which failed and were requeued')
+JOINS_PENDING = metrics.Gauge(
+    'popmap_joins_pending', 'PoP joins left to process')
+
+# Passes assign_pops makes over the links, the first over the
+# unassigned queues and the rest over any links which failed in the
+# pass before, waiting RETRY_BACKOFF seconds before the second and
+# twice as long before each one after it
+ASSIGN_ATTEMPTS = 3
+RETRY_BACKOFF = 5
+MONITOR_INTERVAL = 10
 
-class NoPopExistsError(Exception):
-  pass
 
+def parse(args):
 
-def print_unless_seen(text, seenset):
-  if text not in seenset:
-    print text
-    seenset.add(text)
+  # Configures the singleton used by the parse workers
+  r = connection.Redis(structures.ConnectionInfo(**args.redis))
+  to_redis = not args.offline and not args.dump
 
+  try:
+    if to_redis:
+      dbkeys.configure_link_partitions(r, connection.sharded(r))
+      delays.ensure_histogram_store(r, dbkeys.Link.queues())
+      dbkeys.configure_ip_layout(r, args.ip_layout)
+
+    # Load the GeoIP tables before any workers fork, so that
+    # they all share the parent's copy and lookup cache.
+    preprocess.configure_lookup_cache(args.geoip_cache_mb, args.geoip_cache)
+    preprocess.MaxMindGeoIPReader.Instance()
+
+    if args.offline and not os.path.isdir(args.offline):
+      os.makedirs(args.offline)
+    if args.dump:
+      args.run_dir = tempfile.mkdtemp(prefix='popmap-ips-', dir=args.tmpdir)
+
+    shards = []
+    for path in tracefile.expand_paths(args.trace):
+      if args.format == 'warts':
+        # Binary files can't be split at text headers, so each
+        # file is parsed whole by a single worker.
+        shards.append((path, 0, None))
+      else:
+        shards.extend(tracefile.find_shards(path,
+                                            args.shard_size * 1024 * 1024))
+    if to_redis and not args.resume and not args.force:
+      _check_not_parsed(r, shards)
+    if to_redis:
+      _check_shard_layout(r, shards, args)
+
+    workers = min(args.workers, len(shards))
+    if workers > 1 and to_redis and connection.in_process(r):
+      log.warn("Forked workers can't write to the memory backend. "
+               "Parsing with one worker.")
+      workers = 1
+    log.info("Parsing {0} shards with {1} workers"
+             .format(len(shards), workers))
+
+    started = time.time()
+    numtraces = 0
+    totals = collections.Counter()
+    if workers > 1:
+      pool = multiprocessing.Pool(processes=workers,
+                                  initializer=_init_parse_worker,
+                                  initargs=(args,))
+      try:
+        results = pool.imap_unordered(_parse_shard, shards)
+        while True:
+          try:
+            path, start, count, elapsed, stats = results.next(timeout=60)
+          except multiprocessing.TimeoutError:
+            continue
+          except StopIteration:
+            break
+          numtraces += _log_shard_rate(path, start, count, elapsed)
+          totals.update(stats)
+        pool.close()
+      except:
+        pool.terminate()
+        raise
+      finally:
+        pool.join()
+    else:
+      _init_parse_worker(args, worker=False)
+      for shard in shards:
+        path, start, count, elapsed, stats = _parse_shard(shard)
+        numtraces += _log_shard_rate(path, start, count, elapsed)
+        totals.update(stats)
+
+    elapsed = time.time() - started
+    log.info("Parsed {0} traces in {1:.1f} seconds [{2:.1f} traces/sec]"
+             .format(numtraces, elapsed, numtraces / max(elapsed, 1e-6)))
+    if not args.dump:
+      log.info("Wrote {0} links ({1} new). Wrote {2} IP records and "
+               "skipped {3} already known."
+               .format(totals['links_written'], totals['new_links'],
+                       totals['ip_writes'], totals['ip_writes_avoided']))
+    if totals['links_rewrites_avoided']:
+      log.info("Skipped {0} links which an interrupted run had already "
+               "written.".format(totals['links_rewrites_avoided']))
+    lookups = totals['geoip_hits'] + totals['geoip_misses']
+    log.info("GeoIP cache: {0} lookups, {1:.1%} hit rate, {2} evictions"
+             .format(lookups,
+                     float(totals['geoip_hits']) / max(lookups, 1),
+                     totals['geoip_evictions']))
+
+    if args.dump:
+      _write_ip_dump(args, totals)
 
-@timeit
-def load_link_pairs(newpairs, geoipdb=None):
-  global lua_push_unique
+  except IOError as e:
+    log.error("Error: {0}".format(e))
+    raise SilentExit()
+  except DataError as e:
+    log.error("Error: {0}".format(e))
+    raise SilentExit()
+  finally:
+    if getattr(args, 'run_dir', None) is not None:
+      shutil.rmtree(args.run_dir, ignore_errors=True)
 
-  r = connection.Redis()
 
-  if lua_push_unique is None:
-    lua_push_unique = r.register_script("""
-      local exists
-      exists = redis.call("EXISTS", KEYS[1])
-      if exists == 0 then
-        redis.call("LPUSH", "delayed_job:unassigned_links", KEYS[1])
-      end
-      redis.call("SADD", KEYS[1], ARGV[1])
-      return redis.status_reply("OK")
-    """)
+def _check_not_parsed(r, shards):
+  """ Make sure none of :shards: has been parsed into the database at
+  :r: before, even in part. Each parse adds to the delay counts of
+  the links it finds, so parsing a shard twice counts them twice.
 
-  with r.pipeline() as pipe:
+  :raises: DataError if one has
+  """
+  content_ids = dict()
+  parsed = []
+  for path, start, end in shards:
+    if path == tracefile.STDIN:
+      continue
+    if path not in content_ids:
+      content_ids[path] = tracefile.content_id(path)
+    if r.exists(dbkeys.Checkpoint.parse(content_ids[path], start)):
+      parsed.append("{0}@{1}".format(path, start))
+  if parsed:
+    raise DataError("Some of these traces have already been parsed into "
+                    "this database, at least in part ({0} of the shards, "
+                    "starting with {1}). "
+                    "Parsing them again would count their delays twice. "
+                    "Use --resume to finish them, or --force to parse "
+                    "them again anyway.".format(len(parsed), parsed[0]))
+
+
+def _check_shard_layout(r, shards, args):
+  """ Record how each file in :shards: was split up for the database
+  at :r:. Checkpoints are kept per shard, so with --resume the files
+  must be split just as they were before, or none of their
+  checkpoints would be found and they'd all be parsed again.
+
+  :raises: DataError if a file is split differently from the run
+  being resumed
+  """
+  starts = collections.OrderedDict()
+  for path, start, end in shards:
+    if path != tracefile.STDIN:
+      starts.setdefault(path, []).append(start)
+
+  for path, offsets in starts.iteritems():
+    key = dbkeys.Checkpoint.shards(tracefile.content_id(path))
+    layout = ",".join(map(str, offsets))
+    saved = r.hgetall(key)
+    if args.resume and saved and saved['starts'] != layout:
+      raise DataError("{0} was split into {1} shards when it was parsed "
+                      "before, with --shard_size {2}, but would now be "
+                      "split into {3}. Resume it with the same "
+                      "--shard_size.".format(
+                          path, len(saved['starts'].split(",")),
+                          saved['shard_size'], len(offsets)))
+    r.hmset(key, {'shard_size': args.shard_size, 'starts': layout})
+
+
+def _write_ip_dump(args, totals):
+  """ Merge the runs written by dump_ips workers into
+  the sorted list of unique IPs.
+  """
+  runs = ipdump.find_runs(args.run_dir)
+  log.info("Merging {0} runs of {1} IPs".format(len(runs),
+                                                totals['ips_written']))
+  started = time.time()
+  output = sys.stdout if args.output == '-' else open(args.output, 'w')
+  resolved = open(args.resolved, 'w') if args.resolved else None
+  try:
+    count = ipdump.write_ips(
+        ipdump.merge_runs(runs, args.run_dir, args.merge_width),
+        output, resolved, preprocess.MaxMindGeoIPReader.Instance())
+  finally:
+    if output is not sys.stdout:
+      output.close()
+    if resolved is not None:
+      resolved.close()
+  log.info("Wrote {0} unique IPs in {1:.1f} seconds"
+           .format(count, time.time() - started))
 
-    for link in newpairs:
-      if link[0] == link[1]:
-        raise Exception("Should not happen")
+_parse_args = None
+_seen_ips = None
 
-      lua_push_unique(
-          keys=[dbkeys.delay_key(link[0], link[1])],
-          args=[link[2]],
-          client=pipe)
 
-      pipe.sadd('iplist', *link[:2])
-      for ip, asn in itertools.izip(link, geoipdb.lookup_ips(link[:2])):
-        pipe.hmset(dbkeys.ip_key(ip), {'asn': asn})
+def _init_parse_worker(args, worker=True):
+  """ Set up a parse process, with a cache of the IPs whose ASNs it
+  has written shared by every shard it parses. Workers ignore SIGINT
+  so that the parent can shut the pool down cleanly.
+  """
+  global _parse_args, _seen_ips
+  _parse_args = args
+  _seen_ips = None
+  if not args.dump and args.seen_ip_mb > 0:
+    _seen_ips = BoundedCache.from_budget(args.seen_ip_mb)
+  if worker:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    pipe.execute()
 
-lua_push_unique = None
+def _log_shard_rate(path, start, count, elapsed):
+  log.info("Finished {0}@{1}: {2} traces [{3:.1f} traces/sec]"
+           .format(path, start, count, count / max(elapsed, 1e-6)))
+  return count
 
 
-def parse(args):
+def _parse_shard(shard):
+  """ Parse the traces contained in :shard:, a tuple
+  of (path, start, end) as produced by tracefile.find_shards.
 
-  # We don't use this, but it configures the singleton
-  connection.Redis(structures.ConnectionInfo(**args.redis))
+  :returns: (path, start, number of traces, seconds taken,
+             dict of writer statistics)
+  """
+  path, start, end = shard
+  args = _parse_args
+  aslookup = preprocess.MaxMindGeoIPReader.Instance()
+  geoip_stats = aslookup.cache_stats()
+  started = time.time()
+
+  numtraces = 0
+  writer = None
+  checkpoint = None
+  if args.dump:
+    writer = ipdump.RunWriter(args.run_dir, run_size=args.run_size)
+  elif args.offline:
+    segment = os.path.join(args.offline,
+                           linkstore.segment_name(path, start))
+    # Segments only appear once they're complete
+    if args.resume and os.path.exists(segment):
+      log.info("Skipping {0}@{1}: already parsed".format(path, start))
+      return (path, start, 0, time.time() - started, {})
+    writer = linkstore.OfflineLinkWriter(segment, aslookup,
+                                         batch_size=args.batch_size,
+                                         seen_ips=_seen_ips)
+  elif path != tracefile.STDIN:
+    checkpoint = ParseCheckpoint(connection.Redis(), path, start,
+                                 interval=args.checkpoint_interval)
+
+  # Traces parsed by earlier, interrupted runs
+  previous = 0
+  offset = start
+  written = None
+  if checkpoint is not None and not args.resume:
+    # Save one straight away, so that a run which dies before its
+    # first checkpoint can still be resumed (or refused by parse)
+    checkpoint.clear()
+    checkpoint.save(start, 0)
+  elif checkpoint is not None:
+    saved = checkpoint.load()
+    if saved is not None:
+      offset, previous, done = saved
+      if done:
+        log.info("Skipping {0}@{1}: already parsed".format(path, start))
+        return (path, start, 0, time.time() - started, {})
+      log.info("Resuming {0}@{1} at offset {2} ({3} traces already parsed)"
+               .format(path, start, offset, previous))
+      written = checkpoint.load_written()
+
+  if writer is None:
+    writer = LinkWriter(connection.Redis(), aslookup,
+                        batch_size=args.batch_size,
+                        max_delay=args.batch_timeout,
+                        seen_ips=_seen_ips,
+                        pipelines=args.write_pipelines,
+                        checkpoint=checkpoint, written=written)
+
+  if args.format == 'warts':
+    traces = warts.read_traces(path, offset)
+    trace_hops = TraceParser.public_hops
+  else:
+    traces = tracefile.read_traces(path, offset, end)
+    trace_hops = TraceParser.hops_from_fields
+
+  batch = TraceBatch()
+  batch_offsets = []
+  for offset, trace in traces:
+    numtraces += 1
+    if numtraces % 1000 == 0:
+      TRACES_PARSED.inc(1000)
+      log.info("\r\x1b[K" + "Processed trace: %s [%.1f traces/sec]"
+               % (numtraces, numtraces / (time.time() - started)))
+    try:
+      batch.add(trace_hops(trace))
+      batch_offsets.append(offset)
+    except EmptyTraceError:
+      TRACES_SKIPPED.inc()
+      continue
+    except ParseError as e:
+      log.debug("Skipping trace: {0}".format(e))
+      TRACES_SKIPPED.inc()
+      continue
+
+    if len(batch) >= BATCH_TRACES:
+      _write_batch(batch, batch_offsets, writer)
+      if checkpoint is not None and checkpoint.due():
+        # Write out the links still buffered, and wait for them and
+        # the writes in flight, so that everything up to the end of
+        # this trace is in Redis before the offset is saved
+        writer.flush()
+        writer.wait()
+        checkpoint.save(offset, previous + numtraces)
+  _write_batch(batch, batch_offsets, writer)
+  TRACES_PARSED.inc(numtraces % 1000)
+
+  # Closing flushes the last links, looking up the ASNs of their IPs
+  writer.close()
+  stats = dict(('geoip_' + key, val - geoip_stats[key])
+               for key, val in aslookup.cache_stats().iteritems()
+               if key in ('hits', 'misses', 'evictions'))
+  if checkpoint is not None:
+    checkpoint.save(offset, previous + numtraces, done=True)
+  stats.update(writer.stats())
+  if not args.dump:
+    log.debug("Wrote {links_written} links ({new_links} new) in {flushes} "
+              "batches. Skipped {ip_writes_avoided} known IP writes."
+              .format(**stats))
+
+  return (path, start, numtraces, time.time() - started, stats)
+
+
+def _write_batch(batch, offsets, writer):
+  """ Parse the traces in :batch:, which end at :offsets:, and hand
+  their links to :writer:
+  """
+  for (newpairs, removed), offset in zip(batch.parse(), offsets):
+    if removed is not None:
+      log.debug("Removed %s" % removed)
+    writer.add(newpairs, offset)
+  batch.clear()
+  del offsets[:]
 
-  try:
-    aslookup = preprocess.MaxMindGeoIPReader.Instance()
-
-    with open(args.trace) as trace_in:
-      tracehops = []
-      seenset = set()
-      numtraces = 0
-      log.info("Processed trace: %s" % str(numtraces))
-      for line in trace_in:
-        if line.split()[0] == "traceroute":
-          numtraces += 1
-          if numtraces % 1000 == 0:
-            log.info("\r\x1b[K" + "Processed trace: %s" % str(numtraces))
-          try:
-            newpairs, removed = TraceParser.parse(tracehops)
-            if removed is not None:
-              log.debug("Removed %s" % removed)
-          except EmptyTraceError:
-            tracehops = [line]
-            continue
-          if not args.dump and dbkeys.mutex_popjoin().is_locked():
-            log.debug("Waiting for popjoin lock")
-            dbkeys.mutex_popjoin().wait()
-
-          if args.dump:
-            for pair in newpairs:
-              print_unless_seen(pair[0], seenset)
-              print_unless_seen(pair[1], seenset)
-          else:
-            load_link_pairs(newpairs, geoipdb=aslookup)
 
-          tracehops = [line]
-        else:
-          tracehops.append(line)
+def bulkload(args):
+  """ Load link stores written by 'parse --offline' into Redis. """
+  r = connection.Redis(structures.ConnectionInfo(**args.redis))
 
-  except IOError as e:
-    log.error("Error: {0}".format(e))
-    raise SilentExit()
-  except DataError as e:
+  try:
+    segments = linkstore.find_segments(args.store)
+    if len(segments) == 0:
+      raise IOError("No link segments found in {0}"
+                    .format(", ".join(args.store)))
+    dbkeys.configure_link_partitions(r, connection.sharded(r))
+    delays.ensure_histogram_store(r, dbkeys.Link.queues())
+    dbkeys.configure_ip_layout(r, args.ip_layout)
+
+    started = time.time()
+    loader = BulkLoader(r, window=args.window)
+    for i, segment in enumerate(segments):
+      for links, ip_asns in linkstore.read_segment(segment):
+        loader.add(links, ip_asns)
+      loader.flush()
+      log.info("Loaded {0} [{1}/{2}]".format(segment, i + 1, len(segments)))
+
+    elapsed = time.time() - started
+    log.info("Loaded {0} links ({1} new) and {2} IP records in {3:.1f} "
+             "seconds [{4:.1f} links/sec]"
+             .format(loader.links_written, loader.new_links,
+                     loader.ip_writes, elapsed,
+                     loader.links_written / max(elapsed, 1e-6)))
+
+  except (IOError, DataError) as e:
     log.error("Error: {0}".format(e))
     raise SilentExit()
 
 
+def convert_delays(args):
+  """ Convert link delays stored as sets by older versions
+  into histograms (see data.delays).
+  """
+  r = connection.Redis(structures.ConnectionInfo(**args.redis))
+  log.info("Converting link delays to histograms")
+  converted = delays.convert_set_store(r, dbkeys.Link.queues())
+  log.info("Converted {0} links".format(converted))
+
+
 def descend_target_chain(r, target):
   """ If :target: has already been joined to something,
   descend down the list of POPs it's been joined to
@@ -153,7 +469,8 @@ def descend_target_chain(r, target):
 def process_delayed_joins(args):
   log.info("Processing delayed joins")
   r = connection.Redis()
-  if r.llen("delayed_job:unassigned_link_fails") > 0:
+  if any(r.llen(dbkeys.Link.unassigned_fails(partition)) > 0
+         for partition in dbkeys.partitions()):
     sys.stderr.write("Have unassigned links. "
                      "Run assign_pops --process_failed\n")
     raise SilentExit()
@@ -174,6 +491,7 @@ def process_delayed_joins(args):
       log.addHandler(fh)
 
     timer = ProgressTimer(x)
+    JOINS_PENDING.set(x)
     for i, to_join in enumerate(joinlist):
       inprocess.append(to_join)
       log.info("Joining %s to %s\n" % (to_join[1], to_join[0]))
@@ -185,6 +503,7 @@ def process_delayed_joins(args):
                   .format(to_join, e))
         joinlist.insert(0, inprocess.pop())
         error_ctr += 1
+        JOIN_ERRORS.inc()
         continue
 
       else:
@@ -201,8 +520,10 @@ def process_delayed_joins(args):
                      "previously been joined to {3}\n"
                      .format(to_join[1], to_join[0], to_join[0], to_join[1]))
         timer.tick(1)
+        JOINS_APPLIED.inc()
 
       x = len(joinlist) - i
+      JOINS_PENDING.set(x)
 
       sys.stderr.write("{newl} {0} joins left {1}\n".format(
                        x,
@@ -265,13 +586,17 @@ def preprocess_joins():
                    "PreProcessing joins {0}\n"
                    .format(Color.wrapformat("[complete]", Color.OKGREEN)))
 
+  # Every pop that was joined to another (including the targets of
+  # earlier joins, which aren't the second pop of any join) is joined
+  # straight to the bottom of its chain
   timer = ProgressTimer(numjoins)
   for i, join in enumerate(joins):
-    newjoin = (get_join_target(jm, join[0]), join[1])
+    for node in (join[1], join[0]):
+      newjoin = (get_join_target(jm, node), node)
 
-    if newjoin not in seen_joins:
-      reduced_joins.append(newjoin)
-      seen_joins.add(newjoin)
+      if newjoin[0] != node and newjoin not in seen_joins:
+        reduced_joins.append(newjoin)
+        seen_joins.add(newjoin)
 
     if i % 100 == 0:
       timer.tick(100)
@@ -304,7 +629,7 @@ def join_pops(r, newpop, oldpop):
   popas = r.get(dbkeys.POP.asn(oldpop))
   interlinks = r.smembers(dbkeys.POP.neighbors(oldpop))
 
-  pipe = r.pipeline()
+  pipe = r.pipeline(transaction=True)
   for connected_pop in interlinks:
     if connected_pop == newpop:
       # What used to be an inter link from oldpop -> newpop
@@ -337,7 +662,7 @@ def join_pops(r, newpop, oldpop):
 
   # Update the pop value for every member of oldpop, and move it to newpop
   for member in members:
-    pipe.hset(dbkeys.ip_key(member), 'pop', newpop)
+    dbkeys.set_pop(member, newpop, pipe=pipe)
     pipe.smove(dbkeys.POP.members(oldpop), dbkeys.POP.members(newpop), member)
 
   # Clean up oldpop
@@ -382,181 +707,275 @@ def assign_pops(args):
   r = connection.Redis()
   if args.reset:
     log.info("Resetting processed_links")
-    if r.llen("delayed_job:unassigned_links") == 0:
-      r.rename("delayed_job:processed_links", "delayed_job:unassigned_links")
-    else:
-      while r.rpoplpush("delayed_job:processed_links",
-                        "delayed_job:unassigned_links"):
-        pass
-    r.delete("delayed_job:unassigned_link_fails")
+    for partition in dbkeys.partitions():
+      unassigned = dbkeys.Link.unassigned(partition)
+      processed = dbkeys.Link.processed(partition)
+      if r.llen(unassigned) == 0:
+        if r.exists(processed):
+          r.rename(processed, unassigned)
+      else:
+        while r.rpoplpush(processed, unassigned):
+          pass
+      r.delete(dbkeys.Link.unassigned_fails(partition),
+               dbkeys.Link.retry_fails(partition))
     return
 
+  partitions = dbkeys.partitions()
+  failed_queues = map(dbkeys.Link.unassigned_fails, partitions)
+  # Links a run was retrying when it was stopped
+  _requeue_retry_fails(r, partitions)
+
+  _init_assign_worker(args.asn_cache_mb, worker=False)
   if args.process_failed:
+    # Links left by an older version, or by a run which gave up
     log.info("Processing failed links")
-    dbkeys.mutex_popjoin().acquire()
-    _assign_pops("delayed_job:unassigned_link_fails",
-                 "delayed_job:unassigned_link_fails2",
-                 no_add_processed=True)
-
-    if r.exists("delayed_job:unassigned_link_fails2"):
-      r.rename("delayed_job:unassigned_link_fails2",
-               "delayed_job:unassigned_link_fails")
-
-    dbkeys.mutex_popjoin().release()
+    try:
+      totals = _assign_failed_serially(args.batch_size)
+    except assign.RETRY_ERRORS as e:
+      log.error("Assigning failed links stopped: {0}. Run assign_pops "
+                "--process_failed again once Redis is healthy.".format(e))
+      raise SilentExit()
+    _log_assign_stats(totals)
+    remaining = _count_links(r, failed_queues)
+    if remaining > 0:
+      log.error("{0} links still failed. Run assign_pops --process_failed "
+                "again once Redis is healthy.".format(remaining))
+      raise SilentExit()
     log.info("Complete")
     return
 
-  _assign_pops("delayed_job:unassigned_links",
-               "delayed_job:unassigned_link_fails")
-
+  workers = args.workers
+  if workers > 1 and connection.in_process(r):
+    log.warn("Forked workers can't share the memory backend. "
+             "Assigning with one worker.")
+    workers = 1
+  # Load the GeoIP tables before any workers fork
+  preprocess.MaxMindGeoIPReader.Instance()
+
+  totals = collections.Counter()
+  errors = []
+  tasks = [(dbkeys.Link.unassigned(partition),
+            dbkeys.Link.processed(partition),
+            dbkeys.Link.unassigned_fails(partition), args.batch_size)
+           for partition in partitions]
+  for attempt in xrange(ASSIGN_ATTEMPTS):
+    if attempt > 0:
+      failed = _count_links(r, failed_queues)
+      if failed == 0:
+        break
+      delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+      log.warn("Retrying {0} failed links in {1} seconds"
+               .format(failed, delay))
+      time.sleep(delay)
+      # Failed links are already on the processed queues. Those which
+      # fail again are set aside until the pass is over, so that
+      # they're not claimed again straight away.
+      tasks = [(dbkeys.Link.unassigned_fails(partition), None,
+                dbkeys.Link.retry_fails(partition), args.batch_size)
+               for partition in partitions]
+    stats, task_errors = _run_assigners(r, tasks, workers, args.asn_cache_mb)
+    totals.update(stats)
+    errors.extend(task_errors)
+    if attempt > 0:
+      _requeue_retry_fails(r, partitions)
+
+  if _count_links(r, failed_queues) > 0:
+    log.warn("Some links still failed. Assigning them in this process")
+    try:
+      totals.update(_assign_failed_serially(args.batch_size))
+    except assign.RETRY_ERRORS as e:
+      errors.append(str(e))
+
+  _log_assign_stats(totals)
+  remaining = _count_links(r, map(dbkeys.Link.unassigned, partitions) +
+                           failed_queues)
+  if errors or remaining > 0:
+    log.error("Assigning failed with {0} errors, leaving {1} links "
+              "unassigned. Run assign_pops again once Redis is healthy."
+              .format(len(errors), remaining))
+    raise SilentExit()
 
-def _assign_pops(unassigned_list_key, failed_list_key,
-                 no_add_processed=False):
-  """ Assign all of the IP addresses found in the redis list
-  :unassigned_list_key:. If any fail, put them in the redis list
-  :failed_list_key.
 
-  Store processed links in 'delayed_job:processed_links' unless
-  :no_add_processed: is False
+def _requeue_retry_fails(r, partitions):
+  """ Move links which failed again while the failed links were
+  being retried back onto the failed queues of :partitions:.
   """
+  for partition in partitions:
+    failed = dbkeys.Link.unassigned_fails(partition)
+    retry = dbkeys.Link.retry_fails(partition)
+    if r.llen(failed) == 0:
+      if r.exists(retry):
+        r.rename(retry, failed)
+    else:
+      while r.rpoplpush(retry, failed):
+        pass
 
-  r = connection.Redis()
 
-  while r.llen(unassigned_list_key) > 0:
-    try:
-      if no_add_processed:
-        link = r.rpop(unassigned_list_key)
-      else:
-        link = r.rpoplpush(unassigned_list_key, "delayed_job:processed_links")
-      if link is None:
-        return
-      ip1, ip2 = link.split(":")[2:]
-      cross_as = different_as(r, dbkeys.ip_key(ip1), dbkeys.ip_key(ip2))
-      cross_24 = different_24(r, ip1, ip2)
-
-      if cross_as is None:
-        # This means that one side of this link has no AS. We don't want it
-       continue
-
-      if dbkeys.get_delay(link) > 2.5 or cross_as or cross_24:
-        success = handle_cross_pop_link(link)
-      else:
-        success = handle_same_pop_link(link)
-
-      log.info("Assigning PoPs. Remaining: [{0}]. "
-               "Deferred for join: [{1}]".format(
-                   Color.wrap(r.llen(unassigned_list_key), Color.OKBLUE),
-                   Color.wrap(r.llen('delayed_job:popjoins'), Color.HEADER)))
-
-      if not success:
-        assert_pops_ok(r, ip1, ip2)
-        r.lpush(failed_list_key, link)
-
-    except DataError as e:
-      log.error("Fatal Error - Resetting: " + e)
-      args = object()
-      args.reset = True
-      return assign_pops(args)
-
-
-def handle_cross_pop_link(link):
-  """ Handle a situation where the two IPs on either end of a
-  link should be in different PoPs.
-
-  - Neither has a PoP assigned
-    - Assign two new PoPs, and create links:inter
-  - One side has a PoP assigned
-    - Assign 1 new PoP and create links:inter
-  -  Both sides have a PoP assigned
-    - Add it to the links:inter
+def _count_links(r, queues):
+  p = r.pipeline(transaction=False)
+  for queue in queues:
+    p.llen(queue)
+  return sum(p.execute())
+
+
+def _run_assigners(r, tasks, workers, asn_cache_mb):
+  """ Work through :tasks: (see _assign_queue) with a pool of
+  :workers: processes, or in this one if there's only one,
+  logging how many links are left every MONITOR_INTERVAL seconds.
+  Each process caches ASNs in :asn_cache_mb: megabytes.
+
+  :returns: (dict of statistics summed over the tasks,
+             list of the errors which stopped any of them)
   """
-  r = connection.Redis()
+  totals = collections.Counter()
+  errors = []
+  if workers <= 1:
+    for task in tasks:
+      stats, error = _assign_queue(task)
+      totals.update(stats)
+      if error is not None:
+        errors.append(error)
+    return totals, errors
+
+  # Partitions are worked through in parallel. With fewer of them
+  # than workers, several workers share each one's queue.
+  tasks = tasks * ((workers + len(tasks) - 1) // len(tasks))
+  queues = sorted(set(task[0] for task in tasks))
+  pool = multiprocessing.Pool(processes=workers,
+                              initializer=_init_assign_worker,
+                              initargs=(asn_cache_mb,))
+  try:
+    results = pool.imap_unordered(_assign_queue, tasks)
+    while True:
+      try:
+        stats, error = results.next(timeout=MONITOR_INTERVAL)
+      except multiprocessing.TimeoutError:
+        remaining = _count_links(r, queues)
+        assign.UNASSIGNED_LINKS.set(remaining)
+        log.info("Assigning PoPs with {0} workers. Remaining: [{1}]"
+                 .format(workers, Color.wrap(remaining, Color.OKBLUE)))
+        continue
+      except StopIteration:
+        break
+      totals.update(stats)
+      if error is not None:
+        errors.append(error)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return totals, errors
 
-  ip1, ip2 = link.split(":")[2:]
 
-  with r.pipeline() as pipe:
-    try:
-      pipe.watch(dbkeys.ip_key(ip1))
-      pipe.watch(dbkeys.ip_key(ip2))
-      pop1 = dbkeys.get_pop(ip1, pipe=pipe)
-      pop2 = dbkeys.get_pop(ip2, pipe=pipe)
-      pipe.multi()
+_asn_cache = None
 
-      if pop1 is None and pop2 is None:
-        pop1 = dbkeys.setpopnumber(dbkeys.mutex_popnum(), ip1, pipe=pipe)
-        pop2 = dbkeys.setpopnumber(dbkeys.mutex_popnum(), ip2, pipe=pipe)
 
-      elif pop1 is not None and pop2 is not None:
-        pass
-      else:
-        if pop1 is None:
-          pop1 = dbkeys.setpopnumber(dbkeys.mutex_popnum(), ip1, pipe=pipe)
-        else:
-          pop2 = dbkeys.setpopnumber(dbkeys.mutex_popnum(), ip2, pipe=pipe)
-      store_link(r, (ip1, ip2), pop1, pop2, pipe=pipe)
-
-      pipe.execute()
-      return True
-    except redis.WatchError:
-      return False
-    finally:
-      pipe.reset()
+def _init_assign_worker(asn_cache_mb, worker=True):
+  """ Set up an assigning process, with a cache of ASNs shared by
+  every queue it works on. Workers ignore SIGINT so that the parent
+  can shut the pool down cleanly.
+  """
+  global _asn_cache
+  _asn_cache = None
+  if asn_cache_mb > 0:
+    _asn_cache = BoundedCache.from_budget(asn_cache_mb,
+                                          assign.ASN_ENTRY_BYTES)
+  if worker:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
-def handle_same_pop_link(link):
-  """ Handle links which should belong to the same PoP
+def _assign_queue(task):
+  """ Assign the links on a queue. :task: is a tuple of the
+  (unassigned, processed, failed) queues and batch size to give
+  assign.BatchAssigner.
 
-  a. Neither has a PoP assigned
-    - Assign both the same pop and set links:intra
-  b. One side has a PoP assigned
-    - Assign the other one the existing PoP and add links:intra
-  c. Both sides have a PoP assigned
-    - add to delayed_job:popjoins
+  :returns: (dict of statistics, the error which stopped it or None)
   """
-  r = connection.Redis()
+  unassigned, processed, failed, batch_size = task
+  assigner = assign.BatchAssigner(connection.Redis(), unassigned,
+                                  processed=processed, failed=failed,
+                                  batch_size=batch_size,
+                                  asn_cache=_asn_cache)
+  try:
+    assigner.run()
+  except assign.RETRY_ERRORS as e:
+    log.error("Stopped assigning {0}: {1}".format(unassigned, e))
+    return assigner.stats(), str(e)
+  return assigner.stats(), None
+
 
-  ip1, ip2 = link.split(":")[2:]
+def _assign_failed_serially(batch_size):
+  """ Assign the links on the failed queues, one batch at a time
+  while holding the join mutex. Links which fail again are left on
+  the failed queues.
 
-  with r.pipeline() as pipe:
+  :returns: dict of statistics
+  """
+  totals = collections.Counter()
+  partitions = dbkeys.partitions()
+  dbkeys.mutex_popjoin().acquire()
+  try:
+    for partition in partitions:
+      totals.update(_assign_pops(
+          dbkeys.Link.unassigned_fails(partition), no_add_processed=True,
+          batch_size=batch_size,
+          failed_list_key=dbkeys.Link.retry_fails(partition)))
+  finally:
     try:
-      pipe.watch(dbkeys.ip_key(ip1))
-      pipe.watch(dbkeys.ip_key(ip2))
-      pop1 = dbkeys.get_pop(ip1, pipe=pipe)
-      pop2 = dbkeys.get_pop(ip2, pipe=pipe)
-      pipe.multi()
-
-      if pop1 is None and pop2 is None:
-        pop1 = dbkeys.setpopnumber(dbkeys.mutex_popnum(), ip1, pipe=pipe)
-        pipe.hset(dbkeys.ip_key(ip2), 'pop', pop1)
-        pipe.sadd(dbkeys.POP.members(pop1), ip2)
-
-        store_link(r, (ip1, ip2), pop1, pipe=pipe)
-      elif pop1 is not None and pop2 is not None:
-        if not r.sismember('delayed_job:popjoins:known', (pop1, pop2)):
-          pipe.lpush("delayed_job:popjoins", (pop1, pop2))
-          pipe.sadd('delayed_job:popjoins:known', (pop1, pop2))
-      else:
-        if pop1 is None:
-          knownpop = pop2
-          pipe.hset(dbkeys.ip_key(ip1), 'pop', knownpop)
-          pipe.sadd(dbkeys.POP.members(knownpop), ip1)
-        else:
-          knownpop = pop1
-          pipe.hset(dbkeys.ip_key(ip2), 'pop', knownpop)
-          pipe.sadd(dbkeys.POP.members(knownpop), ip2)
-        store_link(r, (ip1, ip2), knownpop, pipe=pipe)
-
-      pipe.execute()
-      return True
-    except redis.WatchError:
-      return False
+      _requeue_retry_fails(connection.Redis(), partitions)
     finally:
-      pipe.reset()
+      dbkeys.mutex_popjoin().release()
+  return totals
 
 
-def assert_pops_ok(r, *ips):
-  for ip in ips:
-    pop = dbkeys.get_pop(ip)
-    if pop is not None and not r.sismember('poplist', pop):
-      raise NoPopExistsError(
-          "ip %s has pop of %s, which doesn't exist" % (ip, pop))
+def cluster_pops(args):
+  """ Assign every link to a PoP in one pass, rather than with
+  assign_pops and process_joins (see data.cluster).
+  """
+  r = connection.Redis()
+  try:
+    stats = cluster.Clusterer(r).run()
+  except DataError as e:
+    log.error("Error: {0}".format(e))
+    raise SilentExit()
+  _log_assign_stats(stats)
+  log.info("Clustered links into {0} PoPs".format(stats['pops']))
+
+
+def _log_assign_stats(totals):
+  log.info("Assigned {0} links ({1} without an ASN)"
+           .format(totals['assigned'], totals['no_asn']))
+  if totals.get('failed'):
+    log.info("{0} links failed to be assigned on the way and were "
+             "retried".format(totals['failed']))
+  lookups = (totals.get('asn_cache_hits', 0) +
+             totals.get('asn_cache_misses', 0))
+  if lookups:
+    log.info("ASN cache: {0} lookups, {1:.1%} hit rate"
+             .format(lookups, float(totals['asn_cache_hits']) / lookups))
+
+
+def _assign_pops(unassigned_list_key, no_add_processed=False,
+                 processed_list_key=None, batch_size=assign.BATCH_LINKS,
+                 failed_list_key=None):
+  """ Assign all of the IP addresses found in the redis list
+  :unassigned_list_key:, :batch_size: links at a time (see
+  assign.BatchAssigner).
+
+  Store processed links in :processed_list_key: (by default
+  'delayed_job:processed_links') unless :no_add_processed: is True,
+  and links which fail in :failed_list_key:, if given.
+
+  :returns: dict of statistics
+  """
+  r = connection.Redis()
+  if processed_list_key is None:
+    processed_list_key = dbkeys.Link.processed()
+
+  assigner = assign.BatchAssigner(
+      r, unassigned_list_key,
+      processed=None if no_add_processed else processed_list_key,
+      batch_size=batch_size, failed=failed_list_key, asn_cache=_asn_cache)
+  return assigner.run()
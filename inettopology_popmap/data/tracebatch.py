@@ -0,0 +1,121 @@
+"""
+Turning many traces into links at once.
+
+A TraceBatch gathers the hops of a few thousand traces. When numpy is
+installed, parsing the batch packs every hop into flat arrays (the
+delays, the addresses, and where each trace ends) and runs the steps
+of TraceParser.parsepairs over all of them together: dropping slow
+last hops, smoothing delays and finding the links. Only building the
+link tuples is left to Python. Without numpy each trace goes through
+parsepairs in turn. The results are the same either way.
+"""
+import operator
+import itertools
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from inettopology_popmap.data.parsers import TraceParser, MAX_LAST_DELAY
+
+BATCH_TRACES = 2000
+
+
+class TraceBatch(object):
+  """ A batch of traces, each a list of [ip, delay, ipnum] hops as
+  returned by TraceParser.hops_from_fields or public_hops.
+  """
+
+  def __init__(self):
+    self.traces = []
+
+  def __len__(self):
+    return len(self.traces)
+
+  def add(self, hops):
+    self.traces.append(hops)
+
+  def clear(self):
+    self.traces = []
+
+  def parse(self):
+    """ Return a (links, removed hop) tuple for each trace, as
+    TraceParser.parsepairs would.
+    """
+    if numpy is None or len(self.traces) == 0:
+      return [TraceParser.parsepairs(hops) for hops in self.traces]
+    return _parse_arrays(self.traces)
+
+
+def round3(values):
+  """ Round the array :values: to 3 decimal places as Python's
+  round() does, which is to the nearest. Scaling by 1000 can land
+  a value just beside a midpoint on the wrong side of it, so values
+  that end up close to one are rounded in Python.
+  """
+  scaled = values * 1000
+  rounded = numpy.round(scaled) / 1000
+  close = numpy.flatnonzero(abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6)
+  for i in close.tolist():
+    rounded[i] = round(values[i], 3)
+  return rounded
+
+
+def _parse_arrays(traces):
+  hops = list(itertools.chain.from_iterable(traces))
+  ips = map(operator.itemgetter(0), hops)
+  delays = numpy.array(map(operator.itemgetter(1), hops), numpy.float64)
+  ipnums = numpy.array(map(operator.itemgetter(2), hops), numpy.int64)
+  lengths = numpy.fromiter(itertools.imap(len, traces), numpy.intp,
+                           len(traces))
+  ends = numpy.cumsum(lengths)
+
+  # Drop last hops which are too slow to be believed
+  removed = [None] * len(traces)
+  slow = delays[ends - 1] > MAX_LAST_DELAY
+  for t in numpy.flatnonzero(slow).tolist():
+    removed[t] = traces[t][-1]
+  keep = numpy.ones(len(hops), dtype=bool)
+  keep[(ends - 1)[slow]] = False
+  index = numpy.flatnonzero(keep)
+  delays = delays[index]
+  ipnums = ipnums[index]
+  lengths -= slow
+  ends = numpy.cumsum(lengths)
+  starts = ends - lengths
+
+  # TraceParser.sane_itize walks each trace back from its end, so
+  # the k'th step of every trace is done at once.
+  for k in xrange(1, int(lengths.max()) - 1):
+    middle = ends - 1 - k
+    middle = middle[middle > starts]
+    after = delays[middle + 1]
+    before = delays[middle - 1]
+    fix = delays[middle] > after
+    delays[middle[fix]] = numpy.where(before > after, after,
+                                      (after + before) / 2)[fix]
+
+  # A link joins each hop to the next unless they're the same
+  # address or in different traces
+  linked = ipnums[1:] != ipnums[:-1]
+  boundaries = ends[:-1]
+  boundaries = boundaries[(boundaries > 0) & (boundaries < len(delays))]
+  linked[boundaries - 1] = False
+  firsts = numpy.flatnonzero(linked)
+
+  dists = round3(delays[firsts + 1] - delays[firsts])
+  dists[dists == 0.0] = 1.0
+  links = zip(map(ips.__getitem__, index[firsts].tolist()),
+              map(ips.__getitem__, index[firsts + 1].tolist()),
+              dists.tolist(),
+              ipnums[firsts].tolist(),
+              ipnums[firsts + 1].tolist())
+
+  # Links come out in trace order, so each trace's are a slice
+  counts = numpy.bincount(numpy.searchsorted(ends, firsts, side='right'),
+                          minlength=len(traces))
+  stops = numpy.cumsum(counts).tolist()
+  return [(links[stop - count:stop], hop)
+          for stop, count, hop in itertools.izip(stops, counts.tolist(),
+                                                 removed)]
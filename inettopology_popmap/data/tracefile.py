@@ -0,0 +1,185 @@
+"""
+Helpers for locating and reading traceroute files produced by the
+sc_warts2text command.
+
+Large trace files are split into shards, which are byte ranges that
+always begin on a 'traceroute' header line, so that they can be
+parsed independently of each other.
+
+Files compressed with gzip, bzip2 or xz are decompressed as they are
+read (and are never sharded, since they can't be seeked into). The
+path '-' reads uncompressed text from stdin.
+"""
+import io
+import os
+import sys
+import bz2
+import glob
+import gzip
+import hashlib
+
+TRACE_HEADER = "traceroute"
+STDIN = "-"
+
+_MAGIC = (('\x1f\x8b', 'gzip'),
+          ('BZh', 'bzip2'),
+          ('\xfd7zXZ\x00', 'xz'))
+
+
+def expand_paths(patterns):
+  """ Expand each of :patterns: (which may be a plain path or
+  a glob) into the list of trace files it names.
+
+  :patterns: list of path or glob strings
+  :returns: list of paths, in the order given
+  :raises: IOError if a pattern doesn't match anything
+  """
+  paths = []
+  for pattern in patterns:
+    if pattern == STDIN:
+      paths.append(pattern)
+      continue
+    matched = sorted(glob.glob(pattern))
+    if len(matched) == 0:
+      raise IOError("No trace files match '{0}'".format(pattern))
+    paths.extend(matched)
+  return paths
+
+
+def find_shards(path, shard_size):
+  """ Index :path: into shards of roughly :shard_size: bytes.
+
+  Each shard is a tuple (path, start, end) where :start: is the
+  offset of a 'traceroute' header line and :end: is the offset of
+  the header which begins the next shard (or the end of the file).
+  Compressed files and stdin are a single shard with an :end: of None.
+  """
+  if path == STDIN or compression(path) is not None:
+    return [(path, 0, None)]
+
+  size = os.path.getsize(path)
+  if shard_size <= 0 or size <= shard_size:
+    return [(path, 0, size)]
+
+  boundaries = [0]
+  with open(path, 'rb') as fh:
+    target = shard_size
+    while target < size:
+      fh.seek(target)
+      fh.readline()  # We probably landed mid-line
+
+      pos = fh.tell()
+      line = fh.readline()
+      while line and not line.startswith(TRACE_HEADER):
+        pos = fh.tell()
+        line = fh.readline()
+
+      if not line:
+        break
+      boundaries.append(pos)
+      target = pos + shard_size
+
+  boundaries.append(size)
+  return [(path, start, end)
+          for start, end in zip(boundaries, boundaries[1:])
+          if end > start]
+
+
+def compression(path):
+  """ Return the name of the compression used by :path:
+  (judged by its magic number) or None if it's plain text.
+  """
+  with open(path, 'rb') as fh:
+    head = fh.read(6)
+  for magic, name in _MAGIC:
+    if head.startswith(magic):
+      return name
+  return None
+
+
+def open_trace(path):
+  """ Open :path: for reading, decompressing it if necessary. """
+  if path == STDIN:
+    return sys.stdin
+
+  kind = compression(path)
+  if kind is None:
+    return open(path, 'rb')
+  elif kind == 'gzip':
+    return io.BufferedReader(gzip.open(path, 'rb'))
+  elif kind == 'bzip2':
+    return bz2.BZ2File(path, 'rb')
+  else:
+    try:
+      import lzma
+    except ImportError:
+      try:
+        from backports import lzma
+      except ImportError:
+        raise IOError("Reading xz compressed traces requires the lzma "
+                      "library: 'pip install backports.lzma'")
+    return lzma.LZMAFile(path, 'rb')
+
+
+def content_id(path, sample_size=1024 * 1024):
+  """ Return an identifier for the contents of :path: which is cheap
+  to compute for large files: a hash of its size and of the data at
+  its beginning and end.
+  """
+  size = os.path.getsize(path)
+  digest = hashlib.sha1(str(size))
+  with open(path, 'rb') as fh:
+    digest.update(fh.read(sample_size))
+    if size > sample_size:
+      fh.seek(max(sample_size, size - sample_size))
+      digest.update(fh.read(sample_size))
+  return digest.hexdigest()
+
+
+def read_shard(path, start=0, end=None):
+  """ Yield the lines of :path: between the byte offsets
+  :start: and :end:. An :end: of None reads to the end of the file.
+  Offsets in compressed files are offsets into the uncompressed data.
+  """
+  fh = open_trace(path)
+  try:
+    if start > 0:
+      fh.seek(start)
+
+    if end is None:
+      for line in fh:
+        yield line
+      return
+
+    pos = start
+    while pos < end:
+      line = fh.readline()
+      if not line:
+        break
+      pos += len(line)
+      yield line
+  finally:
+    if fh is not sys.stdin:
+      fh.close()
+
+
+def read_traces(path, start=0, end=None):
+  """ Yield each trace in the shard of :path: between :start:
+  and :end: as a tuple (offset, trace), where :trace: is a list of
+  tokenized lines and :offset: is where the next trace begins. The
+  first line of each trace is its 'traceroute' header. Blank lines
+  are dropped.
+  """
+  trace = []
+  pos = start
+  for line in read_shard(path, start, end):
+    fields = line.split()
+    if len(fields) > 0:
+      if fields[0] == TRACE_HEADER and len(trace) > 0:
+        yield pos, trace
+        trace = []
+      trace.append(fields)
+    pos += len(line)
+
+  if len(trace) > 0:
+    yield pos, trace
@@ -0,0 +1,291 @@
+"""
+A reader for the binary warts files written by scamper, so that
+traces can be parsed without converting them with sc_warts2text.
+
+A warts file is a sequence of records, each with an 8 byte header
+(magic, type, length). Traceroute records hold a block of optional
+parameters, announced by a variable length bitmask of flags, followed
+by one parameter block per hop. Only the parameters needed to build
+the (ip, delay) hop list are decoded; the rest are stepped over.
+
+Each record is read into a single reused buffer and decoded in place
+with struct.unpack_from through a memoryview, so nothing is copied
+per field. Only IPv4 addresses are kept.
+
+See warts(5) in the scamper distribution for the file format.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import sys
+import socket
+import struct
+
+import inettopology_popmap.data.tracefile as tracefile
+
+MAGIC = 0x1205
+TYPE_ADDRESS = 0x0005
+TYPE_TRACE = 0x0006
+
+ADDR_IPV4 = 0x01
+
+_HEADER = struct.Struct('>HHI')
+_U8 = struct.Struct('>B').unpack_from
+_U16 = struct.Struct('>H').unpack_from
+_U32 = struct.Struct('>I').unpack_from
+
+# Parameter sizes in bytes, indexed by flag number. ADDRESS and
+# ICMPEXT parameters have their own variable length encodings.
+ADDRESS = -1
+ICMPEXT = -2
+
+TRACE_PARAMS = (
+    None,
+    4,        # 1: list id
+    4,        # 2: cycle id
+    4,        # 3: source address id (old address format)
+    4,        # 4: destination address id (old address format)
+    8,        # 5: start time
+    1, 1,     # 6-7: stop reason, stop data
+    1, 1,     # 8-9: trace flags, attempts
+    1, 1,     # 10-11: hop limit, trace type
+    2, 2, 2,  # 12-14: probe size, source port, destination port
+    1, 1,     # 15-16: first ttl, ip tos
+    1, 1,     # 17-18: timeout, loops
+    2,        # 19: hop count
+    1, 1, 1,  # 20-22: gap limit, gap action, loop action
+    2,        # 23: probes sent
+    1, 1,     # 24-25: probe interval, confidence
+    ADDRESS,  # 26: source address
+    ADDRESS,  # 27: destination address
+    4,        # 28: user id
+    2,        # 29: ip offset
+)
+TRACE_SRC_ID = 3
+TRACE_SRC = 26
+
+HOP_PARAMS = (
+    None,
+    4,        # 1: address id (old address format)
+    1, 1,     # 2-3: probe ttl, reply ttl
+    1, 1,     # 4-5: hop flags, probe id
+    4,        # 6: rtt in microseconds
+    2,        # 7: icmp type and code
+    2, 2,     # 8-9: probe size, reply size
+    2, 1,     # 10-11: reply ip id, reply tos
+    2,        # 12: next hop mtu
+    2, 1,     # 13-14: quoted ip length, quoted ttl
+    1, 1,     # 15-16: reply tcp flags, quoted tos
+    ICMPEXT,  # 17: icmp extensions
+    ADDRESS,  # 18: address
+    8,        # 19: transmit time
+)
+HOP_ADDR_ID = 1
+HOP_PROBE_TTL = 2
+HOP_RTT = 6
+HOP_ADDR = 18
+
+_UNPACK = {1: _U8, 2: _U16, 4: _U32}
+
+
+class WartsError(Exception):
+  pass
+
+
+def _read_flags(buf, off):
+  """ Read the flag bitmask at :off:. Each byte holds seven
+  flags, and its high bit says whether another byte follows.
+
+  :returns: (list of set flag numbers, offset after the bitmask)
+  """
+  flags = []
+  base = 1
+  while True:
+    byte = _U8(buf, off)[0]
+    off += 1
+    bits = byte & 0x7f
+    bit = 0
+    while bits:
+      if bits & 1:
+        flags.append(base + bit)
+      bits >>= 1
+      bit += 1
+    if not byte & 0x80:
+      return flags, off
+    base += 7
+
+
+def _read_address(buf, off, addrs):
+  """ Read an embedded address at :off:. An address is either
+  written out in full, in which case it's added to :addrs:, or is
+  a reference to one already in :addrs:.
+
+  :returns: ((ip, ipnum) or None if not IPv4, new offset)
+  """
+  length = _U8(buf, off)[0]
+  if length == 0:
+    addr_id = _U32(buf, off + 1)[0]
+    try:
+      return addrs[addr_id], off + 5
+    except IndexError:
+      raise WartsError("Reference to unknown address {0}".format(addr_id))
+
+  addr = None
+  if _U8(buf, off + 1)[0] == ADDR_IPV4 and length == 4:
+    addr = (socket.inet_ntoa(buf[off + 2:off + 6].tobytes()),
+            _U32(buf, off + 2)[0])
+  addrs.append(addr)
+  return addr, off + 2 + length
+
+
+def _read_params(buf, off, sizes, wanted, addrs):
+  """ Read the parameter block at :off:, decoding the integer
+  parameters whose flag numbers are in :wanted: and every address.
+
+  :returns: (dict of flag number to value, offset after the block)
+  """
+  flags, off = _read_flags(buf, off)
+  values = {}
+  if len(flags) == 0:
+    return values, off
+
+  end = off + 2 + _U16(buf, off)[0]
+  off += 2
+  for flag in flags:
+    if flag >= len(sizes):
+      break  # Parameters newer than this reader; skipped below
+    size = sizes[flag]
+    if size == ADDRESS:
+      values[flag], off = _read_address(buf, off, addrs)
+    elif size == ICMPEXT:
+      off += 2 + _U16(buf, off)[0]
+    else:
+      if flag in wanted:
+        values[flag] = _UNPACK[size](buf, off)[0]
+      off += size
+
+  if off > end:
+    raise WartsError("Parameters overrun their declared length")
+  return values, end
+
+
+def _trace_hops(buf, global_addrs):
+  """ Decode the traceroute record in :buf:.
+
+  :returns: a list of [ip, delay, ipnum] with the source first
+            (at a delay of 0.0), followed by the first reply to each
+            probe ttl in order, as TraceParser.parse_hops expects.
+            Returns None if the source isn't an IPv4 address.
+  """
+  addrs = []
+  params, off = _read_params(buf, 0, TRACE_PARAMS,
+                             (TRACE_SRC_ID,), addrs)
+  if TRACE_SRC in params:
+    src = params[TRACE_SRC]
+  else:
+    src = global_addrs.get(params.get(TRACE_SRC_ID))
+  if src is None:
+    return None
+
+  hopcount = _U16(buf, off)[0]
+  off += 2
+  replies = {}
+  wanted = (HOP_ADDR_ID, HOP_PROBE_TTL, HOP_RTT)
+  for i in xrange(hopcount):
+    hop, off = _read_params(buf, off, HOP_PARAMS, wanted, addrs)
+    ttl = hop.get(HOP_PROBE_TTL)
+    if ttl is None or ttl in replies or HOP_RTT not in hop:
+      continue
+    if HOP_ADDR in hop:
+      addr = hop[HOP_ADDR]
+    else:
+      addr = global_addrs.get(hop.get(HOP_ADDR_ID))
+    if addr is not None:
+      replies[ttl] = [addr[0], hop[HOP_RTT] / 1000.0, addr[1]]
+
+  hops = [[src[0], 0.0, src[1]]]
+  hops.extend(replies[ttl] for ttl in sorted(replies))
+  return hops
+
+
+def _global_address(buf, global_addrs):
+  """ Record an address from the old, file wide, address table.
+  Its data is the id modulo 255, the address type, and the address.
+  """
+  addr_id = len(global_addrs) + 1
+  if _U8(buf, 0)[0] != addr_id % 255:
+    raise WartsError("Address table is out of sequence")
+  addr = None
+  if _U8(buf, 1)[0] == ADDR_IPV4 and len(buf) == 6:
+    addr = (socket.inet_ntoa(buf[2:6].tobytes()), _U32(buf, 2)[0])
+  global_addrs[addr_id] = addr
+
+
+def _fill(fh, view):
+  """ Read exactly len(:view:) bytes from :fh: into :view:. """
+  want = len(view)
+  got = 0
+  readinto = getattr(fh, 'readinto', None)
+  while got < want:
+    if readinto is not None:
+      n = readinto(view[got:])
+    else:
+      data = fh.read(want - got)
+      n = len(data)
+      view[got:got + n] = data
+    if not n:
+      raise WartsError("Truncated record")
+    got += n
+
+
+def read_records(fh):
+  """ Yield (offset, type, memoryview of data) for each record in
+  :fh:, where :offset: is where the next record begins.
+
+  The view is only valid until the next record is read.
+  """
+  buf = bytearray(65536)
+  view = memoryview(buf)
+  pos = 0
+  while True:
+    header = fh.read(_HEADER.size)
+    if len(header) == 0:
+      return
+    if len(header) < _HEADER.size:
+      raise WartsError("Truncated record header")
+    magic, rtype, length = _HEADER.unpack(header)
+    if magic != MAGIC:
+      raise WartsError("Bad magic number {0:#x}".format(magic))
+
+    if length > len(buf):
+      buf = bytearray(length)
+      view = memoryview(buf)
+    _fill(fh, view[:length])
+    pos += _HEADER.size + length
+    yield pos, rtype, view[:length]
+
+
+def read_traces(path, start=0):
+  """ Yield each IPv4 traceroute in the warts file at :path: as a
+  tuple (offset, hops), where :hops: is a list of [ip, delay, ipnum]
+  (see _trace_hops) and :offset: is where the next record begins.
+
+  Traces before the offset :start: are skipped, although the records
+  before it are still read, since they may hold addresses that later
+  traces refer to.
+  """
+  fh = tracefile.open_trace(path)
+  global_addrs = {}
+  try:
+    for pos, rtype, data in read_records(fh):
+      if rtype == TYPE_TRACE and pos > start:
+        hops = _trace_hops(data, global_addrs)
+        if hops is not None:
+          yield pos, hops
+      elif rtype == TYPE_ADDRESS:
+        _global_address(data, global_addrs)
+  except (struct.error, WartsError) as e:
+    raise IOError("Corrupt warts file {0}: {1}".format(path, e))
+  finally:
+    if fh is not sys.stdin:
+      fh.close()
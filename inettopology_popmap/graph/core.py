@@ -21,6 +21,7 @@ import inettopology_popmap.graph.util as util
 import inettopology_popmap.graph.objects as graph_objects
 import inettopology_popmap.graph.datautil as datautil
 import inettopology_popmap.graph.concurrent as concurrent
+import inettopology_popmap.metrics as metrics
 from inettopology_popmap.data.cleanup import pipelined_delete
 
 
@@ -36,10 +37,22 @@ thread_graph = None
 thread_r = None
 log_out = None
 
+SP_SOURCES = metrics.Gauge(
+    'popmap_shortest_path_sources_total',
+    'Nodes to find shortest paths from')
+SP_SOURCES_DONE = metrics.Gauge(
+    'popmap_shortest_path_sources_done',
+    'Nodes whose shortest paths have been found')
+
 
 def create_graph(args):
 
     r = connection.Redis()
+    if connection.in_process(r):
+      # The shortest path workers are separate processes
+      raise RuntimeError("Creating a graph needs a database shared with "
+                         "its workers; it can't use --backend memory")
+
     if args.xml:
 
         log.info("Loading saved graph from file: %s" % args.xml)
@@ -80,6 +93,7 @@ def create_graph(args):
 
     timer = ProgressTimer(int(r.scard(SP_KEY)))
     left = timer.total
+    SP_SOURCES.set(timer.total)
     timer.tick(1)
     #pool = Pool(processes=12, initializer=thread_init,
                 #initargs=(graphpath, SP_KEY, TYPE_KEY, USED_KEY, PATH_KEY, ))
@@ -101,6 +115,7 @@ def create_graph(args):
                     Color.wrapformat("[ETA: {0}]", Color.OKBLUE, timer.eta())))
 
         left = r.scard(SP_KEY)
+        SP_SOURCES_DONE.set(timer.total - left)
 
     log.info("\nWaiting for jobs to terminate... ")
     for job in workers:
@@ -295,13 +310,8 @@ def load_from_redis(r, args):
                             nodetype='relay',
                             **poi)
 
-        linkdelays = [
-            delay
-            for edge in r.smembers(dbkeys.Link.intralink(poi['pop']))
-            for delay in r.smembers(dbkeys.delay_key(*eval(edge)))]
-
         try:
-          deciles = util.decile_transform(linkdelays)
+          deciles = util.link_deciles(r, dbkeys.Link.intralink(poi['pop']))
         except util.EmptyListError:
           deciles = [5 for x in xrange(10)]
           stats.incr('poi-latency-defaulted')
@@ -338,13 +348,8 @@ def load_from_redis(r, args):
                 continue
 
             linkkey = dbkeys.Link.interlink(pop1, pop2)
-            linkdelays = [
-                delay
-                for edge in r.smembers(linkkey)
-                for delay in r.smembers(dbkeys.delay_key(*eval(edge)))]
-
             try:
-              latency = util.decile_transform(linkdelays)
+              latency = util.link_deciles(r, linkkey)
             except util.EmptyListError:
               latency = eval(r.get("graph:collapsed:%s" %
                                    (dbkeys.Link.interlink(pop1, pop2))))
@@ -443,13 +448,8 @@ def add_alexa_destinations(vertex_list, linklist, count):
 
         linkkey = dbkeys.Link.intralink(db_ip_pop)
 
-        linkdelays = [
-            delay
-            for edge in r.smembers(linkkey)
-            for delay in r.smembers(dbkeys.delay_key(*eval(edge)))]
-
         try:
-          latency = util.decile_transform(linkdelays)
+          latency = util.link_deciles(r, linkkey)
         except util.EmptyListError:
           latency = [5 for x in xrange(10)]
 
@@ -527,13 +527,8 @@ def add_asn_endpoints(vertex_list, linklist, datafile, count, endpointtype):
                                        nodetype=endpointtype, asn=asn)
                 linkkey = dbkeys.Link.intralink(data[0])
 
-                linkdelays = [
-                    delay
-                    for edge in r.smembers(linkkey)
-                    for delay in r.smembers(dbkeys.delay_key(*eval(edge)))]
-
                 try:
-                  latency = util.decile_transform(linkdelays)
+                  latency = util.link_deciles(r, linkkey)
                 except util.EmptyListError:
                   latency = [5 for x in xrange(10)]
 
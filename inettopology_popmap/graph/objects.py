@@ -4,12 +4,33 @@ log = logging.getLogger(__name__)
 import sys
 
 import inettopology_popmap.connection as connection
-from inettopology_popmap.graph.util import decile_transform
+import inettopology_popmap.memstore as memstore
+from inettopology_popmap.graph.util import decile_transform, link_deciles
 from inettopology_popmap.data.cleanup import write_failed
 from inettopology.util.general import ProgressTimer, Color, pairwise
 import inettopology_popmap.data.dbkeys as dbkeys
 
 
+# Rotate the list KEYS[1] by one, returning the link key moved to
+# its head. If that link no longer exists it's dropped from the list.
+ROTATE_LINK_LUA = """
+    local link
+    link  = redis.call("RPOPLPUSH", KEYS[1], KEYS[1])
+    if redis.call("EXISTS", link) == 0 then
+      redis.call("LPOP", KEYS[1])
+    end
+    return link
+    """
+
+
+@memstore.native_script(ROTATE_LINK_LUA)
+def _rotate_link_native(r, keys, args):
+  link = r.rpoplpush(keys[0], keys[0])
+  if not r.exists(link):
+    r.lpop(keys[0])
+  return link
+
+
 class ASNNotKnown(Exception):
     pass
 
@@ -38,14 +59,7 @@ class LinkDict(dict):
 
     self._max_degree = (-1, 0)
 
-    rpoplpush_keylist = r.register_script("""
-    local link
-    link  = redis.call("RPOPLPUSH", KEYS[1], KEYS[1])
-    if redis.call("EXISTS", link) == 0 then
-      redis.call("LPOP", KEYS[1])
-    end
-    return link
-    """)
+    rpoplpush_keylist = r.register_script(ROTATE_LINK_LUA)
 
     total_links = r.llen(dbkeys.Link.interlink_keys())
     for i in xrange(total_links):
@@ -156,19 +170,15 @@ class LinkDict(dict):
 
         try:
           #side1_delay = median(get_delays(dbkeys.Link.interlink(node, side1)))
-          side1_delays = decile_transform(
-              [float(delay)
-               for edge in r.smembers(dbkeys.Link.interlink(node, side1))
-               for delay in r.smembers(dbkeys.delay_key(*eval(edge)))])
+          side1_delays = link_deciles(
+              r, dbkeys.Link.interlink(node, side1))
         except:
           side1_delays = eval(r.get("graph:collapsed:%s" %
                               (dbkeys.Link.interlink(node, side1))))
         try:
           #side2_delay = median(get_delays(dbkeys.Link.interlink(node, side2)))
-          side2_delays = decile_transform(
-              [float(delay)
-               for edge in r.smembers(dbkeys.Link.interlink(node, side2))
-               for delay in r.smembers(dbkeys.delay_key(*eval(edge)))])
+          side2_delays = link_deciles(
+              r, dbkeys.Link.interlink(node, side2))
         except:
           side2_delays = eval(r.get("graph:collapsed:%s" %
                               (dbkeys.Link.interlink(node, side2))))
@@ -1,3 +1,7 @@
+import inettopology_popmap.data.dbkeys as dbkeys
+import inettopology_popmap.data.delays as delays
+
+
 class EmptyListError(Exception):
     pass
 
@@ -15,3 +19,15 @@ def decile_transform(input_list):
       deciles[decile] = sorted_list[int(decile * interval)]
 
   return deciles
+
+
+def link_deciles(r, linkkey):
+  """ Return the deciles of the delays seen on every IP link
+  in the set :linkkey: (such as an inter- or intra-PoP link set),
+  taken from their delay histograms (see data.delays).
+  """
+  keys = [dbkeys.delay_key(*eval(edge)) for edge in r.smembers(linkkey)]
+  histogram = delays.read(r, keys)
+  if len(histogram) == 0:
+    raise EmptyListError()
+  return delays.deciles(histogram)
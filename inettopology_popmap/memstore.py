@@ -0,0 +1,737 @@
+"""
+An in-process stand-in for Redis, used by '--backend memory'.
+
+MemoryRedis implements the subset of the redis-py StrictRedis
+interface which popmap uses (strings, sets, hashes, lists, counters,
+pipelines with WATCH/MULTI, and key expiry) on plain Python
+containers, so a single machine run doesn't pay a socket round trip
+for every command. Values are stored as strings, the way Redis would
+return them, and commands against a key of the wrong type raise the
+same ResponseError.
+
+Lua scripts can't be run, so each script popmap uses has a native
+implementation registered for its source with native_script. A
+script without one raises a ResponseError when it's called.
+
+The store lives in the memory of one process. It can be saved to
+and loaded from a snapshot file, but it can't be shared with forked
+workers; anything they write is lost.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import time
+import fnmatch
+import hashlib
+import itertools
+import marshal
+import threading
+import collections
+
+import redis
+
+MAGIC = 'popmap-memstore'
+VERSION = 1
+
+WRONGTYPE = ("WRONGTYPE Operation against a key holding "
+             "the wrong kind of value")
+
+# The commands a MemoryRedis supports, named and called as in
+# redis-py's StrictRedis
+COMMANDS = frozenset([
+    'delete', 'exists', 'type', 'keys', 'scan_iter', 'rename',
+    'renamenx', 'expire', 'ttl', 'persist', 'dbsize', 'flushdb',
+    'flushall', 'ping', 'evalsha',
+    'get', 'set', 'setnx', 'setex', 'getset', 'mget', 'incr', 'incrby',
+    'decr',
+    'sadd', 'srem', 'smembers', 'sismember', 'scard', 'spop',
+    'srandmember', 'smove', 'sunion', 'sunionstore', 'sinter',
+    'sinterstore', 'sdiff', 'sdiffstore', 'sscan_iter',
+    'hset', 'hsetnx', 'hget', 'hmset', 'hmget', 'hgetall', 'hdel',
+    'hexists', 'hkeys', 'hvals', 'hlen', 'hincrby', 'hscan_iter',
+    'lpush', 'rpush', 'lpop', 'rpop', 'llen', 'lrange', 'lindex',
+    'lrem', 'ltrim', 'rpoplpush'])
+
+_native_scripts = dict()
+
+
+def _sha(source):
+  return hashlib.sha1(source).hexdigest()
+
+
+def native_script(source):
+  """ A decorator registering the decorated function as the
+  implementation of the Lua script :source:. It's called as
+  func(store, keys, args) and should return what the script would.
+  """
+  def register(func):
+    _native_scripts[_sha(source)] = func
+    return func
+  return register
+
+
+def _encode(value):
+  """ Convert :value: to a string the way redis-py does """
+  if isinstance(value, str):
+    return value
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
+def _to_int(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    raise redis.ResponseError("value is not an integer or out of range")
+
+
+class MemoryScript(object):
+  """ What MemoryRedis.register_script returns, called like a
+  redis-py Script.
+  """
+
+  def __init__(self, store, source):
+    self.store = store
+    self.sha = _sha(source)
+
+  def __call__(self, keys=[], args=[], client=None):
+    client = self.store if client is None else client
+    return client.evalsha(self.sha, len(keys), *(tuple(keys) + tuple(args)))
+
+
+class MemoryPipeline(object):
+  """ A redis-py style pipeline on a MemoryRedis.
+
+  Commands are queued and run together by execute(), holding the
+  store's lock so that nothing else runs in between. As with
+  redis-py, commands issued after watch() and before multi() run
+  straight away, and execute() raises WatchError if a watched key
+  was written to since it was watched.
+  """
+
+  def __init__(self, store, transaction=True):
+    self.store = store
+    self.transaction = transaction
+    self._stack = []
+    self._watched = set()
+    self._explicit = False
+    self.dirty = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.reset()
+
+  def __len__(self):
+    return len(self._stack)
+
+  def __getattr__(self, name):
+    if name not in COMMANDS:
+      raise AttributeError(name)
+
+    def queue(*args, **kwargs):
+      if self._watched and not self._explicit:
+        return getattr(self.store, name)(*args, **kwargs)
+      self._stack.append((name, args, kwargs))
+      return self
+    return queue
+
+  def watch(self, *names):
+    if self._explicit:
+      raise redis.RedisError("Cannot issue a WATCH after a MULTI")
+    with self.store._lock:
+      self.store._db.watch(self, names)
+    self._watched.update(names)
+    return True
+
+  def unwatch(self):
+    if self._watched:
+      with self.store._lock:
+        self.store._db.unwatch(self, self._watched)
+      self._watched = set()
+    self.dirty = False
+    return True
+
+  def multi(self):
+    if self._explicit:
+      raise redis.RedisError("Cannot issue nested calls to MULTI")
+    if self._stack:
+      raise redis.RedisError("Commands without an initial WATCH have "
+                             "already been issued")
+    self._explicit = True
+
+  def reset(self):
+    self.unwatch()
+    self._stack = []
+    self._explicit = False
+
+  def execute(self, raise_on_error=True):
+    stack = self._stack
+    try:
+      with self.store._lock:
+        if self.dirty:
+          raise redis.WatchError("Watched variable changed.")
+        db = self.store._db
+        results = []
+        for name, args, kwargs in stack:
+          try:
+            results.append(getattr(db, name)(*args, **kwargs))
+          except redis.ResponseError as e:
+            results.append(e)
+    finally:
+      self.reset()
+
+    if raise_on_error:
+      for result in results:
+        if isinstance(result, redis.ResponseError):
+          raise result
+    return results
+
+
+class MemoryRedis(object):
+  """ An in-process database, loaded from :snapshot: if it's
+  given and exists.
+
+  Every command in COMMANDS runs on the underlying _Database while
+  holding a lock, so the store can be used from several threads.
+  """
+
+  def __init__(self, snapshot=None):
+    self.snapshot = snapshot
+    self._db = _Database()
+    self._lock = threading.Lock()
+    if snapshot is not None and os.path.exists(snapshot):
+      self.load(snapshot)
+
+  def pipeline(self, transaction=True, shard_hint=None):
+    return MemoryPipeline(self, transaction)
+
+  def register_script(self, source):
+    return MemoryScript(self, source)
+
+  def script_load(self, source):
+    return _sha(source)
+
+  # Snapshots
+
+  def save(self, path=None):
+    """ Write the database to :path: (by default the snapshot it
+    was loaded from), replacing it only once the write is complete.
+    """
+    path = path or self.snapshot
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    started = time.time()
+    with self._lock:
+      db = self._db
+      now = time.time()
+      expires = dict((name, when) for name, when in db.expires.iteritems()
+                     if when > now)
+      data = dict()
+      for name, value in db.data.iteritems():
+        if name in db.expires and name not in expires:
+          continue
+        if type(value) is collections.deque:
+          value = ('list', list(value))
+        data[name] = value
+      with open(tmp_path, 'wb') as fh:
+        marshal.dump((MAGIC, VERSION), fh)
+        marshal.dump(expires, fh)
+        marshal.dump(data, fh)
+    os.rename(tmp_path, path)
+    log.info("Saved {0} keys to {1} in {2:.1f}s"
+             .format(len(data), path, time.time() - started))
+
+  def load(self, path):
+    """ Replace the contents of the database with the snapshot
+    at :path:.
+    """
+    started = time.time()
+    with open(path, 'rb') as fh:
+      try:
+        header = marshal.load(fh)
+      except (EOFError, ValueError, TypeError):
+        header = None
+      if header != (MAGIC, VERSION):
+        raise IOError("{0} is not a version {1} popmap snapshot"
+                      .format(path, VERSION))
+      expires = marshal.load(fh)
+      data = marshal.load(fh)
+
+    for name, value in data.iteritems():
+      if type(value) is tuple:
+        data[name] = collections.deque(value[1])
+    with self._lock:
+      self._db.flushdb()
+      self._db.data = data
+      self._db.expires = expires
+    log.info("Loaded {0} keys from {1} in {2:.1f}s"
+             .format(len(data), path, time.time() - started))
+
+
+class _Database(object):
+  """ The contents of a MemoryRedis and the commands on them,
+  which expect the caller to hold the store's lock.
+  """
+
+  def __init__(self):
+    self.data = dict()
+    self.expires = dict()
+    self.watchers = dict()
+
+  # Internals
+
+  def _lookup(self, name, kind=None):
+    """ Return the value at :name:, or None if there isn't one.
+
+    :raises: ResponseError if it isn't a :kind:
+    """
+    if self.expires and name in self.expires:
+      if self.expires[name] <= time.time():
+        self._remove(name)
+        return None
+    value = self.data.get(name)
+    if value is not None and kind is not None and type(value) is not kind:
+      raise redis.ResponseError(WRONGTYPE)
+    return value
+
+  def _create(self, name, kind):
+    """ Return the :kind: at :name:, creating it if needed """
+    value = self._lookup(name, kind)
+    if value is None:
+      value = self.data[name] = kind()
+    self._touch(name)
+    return value
+
+  def _touch(self, name):
+    for pipe in self.watchers.get(name, ()):
+      pipe.dirty = True
+
+  def _tidy(self, name, value):
+    """ Drop :name: if :value: is an empty container, as Redis does """
+    if len(value) == 0:
+      self._remove(name)
+
+  def _remove(self, name):
+    self.expires.pop(name, None)
+    return self.data.pop(name, None) is not None
+
+  def watch(self, pipe, names):
+    for name in names:
+      self.watchers.setdefault(name, set()).add(pipe)
+
+  def unwatch(self, pipe, names):
+    for name in names:
+      watchers = self.watchers.get(name)
+      if watchers is not None:
+        watchers.discard(pipe)
+        if len(watchers) == 0:
+          del self.watchers[name]
+
+  # Connection
+
+  def evalsha(self, sha, numkeys, *keys_and_args):
+    try:
+      func = _native_scripts[sha]
+    except KeyError:
+      raise redis.ResponseError("NOSCRIPT No native implementation of "
+                                "script {0}".format(sha))
+    return func(self, list(keys_and_args[:numkeys]),
+                list(keys_and_args[numkeys:]))
+
+  def ping(self):
+    return True
+
+  # Keys
+
+  def delete(self, *names):
+    removed = 0
+    for name in map(_encode, names):
+      if self._lookup(name) is not None:
+        self._remove(name)
+        self._touch(name)
+        removed += 1
+    return removed
+
+  def exists(self, name):
+    return self._lookup(name) is not None
+
+  def type(self, name):
+    value = self._lookup(name)
+    if value is None:
+      return 'none'
+    return {str: 'string', set: 'set', dict: 'hash',
+            collections.deque: 'list'}[type(value)]
+
+  def keys(self, pattern='*'):
+    names = [name for name in self.data.keys()
+             if self._lookup(name) is not None]
+    if pattern == '*':
+      return names
+    return [name for name in names if fnmatch.fnmatchcase(name, pattern)]
+
+  # The scans gather everything up front, since the lock is only
+  # held while the command runs.
+
+  def scan_iter(self, match=None, count=None):
+    return iter(self.keys(match or '*'))
+
+  def rename(self, src, dst):
+    value = self._lookup(src)
+    if value is None:
+      raise redis.ResponseError("no such key")
+    expires = self.expires.get(src)
+    self._remove(src)
+    self._remove(dst)
+    self.data[dst] = value
+    if expires is not None:
+      self.expires[dst] = expires
+    self._touch(src)
+    self._touch(dst)
+    return True
+
+  def renamenx(self, src, dst):
+    if self._lookup(dst) is not None:
+      return False
+    return self.rename(src, dst)
+
+  def expire(self, name, time_):
+    if self._lookup(name) is None:
+      return False
+    self.expires[name] = time.time() + time_
+    self._touch(name)
+    return True
+
+  def ttl(self, name):
+    if self._lookup(name) is None:
+      return -2
+    if name not in self.expires:
+      return -1
+    return int(round(self.expires[name] - time.time()))
+
+  def persist(self, name):
+    if self._lookup(name) is None:
+      return False
+    return self.expires.pop(name, None) is not None
+
+  def dbsize(self):
+    return len(self.keys())
+
+  def flushdb(self):
+    for name in self.data.keys():
+      self._touch(name)
+    self.data.clear()
+    self.expires.clear()
+    return True
+
+  flushall = flushdb
+
+  # Strings
+
+  def get(self, name):
+    return self._lookup(name, str)
+
+  def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+    exists = self._lookup(name) is not None
+    if (nx and exists) or (xx and not exists):
+      return None
+    self._remove(name)
+    self.data[name] = _encode(value)
+    if ex is not None:
+      self.expires[name] = time.time() + ex
+    elif px is not None:
+      self.expires[name] = time.time() + px / 1000.0
+    self._touch(name)
+    return True
+
+  def setnx(self, name, value):
+    return self.set(name, value, nx=True) is not None
+
+  def setex(self, name, time_, value):
+    return self.set(name, value, ex=time_)
+
+  def getset(self, name, value):
+    old = self._lookup(name, str)
+    self.set(name, value)
+    return old
+
+  def mget(self, keys, *args):
+    names = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+    names.extend(args)
+    values = [self._lookup(name) for name in names]
+    return [value if type(value) is str else None for value in values]
+
+  def incrby(self, name, amount=1):
+    value = _to_int(self._lookup(name, str) or 0) + amount
+    self.data[name] = str(value)
+    self._touch(name)
+    return value
+
+  incr = incrby
+
+  def decr(self, name, amount=1):
+    return self.incrby(name, -amount)
+
+  # Sets
+
+  def sadd(self, name, *values):
+    if len(values) == 0:
+      raise redis.ResponseError("wrong number of arguments for 'sadd'")
+    members = self._create(name, set)
+    before = len(members)
+    members.update(_encode(value) for value in values)
+    return len(members) - before
+
+  def srem(self, name, *values):
+    members = self._lookup(name, set)
+    if members is None:
+      return 0
+    before = len(members)
+    members.difference_update(_encode(value) for value in values)
+    self._touch(name)
+    self._tidy(name, members)
+    return before - len(members)
+
+  def smembers(self, name):
+    return set(self._lookup(name, set) or ())
+
+  def sismember(self, name, value):
+    return _encode(value) in (self._lookup(name, set) or ())
+
+  def scard(self, name):
+    return len(self._lookup(name, set) or ())
+
+  def spop(self, name):
+    members = self._lookup(name, set)
+    if members is None:
+      return None
+    member = members.pop()
+    self._touch(name)
+    self._tidy(name, members)
+    return member
+
+  def srandmember(self, name, number=None):
+    members = list(self._lookup(name, set) or ())
+    if number is None:
+      return members[0] if members else None
+    return members[:number]
+
+  def smove(self, src, dst, value):
+    value = _encode(value)
+    members = self._lookup(src, set)
+    self._lookup(dst, set)
+    if members is None or value not in members:
+      return False
+    members.discard(value)
+    self._touch(src)
+    self._tidy(src, members)
+    self._create(dst, set).add(value)
+    return True
+
+  def _sets(self, keys, args):
+    names = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+    names.extend(args)
+    return [self._lookup(name, set) or set() for name in names]
+
+  def _store_set(self, dest, members):
+    self._remove(dest)
+    if members:
+      self.data[dest] = members
+    self._touch(dest)
+    return len(members)
+
+  def sunion(self, keys, *args):
+    return set().union(*self._sets(keys, args))
+
+  def sunionstore(self, dest, keys, *args):
+    return self._store_set(dest, self.sunion(keys, *args))
+
+  def sinter(self, keys, *args):
+    sets = self._sets(keys, args)
+    return set(sets[0]).intersection(*sets[1:])
+
+  def sinterstore(self, dest, keys, *args):
+    return self._store_set(dest, self.sinter(keys, *args))
+
+  def sdiff(self, keys, *args):
+    sets = self._sets(keys, args)
+    return set(sets[0]).difference(*sets[1:])
+
+  def sdiffstore(self, dest, keys, *args):
+    return self._store_set(dest, self.sdiff(keys, *args))
+
+  def sscan_iter(self, name, match=None, count=None):
+    return iter([member for member in self.smembers(name)
+                 if match is None or fnmatch.fnmatchcase(member, match)])
+
+  # Hashes
+
+  def hset(self, name, key, value):
+    fields = self._create(name, dict)
+    key = _encode(key)
+    new = key not in fields
+    fields[key] = _encode(value)
+    return int(new)
+
+  def hsetnx(self, name, key, value):
+    if _encode(key) in (self._lookup(name, dict) or ()):
+      return 0
+    return self.hset(name, key, value)
+
+  def hget(self, name, key):
+    return (self._lookup(name, dict) or {}).get(_encode(key))
+
+  def hmset(self, name, mapping):
+    if not mapping:
+      raise redis.DataError("'hmset' with 'mapping' of length 0")
+    fields = self._create(name, dict)
+    for key, value in mapping.iteritems():
+      fields[_encode(key)] = _encode(value)
+    return True
+
+  def hmget(self, name, keys, *args):
+    names = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+    names.extend(args)
+    fields = self._lookup(name, dict) or {}
+    return [fields.get(_encode(key)) for key in names]
+
+  def hgetall(self, name):
+    return dict(self._lookup(name, dict) or {})
+
+  def hdel(self, name, *keys):
+    fields = self._lookup(name, dict)
+    if fields is None:
+      return 0
+    removed = 0
+    for key in keys:
+      if fields.pop(_encode(key), None) is not None:
+        removed += 1
+    self._touch(name)
+    self._tidy(name, fields)
+    return removed
+
+  def hexists(self, name, key):
+    return _encode(key) in (self._lookup(name, dict) or ())
+
+  def hkeys(self, name):
+    return list(self._lookup(name, dict) or ())
+
+  def hvals(self, name):
+    return list((self._lookup(name, dict) or {}).itervalues())
+
+  def hlen(self, name):
+    return len(self._lookup(name, dict) or ())
+
+  def hincrby(self, name, key, amount=1):
+    fields = self._create(name, dict)
+    key = _encode(key)
+    value = _to_int(fields.get(key, 0)) + amount
+    fields[key] = str(value)
+    return value
+
+  def hscan_iter(self, name, match=None, count=None):
+    return iter([(key, value) for key, value in self.hgetall(name).iteritems()
+                 if match is None or fnmatch.fnmatchcase(key, match)])
+
+  # Lists
+
+  def lpush(self, name, *values):
+    items = self._create(name, collections.deque)
+    items.extendleft(_encode(value) for value in values)
+    return len(items)
+
+  def rpush(self, name, *values):
+    items = self._create(name, collections.deque)
+    items.extend(_encode(value) for value in values)
+    return len(items)
+
+  def _pop(self, name, left):
+    items = self._lookup(name, collections.deque)
+    if items is None:
+      return None
+    item = items.popleft() if left else items.pop()
+    self._touch(name)
+    self._tidy(name, items)
+    return item
+
+  def lpop(self, name):
+    return self._pop(name, True)
+
+  def rpop(self, name):
+    return self._pop(name, False)
+
+  def llen(self, name):
+    return len(self._lookup(name, collections.deque) or ())
+
+  def lrange(self, name, start, end):
+    items = self._lookup(name, collections.deque)
+    if items is None:
+      return []
+    length = len(items)
+    start = max(0, start + length if start < 0 else start)
+    end = min(length - 1, end + length if end < 0 else end)
+    if start > end:
+      return []
+    return list(itertools.islice(items, start, end + 1))
+
+  def lindex(self, name, index):
+    items = self._lookup(name, collections.deque) or ()
+    try:
+      return items[index]
+    except IndexError:
+      return None
+
+  def lrem(self, name, count, value):
+    items = self._lookup(name, collections.deque)
+    if items is None:
+      return 0
+    value = _encode(value)
+    kept = list(items)
+    if count < 0:
+      kept.reverse()
+    removed = 0
+    result = []
+    for item in kept:
+      if item == value and (count == 0 or removed < abs(count)):
+        removed += 1
+      else:
+        result.append(item)
+    if count < 0:
+      result.reverse()
+    items.clear()
+    items.extend(result)
+    self._touch(name)
+    self._tidy(name, items)
+    return removed
+
+  def ltrim(self, name, start, end):
+    kept = self.lrange(name, start, end)
+    items = self._lookup(name, collections.deque)
+    if items is not None:
+      items.clear()
+      items.extend(kept)
+      self._touch(name)
+      self._tidy(name, items)
+    return True
+
+  def rpoplpush(self, src, dst):
+    self._lookup(dst, collections.deque)
+    item = self._pop(src, False)
+    if item is not None:
+      self._create(dst, collections.deque).appendleft(item)
+    return item
+
+
+def _locked(name):
+  def command(self, *args, **kwargs):
+    with self._lock:
+      return getattr(self._db, name)(*args, **kwargs)
+  command.__name__ = name
+  return command
+
+for _name in COMMANDS:
+  setattr(MemoryRedis, _name, _locked(_name))
@@ -0,0 +1,220 @@
+"""
+Counters, gauges and histograms describing how a run is going, so
+that long runs can be watched, and compared, without scraping logs.
+
+Metrics are defined once, at module level, by the code they measure.
+Their values live in memory shared with every process forked after
+they were defined, so what the parse workers count adds up in the
+process that started them. With --metrics_port the command serves
+them in the Prometheus text format at http://127.0.0.1:PORT/metrics,
+and with --metrics_json FILE it writes them to FILE when it finishes.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import json
+import time
+import bisect
+import threading
+import multiprocessing
+import BaseHTTPServer
+
+MAX_VALUES = 4096
+
+# Seconds, for timing round trips to Redis and the like
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_values = multiprocessing.RawArray('d', MAX_VALUES)
+_lock = multiprocessing.Lock()
+_metrics = []
+
+
+def _allocate(metric, size):
+  used = sum(m.size for m in _metrics)
+  if used + size > MAX_VALUES:
+    raise RuntimeError("Too many metrics to define {0}".format(metric.name))
+  _metrics.append(metric)
+  return used
+
+
+class Metric(object):
+  """ A value named :name:, with a :help: line and optional :labels:
+  (a dict) which set it apart from others of the same name.
+  """
+  kind = None
+  size = 1
+
+  def __init__(self, name, help, labels=None):
+    self.name = name
+    self.help = help
+    self.labels = labels or {}
+    self._slot = _allocate(self, self.size)
+
+  def samples(self):
+    """ Yield a (name, labels, value) for each sample """
+    yield self.name, self.labels, _values[self._slot]
+
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, amount=1):
+    with _lock:
+      _values[self._slot] += amount
+
+  def value(self):
+    return _values[self._slot]
+
+
+class Gauge(Metric):
+  kind = 'gauge'
+
+  def set(self, value):
+    with _lock:
+      _values[self._slot] = value
+
+  def inc(self, amount=1):
+    with _lock:
+      _values[self._slot] += amount
+
+  def dec(self, amount=1):
+    self.inc(-amount)
+
+  def value(self):
+    return _values[self._slot]
+
+
+class Histogram(Metric):
+  """ Counts observations falling at or below each of :buckets:,
+  along with their total.
+  """
+  kind = 'histogram'
+
+  def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+    self.buckets = tuple(sorted(buckets))
+    # A count for each bucket and for +Inf, then the sum
+    self.size = len(self.buckets) + 2
+    super(Histogram, self).__init__(name, help, labels)
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.buckets, value)
+    with _lock:
+      _values[self._slot + i] += 1
+      _values[self._slot + len(self.buckets) + 1] += value
+
+  def time(self):
+    """ A context manager which observes how long its block took """
+    return _Timer(self)
+
+  def samples(self):
+    counts = _values[self._slot:self._slot + len(self.buckets) + 1]
+    total = 0
+    for bound, count in zip(self.buckets + ('+Inf',), counts):
+      total += count
+      labels = dict(self.labels, le=str(bound))
+      yield self.name + '_bucket', labels, total
+    yield self.name + '_sum', self.labels, \
+        _values[self._slot + len(self.buckets) + 1]
+    yield self.name + '_count', self.labels, total
+
+
+class _Timer(object):
+
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.started = time.time()
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.histogram.observe(time.time() - self.started)
+
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join('{0}="{1}"'.format(key, labels[key])
+                        for key in sorted(labels)) + '}'
+
+
+def _format_value(value):
+  if value == int(value):
+    return str(int(value))
+  return repr(value)
+
+
+def render():
+  """ Return every metric in the Prometheus text format """
+  lines = []
+  described = set()
+  for metric in sorted(_metrics, key=lambda m: m.name):
+    if metric.name not in described:
+      described.add(metric.name)
+      lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+      lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+    for name, labels, value in metric.samples():
+      lines.append("{0}{1} {2}".format(name, _format_labels(labels),
+                                       _format_value(value)))
+  return "\n".join(lines) + "\n"
+
+
+def snapshot():
+  """ Return every metric as a list of dicts, ready for JSON """
+  return [{'name': name, 'type': metric.kind, 'labels': labels,
+           'value': value}
+          for metric in _metrics
+          for name, labels, value in metric.samples()]
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = render()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    log.debug(format % args)
+
+
+def serve(port, host='127.0.0.1'):
+  """ Serve the metrics over HTTP on :host:::port: from a
+  background thread.
+
+  :returns: the server, for shutdown()
+  """
+  server = BaseHTTPServer.HTTPServer((host, port), _Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  log.info("Serving metrics on http://{0}:{1}/metrics"
+           .format(host, server.server_port))
+  return server
+
+
+def start(args):
+  """ Expose the metrics as asked for by :args:.
+
+  :returns: a function to call once the command is done, which
+  stops the server and writes the JSON dump
+  """
+  port = getattr(args, 'metrics_port', None)
+  path = getattr(args, 'metrics_json', None)
+  server = serve(port) if port else None
+
+  def finish():
+    if server is not None:
+      server.shutdown()
+      server.server_close()
+    if path is not None:
+      with open(path, 'w') as fh:
+        json.dump({'time': time.time(), 'metrics': snapshot()}, fh,
+                  indent=2)
+  return finish
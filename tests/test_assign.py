@@ -0,0 +1,33 @@
+import unittest
+
+import inettopology_popmap.data.delays as delays
+import inettopology_popmap.data.assign as assign
+
+
+def median_of(*values):
+  histogram = dict()
+  for value in values:
+    b = delays.bucket(value)
+    histogram[b] = histogram.get(b, 0) + 1
+  return delays.median(histogram)
+
+
+class FarLinkTest(unittest.TestCase):
+
+  def test_threshold_delay_is_same_pop(self):
+    for delay in (2.0, 2.49, 2.495, 2.4999, assign.MAX_SAME_POP_DELAY):
+      self.assertFalse(assign.far_link(median_of(delay), '10.0.0.1', '10.0.0.2'),
+                       "{0} ms counted as cross-PoP".format(delay))
+
+  def test_delay_above_threshold_bucket_is_far(self):
+    above = delays.bucket_top(assign.MAX_SAME_POP_DELAY) * 1.001
+    for delay in (above, 3.0, 50.0):
+      self.assertTrue(assign.far_link(median_of(delay), '10.0.0.1', '10.0.0.2'),
+                      "{0} ms counted as same PoP".format(delay))
+
+  def test_different_24_is_far(self):
+    self.assertTrue(assign.far_link(median_of(0.5), '10.0.0.1', '10.0.1.1'))
+
+
+if __name__ == '__main__':
+  unittest.main()
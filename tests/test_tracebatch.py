@@ -0,0 +1,104 @@
+import copy
+import random
+import socket
+import struct
+import unittest
+
+import inettopology_popmap.data.tracebatch as tracebatch
+from inettopology_popmap.data.parsers import TraceParser, MAX_LAST_DELAY
+
+
+def hop(ipnum, delay):
+  return [socket.inet_ntoa(struct.pack('!I', ipnum)), delay, ipnum]
+
+
+def trace(ipnums, delays):
+  """ A trace from the source ipnums[0], whose delay is 0 """
+  return [hop(ipnum, delay)
+          for ipnum, delay in zip(ipnums, [0.0] + list(delays))]
+
+
+def random_trace(rng, length, repeats=0.0, midpoints=False):
+  """ A trace of :length: hops with rising (mostly) delays. With
+  :midpoints:, delays are multiples of 0.0005 ms, so the distances
+  between hops often fall halfway between two rounded values.
+  """
+  ipnums = [rng.randint(0x01000000, 0xDFFFFFFF)]
+  delays = []
+  delay = 0.0
+  for i in xrange(length - 1):
+    if rng.random() < repeats:
+      ipnums.append(ipnums[-1])
+    else:
+      ipnums.append(rng.randint(0x01000000, 0xDFFFFFFF))
+    step = rng.uniform(-2.0, 10.0)
+    if midpoints:
+      step = round(step / 0.0005) * 0.0005
+    delay = max(delay + step, 0.0)
+    delays.append(delay)
+  return trace(ipnums, delays)
+
+
+@unittest.skipIf(tracebatch.numpy is None, "numpy isn't installed")
+class TraceBatchTest(unittest.TestCase):
+
+  def assertMatchesParser(self, traces):
+    # parsepairs smooths the delays of the hops it's given in place
+    batch = tracebatch.TraceBatch()
+    for hops in traces:
+      batch.add(copy.deepcopy(hops))
+    expected = [TraceParser.parsepairs(copy.deepcopy(hops))
+                for hops in traces]
+    self.assertEqual(batch.parse(), expected)
+
+  def test_slow_last_hops(self):
+    rng = random.Random(1)
+    traces = []
+    for last in (MAX_LAST_DELAY, MAX_LAST_DELAY + 0.001, 1500.0):
+      traces.append(trace([0x01020304, 0x01020305, 0x01020306],
+                          [3.0, last]))
+      traces.append(trace([0x01020304, 0x01020305], [last]))
+      traces.append(random_trace(rng, 6)[:-1] + [hop(0x05060708, last)])
+    self.assertMatchesParser(traces)
+
+  def test_single_hop_traces(self):
+    rng = random.Random(2)
+    single = [trace([0x01020304], []), trace([0x05060708], [])]
+    self.assertMatchesParser(single)
+    self.assertMatchesParser(single + [random_trace(rng, 5)] + single +
+                             [random_trace(rng, 3)] + single)
+
+  def test_repeated_adjacent_addresses(self):
+    rng = random.Random(3)
+    traces = [trace([0x01020304, 0x01020304, 0x01020305], [1.0, 2.0]),
+              trace([0x01020305, 0x01020306, 0x01020306], [1.0, 1.0]),
+              # Starts where the last one ended, which isn't a link
+              trace([0x01020306, 0x01020307], [4.0])]
+    traces.extend(random_trace(rng, 8, repeats=0.5) for i in xrange(50))
+    self.assertMatchesParser(traces)
+
+  def test_rounding_midpoints(self):
+    rng = random.Random(4)
+    traces = [trace([0x01020304, 0x01020305, 0x01020306, 0x01020307],
+                    [0.0005, 1.0015, 2.0030]),
+              trace([0x01020304, 0x01020305, 0x01020306],
+                    [2.2225, 4.4455])]
+    traces.extend(random_trace(rng, 10, midpoints=True)
+                  for i in xrange(200))
+    self.assertMatchesParser(traces)
+
+  def test_random_batches(self):
+    rng = random.Random(5)
+    for i in xrange(20):
+      traces = [random_trace(rng, rng.randint(1, 20),
+                             repeats=rng.choice((0.0, 0.2)),
+                             midpoints=rng.random() < 0.5)
+                for j in xrange(rng.randint(1, 100))]
+      for hops in traces:
+        if rng.random() < 0.1:
+          hops[-1][1] = rng.uniform(MAX_LAST_DELAY - 1, MAX_LAST_DELAY + 1)
+      self.assertMatchesParser(traces)
+
+
+if __name__ == '__main__':
+  unittest.main()